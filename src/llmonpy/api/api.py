@@ -14,9 +14,10 @@
 #  OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 import os
 
-from flask import jsonify, request, send_from_directory
+from flask import jsonify, request, send_from_directory, Response
 
 from llmonpy.llm_client import llm_client_prompt_status_service
+from llmonpy.llmonpy_metrics import render_openmetrics, OPENMETRICS_CONTENT_TYPE
 from llmonpy.api.api_app import app
 from llmonpy.api.api_config import api_config
 from llmonpy.api.api_system_startup import api_system_startup, api_system_stop
@@ -101,6 +102,12 @@ def get_all_llm_client_status():
     return jsonify(status_list)
 
 
+@app.route('/metrics')
+def get_metrics():
+    result = Response(render_openmetrics(), content_type=OPENMETRICS_CONTENT_TYPE)
+    return result
+
+
 def init_api_directory():
     global global_static_directory
     if global_static_directory is None:
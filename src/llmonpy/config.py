@@ -12,10 +12,14 @@
 #   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
 #   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
 #   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
-import concurrent
 import os
 
 from llmonpy.llm_client import init_llm_clients
+from llmonpy.llmonpy_http import HttpPoolSettings, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_KEEPALIVE_CONNECTIONS, \
+    DEFAULT_KEEPALIVE_EXPIRY, DEFAULT_PREWARM_CONNECTIONS
+from llmonpy.llmonpy_cache import init_response_cache, DEFAULT_CACHE_MAX_BYTES, DEFAULT_CACHE_TTL
+from llmonpy.llmonpy_scheduler import LLMonPyScheduler, DEFAULT_PROMPT_WORKER_COUNT, \
+    DEFAULT_PROVIDER_CONCURRENCY_LIMIT, DEFAULT_MODEL_CONCURRENCY_LIMIT
 from llmonpy.system_services import add_service_to_stop
 
 DEFAULT_THREAD_POOL_SIZE = 100
@@ -37,13 +41,36 @@ class LLMonPyConfig:
         return cls._instance
 
     def __init__(self, data_directory=None,
-                 thread_pool_size=DEFAULT_THREAD_POOL_SIZE):
+                 thread_pool_size=DEFAULT_THREAD_POOL_SIZE,
+                 prompt_worker_count=DEFAULT_PROMPT_WORKER_COUNT,
+                 provider_concurrency_limit=DEFAULT_PROVIDER_CONCURRENCY_LIMIT,
+                 model_concurrency_limit=DEFAULT_MODEL_CONCURRENCY_LIMIT,
+                 response_cache_enabled=False,
+                 response_cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 response_cache_ttl=DEFAULT_CACHE_TTL,
+                 http_max_connections=DEFAULT_MAX_CONNECTIONS,
+                 http_max_keepalive_connections=DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+                 http_keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+                 http2=None,
+                 prewarm_connections=DEFAULT_PREWARM_CONNECTIONS,
+                 metrics_port=None):
+        # thread_pool_size is the number of pypeline workers, prompts run on the scheduler's prompt workers
         self.thread_pool_size = thread_pool_size
-        self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_pool_size)
+        self.scheduler = LLMonPyScheduler(prompt_worker_count, thread_pool_size, provider_concurrency_limit,
+                                          model_concurrency_limit)
         self.data_directory = data_directory if data_directory else compute_default_data_directory()
+        self.response_cache_enabled = response_cache_enabled
+        self.response_cache_max_bytes = response_cache_max_bytes
+        self.response_cache_ttl = response_cache_ttl
+        # one pool per provider endpoint, prewarm_connections > 0 opens that many connections per endpoint at init
+        self.http_pool_settings = HttpPoolSettings(http_max_connections, http_max_keepalive_connections,
+                                                   http_keepalive_expiry, http2,
+                                                   prewarm_connections=prewarm_connections)
+        # serves /metrics on its own thread when set, the llmonpy_viewer app always serves it
+        self.metrics_port = metrics_port
 
     def stop(self):
-        self.thread_pool.shutdown()
+        self.scheduler.stop()
 
     @staticmethod
     def get_instance():
@@ -53,9 +80,19 @@ class LLMonPyConfig:
 def init_llmonpy():
     config = LLMonPyConfig()
     add_service_to_stop(config)
-    init_llm_clients(data_directory=config.data_directory)
+    init_llm_clients(data_directory=config.data_directory, pool_settings=config.http_pool_settings)
     if os.path.isdir(config.data_directory) is False:
         os.makedirs(config.data_directory)
+    if config.response_cache_enabled:
+        response_cache = init_response_cache(config.data_directory, config.response_cache_max_bytes,
+                                             config.response_cache_ttl)
+        add_service_to_stop(response_cache)
+    if config.metrics_port is not None:
+        # imported here, llmonpy_metrics reads the trace log which imports this module
+        from llmonpy.llmonpy_metrics import MetricsServer
+        metrics_server = MetricsServer(config.metrics_port)
+        metrics_server.start()
+        add_service_to_stop(metrics_server)
 
 
 def llmonpy_config() -> LLMonPyConfig:
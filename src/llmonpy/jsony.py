@@ -1,94 +1,305 @@
-import io
 import json
+import re
 
-ESCAPE_CHARACTERS = {
-    "\b": "b",
-    "\f": "f",
-    "\n": "n",
-    "\r": "r",
-    "\t": "t",
-    '"': '"'
-}
+JSON_WHITESPACE_CHARS = {" ", "\t", "\n", "\r"}
+POST_QUOTE_CHARS = {":", ",", "}", "]"}
+VALID_ESCAPE_CHARS = {"\"", "\\", "/", "b", "f", "n", "r", "t", "u"}
+CONTROL_CHAR_ESCAPES = {"\b": "\\b", "\f": "\\f", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+BARE_TOKEN = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null")
+# the characters inside a string that need more than a copy
+STRING_SPECIAL_CHAR = re.compile(r"[\"'\\\x00-\x1f]")
+# the opening fence of a markdown code block, and everything that can still become one
+CODE_FENCE = re.compile(r"```[A-Za-z]*")
+PARTIAL_CODE_FENCE = re.compile(r"`{0,3}|```[A-Za-z]*")
+DEFAULT_MAX_TRAILING_CHARS = 64
 
 
-def escape_char(char):
-    if char in ESCAPE_CHARACTERS:
-        result = '\\' + ESCAPE_CHARACTERS[char]
-    elif char < '\x7f':
-        result = char
+def escape_string_char(char):
+    if char in CONTROL_CHAR_ESCAPES:
+        result = CONTROL_CHAR_ESCAPES[char]
+    elif char < " ":
+        result = f"\\u{ord(char):04x}"
     else:
-        result = f'\\u{ord(char):04x}'
+        result = char
     return result
 
 
-POST_DOUBLE_QUOTE_CHARS = { ":": ":", ",": ",", "}": "}" }
+"""
+  JsonyStreamParser turns jsony, the JSON models write, into JSON as it streams in.  It is fed the response a chunk at
+  a time and makes the repairs jsony_to_json makes: single quoted strings become double quoted, a double quote inside
+  a string is escaped unless JSON structure follows it, and raw newlines and other control characters in strings are
+  escaped.  Python's True, False and None become JSON literals.  A quote that might close a string is held until the
+  next non-whitespace character arrives, which may be in a later chunk, so the output never has to be rewritten.
 
+  When the top level value is an object each field is parsed as soon as its value closes and passed to
+  field_listener, so a step can act on {"winner": 1} while the model is still writing its explanation.  feed returns
+  False as soon as the text can't become JSON: it doesn't start with an object or array, brackets don't match, a bare
+  word isn't a number or literal, a field doesn't parse, or too much text follows the top level value.  Text after
+  the top level value is dropped and so is the opening fence of a markdown code block, so a response wrapped in a code
+  block parses.
+"""
 
-def next_nonwhitespace_char(jsone_string, i):
-    result = None
-    while i < len(jsone_string):
-        current_char = jsone_string[i]
-        if current_char not in [" ", "\t", "\n", "\r"]:
-            result = current_char
-            break
-        i += 1
-    return result
 
+class JsonyStreamParser:
+    def __init__(self, field_listener=None, max_trailing_chars=DEFAULT_MAX_TRAILING_CHARS):
+        self.field_listener = field_listener
+        self.max_trailing_chars = max_trailing_chars
+        self.output_part_list = []
+        self.member_part_list = None  # output of the current top level field, only when the top level is an object
+        self.member_emitted = False
+        self.field_dict = {}
+        self.container_stack = []
+        self.started = False
+        self.prefix_part_list = []
+        self.closed = False
+        self.failed = False
+        self.error_message = None
+        self.trailing_char_count = 0
+        self.last_structure_char = None
+        self.token_part_list = []
+        self.string_quote = None
+        self.string_is_value = False
+        self.in_substring = False
+        self.pending_escape = False
+        self.pending_quote = False
+        self.pending_whitespace_list = []
 
-def copy_double_quoted_string(jsone_string, i, string_builder):
-    string_builder.write(jsone_string[i])
-    i += 1
-    while i < len(jsone_string):
-        current_char = jsone_string[i]
-        if current_char == "\"" and jsone_string[i-1] != "\\":
-            if next_nonwhitespace_char(jsone_string, i+1) in POST_DOUBLE_QUOTE_CHARS:
-                string_builder.write("\"")
-                break
+    def feed(self, chunk):
+        if self.failed or chunk is None:
+            return not self.failed
+        index = 0
+        chunk_length = len(chunk)
+        while index < chunk_length and self.failed is False:
+            if self.closed:
+                if chunk[index] not in JSON_WHITESPACE_CHARS:
+                    self.trailing_char_count += 1
+                    if self.trailing_char_count > self.max_trailing_chars:
+                        self.fail("text after the top level value")
+                index += 1
+            elif self.pending_escape:
+                index = self.handle_escape(chunk, index)
+            elif self.pending_quote:
+                current_char = chunk[index]
+                if current_char in JSON_WHITESPACE_CHARS:
+                    self.pending_whitespace_list.append(current_char)
+                    index += 1
+                else:
+                    self.resolve_pending_quote(current_char)
+            elif self.string_quote is not None:
+                index = self.copy_string(chunk, index)
             else:
-                string_builder.write("\\\"") # escape double quote
+                self.handle_structure_char(chunk[index])
+                index += 1
+        return not self.failed
+
+    # ends the stream, returns the JSON text
+    def finish(self):
+        if self.failed is False:
+            if self.pending_escape:
+                self.pending_escape = False
+                self.write("\\\\")
+            if self.pending_quote:
+                self.resolve_pending_quote(None)
+            self.flush_token()
+        result = self.get_json_text()
+        return result
+
+    def get_json_text(self):
+        result = "".join(self.output_part_list)
+        return result
+
+    def get_value(self):
+        result = json.loads(self.finish())
+        return result
+
+    def get_field_dict(self):
+        return self.field_dict
+
+    def is_valid_so_far(self):
+        return not self.failed
+
+    def is_closed(self):
+        return self.closed
+
+    # the first error is the one that explains the failure
+    def fail(self, error_message):
+        if self.failed is False:
+            self.failed = True
+            self.error_message = error_message
+
+    def write(self, text):
+        self.output_part_list.append(text)
+        if self.member_part_list is not None:
+            self.member_part_list.append(text)
+
+    def copy_string(self, chunk, index):
+        match = STRING_SPECIAL_CHAR.search(chunk, index)
+        if match is None:
+            self.write(chunk[index:])
+            result = len(chunk)
         else:
-            string_builder.write(current_char)
-        i += 1
-    return i
-
-
-def copy_single_quoted_string(jsone_string, i, string_builder):
-    string_builder.write("\"")
-    i += 1
-    while i < len(jsone_string):
-        current_char = jsone_string[i]
-        if current_char == "'" and jsone_string[i-1] != "\\":
-            string_builder.write("\"")
-            break
-        elif current_char == "\\" and len(jsone_string) > i+1 and jsone_string[i+1] == "'": # escaped single quote, single quote doesn't need to be escaped
-            string_builder.write("'")
-            i += 1
+            special_index = match.start()
+            if special_index > index:
+                self.write(chunk[index:special_index])
+            current_char = chunk[special_index]
+            result = special_index + 1
+            if current_char == self.string_quote:
+                self.pending_quote = True
+            elif current_char == "\"":
+                self.write("\\\"")
+            elif current_char == "'":
+                self.write(current_char)
+            elif current_char == "\\":
+                self.pending_escape = True
+            else:
+                self.write(escape_string_char(current_char))
+        return result
+
+    # a valid escape is kept, \' doesn't need one in JSON, any other backslash is escaped
+    def handle_escape(self, chunk, index):
+        self.pending_escape = False
+        current_char = chunk[index]
+        if current_char in VALID_ESCAPE_CHARS:
+            self.write("\\" + current_char)
+            result = index + 1
+        elif current_char == "'":
+            self.write(current_char)
+            result = index + 1
         else:
-            string_builder.write(escape_char(current_char))
-        i += 1
-    return i
+            self.write("\\\\")
+            result = index
+        return result
+
+    # A quote only closes the string when JSON structure follows it.  In a double quoted string an inner quote that
+    # opened a quoted phrase is always taken to be closed by the next one.
+    def resolve_pending_quote(self, next_char):
+        self.pending_quote = False
+        whitespace_list = self.pending_whitespace_list
+        self.pending_whitespace_list = []
+        in_substring = self.in_substring and self.string_quote == "\""
+        if in_substring is False and (next_char is None or next_char in POST_QUOTE_CHARS):
+            self.write("\"")
+            self.string_quote = None
+            self.last_structure_char = "\""
+            if self.string_is_value:
+                self.value_done()
+            self.write("".join(whitespace_list))
+        else:
+            if self.string_quote == "\"":
+                self.in_substring = not self.in_substring
+                self.write("\\\"")
+            else:
+                self.write("'")
+            for whitespace_char in whitespace_list:
+                self.write(escape_string_char(whitespace_char))
+
+    def handle_structure_char(self, current_char):
+        if current_char in JSON_WHITESPACE_CHARS:
+            self.flush_token()
+            if self.started:
+                self.write(current_char)
+        elif self.started is False:
+            prefix = "".join(self.prefix_part_list)
+            if (current_char == "{" or current_char == "[") and (prefix == "" or CODE_FENCE.fullmatch(prefix)):
+                self.started = True
+                self.open_container(current_char)
+            elif PARTIAL_CODE_FENCE.fullmatch(prefix + current_char):
+                self.prefix_part_list.append(current_char)
+            else:
+                self.fail("response doesn't start with an object or array")
+        elif current_char == "\"" or current_char == "'":
+            self.flush_token()
+            self.string_quote = current_char
+            self.string_is_value = self.last_structure_char == ":"
+            self.in_substring = False
+            self.write("\"")
+        elif current_char == "{" or current_char == "[":
+            self.flush_token()
+            self.open_container(current_char)
+        elif current_char == "}" or current_char == "]":
+            self.flush_token()
+            self.close_container(current_char)
+        elif current_char == "," or current_char == ":":
+            self.flush_token()
+            # only the fields of a top level object are emitted, the items of a top level array aren't
+            if len(self.container_stack) == 1 and self.container_stack[0] == "{" and current_char == ",":
+                self.emit_member()
+                self.write(current_char)
+                self.start_member()
+            else:
+                self.write(current_char)
+            self.last_structure_char = current_char
+        else:
+            self.token_part_list.append(current_char)
+
+    def open_container(self, current_char):
+        self.container_stack.append(current_char)
+        self.write(current_char)
+        self.last_structure_char = current_char
+        if len(self.container_stack) == 1 and current_char == "{":
+            self.start_member()
+
+    def close_container(self, current_char):
+        open_char = "{" if current_char == "}" else "["
+        if len(self.container_stack) == 0 or self.container_stack[-1] != open_char:
+            self.fail("unmatched " + current_char)
+        else:
+            if len(self.container_stack) == 1:
+                self.emit_member()
+                self.member_part_list = None
+            self.container_stack.pop()
+            self.write(current_char)
+            self.last_structure_char = current_char
+            if len(self.container_stack) == 0:
+                self.closed = True
+            else:
+                self.value_done()
+
+    def flush_token(self):
+        if len(self.token_part_list) > 0:
+            token = "".join(self.token_part_list)
+            self.token_part_list = []
+            token = PYTHON_LITERALS.get(token, token)
+            if BARE_TOKEN.fullmatch(token) is None:
+                self.fail("not a JSON value: " + token)
+            else:
+                self.write(token)
+                self.last_structure_char = token[-1]
+                self.value_done()
+
+    def start_member(self):
+        self.member_part_list = []
+        self.member_emitted = False
+
+    # a value just closed, when it belongs to a top level field the field is complete
+    def value_done(self):
+        if len(self.container_stack) == 1 and self.member_part_list is not None:
+            self.emit_member()
+
+    def emit_member(self):
+        if self.member_part_list is not None and self.member_emitted is False:
+            member_text = "".join(self.member_part_list).strip()
+            if len(member_text) > 0:
+                self.member_emitted = True
+                try:
+                    member_dict = json.loads("{" + member_text + "}")
+                except ValueError:
+                    member_dict = None
+                    self.fail("field doesn't parse: " + member_text)
+                if member_dict is not None:
+                    for key, value in member_dict.items():
+                        self.field_dict[key] = value
+                        if self.field_listener is not None:
+                            self.field_listener(key, value)
 
 
 def jsony_to_json(jsony_string):
     if jsony_string is None:
         return None
-    result = jsony_string
-    with io.StringIO() as string_builder:
-        current_char = None
-        last_char = None
-        max_index = len(jsony_string)
-        i = 0
-        while i < max_index:
-            current_char = jsony_string[i]
-            if current_char == "\"" and last_char != "\\":
-                i = copy_double_quoted_string(jsony_string, i, string_builder)
-            elif current_char == "'":
-                i = copy_single_quoted_string(jsony_string, i, string_builder)
-            else:
-                string_builder.write(current_char)
-            last_char = jsony_string[i]  # i could have been modified, so last char if different than current char
-            i += 1
-        result = string_builder.getvalue()
+    parser = JsonyStreamParser()
+    parser.feed(jsony_string)
+    result = parser.finish()
     return result
 
 
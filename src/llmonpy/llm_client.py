@@ -14,8 +14,15 @@
 #   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import asyncio
 import concurrent
+import contextvars
 import copy
+import datetime
+import functools
+import hashlib
+import importlib
+import importlib.util
 import json
 import os
 import threading
@@ -23,43 +30,56 @@ import time
 import uuid
 from queue import Queue, Empty
 
-import anthropic
-from ai21 import AI21Client
-from ai21.models.chat import SystemMessage, UserMessage
-from fireworks.client import Fireworks
-from fireworks.client.error import RateLimitError
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from groq import Groq
-from mistralai import Mistral
-from openai import OpenAI
-import google.generativeai as genai
-from together import Together
-
-from llmonpy.llmonpy_util import fix_common_json_encoding_errors
+from llmonpy.llmonpy_api_keys import ApiKey, ApiKeyPool, ApiKeyShard, CURRENT_API_KEY_SHARD, parse_api_key_list
+from llmonpy.llmonpy_cache import llmonpy_response_cache
+from llmonpy.llmonpy_circuit_breaker import CircuitBreaker, CircuitBreakerPolicy
+from llmonpy.llmonpy_deadline import DEFAULT_CALL_TIMEOUT, remaining_call_time, run_before_deadline, \
+    arun_before_deadline, get_call_deadline, remaining_time, LLMonPyDeadlineExceededException
+from llmonpy.llmonpy_histogram import LatencyHistogram, RollingThroughput
+from llmonpy.llmonpy_hedge import HedgePolicy, LatencyTracker, default_hedge_policy, run_hedged
+from llmonpy.llmonpy_http import HttpPoolSettings, make_http_client, make_async_http_client, prewarm_http_client, \
+    shared_endpoint_clients, http_pool_settings, set_http_pool_settings
+from llmonpy.llmonpy_routing import ClientHealth, LlmClientGroup, add_llm_client_group, get_llm_client_group
+from llmonpy.llmonpy_retry import RetryPolicy, RetryAttempt, default_retry_policy, classify_exception, \
+    ERROR_CLASS_JSON_FORMAT, RATE_LIMIT_STATUS_CODE
+from llmonpy.llmonpy_scheduler import llmonpy_scheduler, SchedulerLane
+from llmonpy.llmonpy_token_limiter import TokenRateLimiter, TokenReservation, estimate_token_count, \
+    DEFAULT_OUTPUT_RESERVATION
+from llmonpy.jsony import JsonyStreamParser
+from llmonpy.llmonpy_schema import OutputSchema, get_output_schema, output_format_key
+from llmonpy.llmonpy_util import parse_json_response
 from ratellmiter.rate_llmiter import RateLimitedService, BucketRateLimiter, RateLlmiterMonitor, SecondTicketBucketListener, \
     LlmClientRateLimitException, llmiter, SecondTicketBucket
 from llmonpy.system_services import add_service_to_stop
 
-PROMPT_RETRIES = 5
-BASE_RETRY_DELAY = 30  # seconds
-DEFAULT_THREAD_POOL_SIZE = 200
+TICKET_THREAD_POOL_SIZE = 32
 TOKEN_UNIT_FOR_COST = 1000000
 
 LLMONPY_API_PREFIX = "LLMONPY_"
 
-MISTRAL_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-ANTHROPIC_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-OPENAI_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-DEEPSEEK_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-GEMINI_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-FIREWORKS_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-TOMBU_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-AI21_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
-GROQ_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE)
+# provider names are the keys the scheduler uses for per provider concurrency limits
+MISTRAL_PROVIDER = "MISTRAL"
+ANTHROPIC_PROVIDER = "ANTHROPIC"
+OPENAI_PROVIDER = "OPENAI"
+DEEPSEEK_PROVIDER = "DEEPSEEK"
+GEMINI_PROVIDER = "GEMINI"
+FIREWORKS_PROVIDER = "FIREWORKS"
+TOMBU_PROVIDER = "TOMBU_FIREWORKS"
+AI21_PROVIDER = "AI21"
+GROQ_PROVIDER = "GROQ"
+# aprompt only borrows a thread while it waits for a ratellmiter ticket, the request itself runs on the event loop
+TICKET_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=TICKET_THREAD_POOL_SIZE)
 MISTRAL_RATE_LIMITER = BucketRateLimiter(180, "MISTRAL")
 FIREWORKS_RATE_LIMITER = BucketRateLimiter(300, "FIREWORKS")
 TOMBU_RATE_LIMITER = BucketRateLimiter(1200, "TOMBU_FIREWORKS")
 AI21_RATE_LIMITER = BucketRateLimiter(60,  "AI21")
+# tokens per minute, shared by every model of the provider.  Match these to the account's tier.
+MISTRAL_TOKEN_RATE_LIMITER = TokenRateLimiter(2000000, "MISTRAL")
+FIREWORKS_TOKEN_RATE_LIMITER = TokenRateLimiter(1000000, "FIREWORKS")
+PROVIDER_TOKEN_RATE_LIMITER_DICT = {
+    MISTRAL_PROVIDER: MISTRAL_TOKEN_RATE_LIMITER,
+    FIREWORKS_PROVIDER: FIREWORKS_TOKEN_RATE_LIMITER
+}
 
 
 class LLMonPyNoKeyForApiException(Exception):
@@ -68,6 +88,12 @@ class LLMonPyNoKeyForApiException(Exception):
         self.api_key_name = api_key_name
 
 
+class LLMonPyMissingSdkException(Exception):
+    def __init__(self, sdk_module_name):
+        super().__init__("SDK not installed: " + sdk_module_name)
+        self.sdk_module_name = sdk_module_name
+
+
 class TenacityRateLimitError(Exception):
     def __init__(self):
         super().__init__("Rate limit exceeded")
@@ -84,9 +110,40 @@ def get_api_key(api_key_name, exit_on_error=True):
     return key
 
 
-def backoff_after_exception(attempt):
-    delay_time = (attempt + 1) * BASE_RETRY_DELAY
-    time.sleep(delay_time)
+# the key variable can hold several keys, "key1,key2:org-id", each one sharded with its own requests_per_minute
+def get_api_key_list(api_key_name, requests_per_minute) -> [ApiKey]:
+    result = parse_api_key_list(get_api_key(api_key_name), requests_per_minute)
+    return result
+
+
+# Provider SDKs are slow to import, so each one is imported the first time a client that needs it starts
+SDK_MODULE_DICT = {}
+SDK_IMPORT_LOCK = threading.Lock()
+
+
+def import_sdk(module_name):
+    result = SDK_MODULE_DICT.get(module_name, None)
+    if result is None:
+        with SDK_IMPORT_LOCK:
+            result = SDK_MODULE_DICT.get(module_name, None)
+            if result is None:
+                result = importlib.import_module(module_name)
+                SDK_MODULE_DICT[module_name] = result
+    return result
+
+
+def is_sdk_installed(module_name):
+    try:
+        result = importlib.util.find_spec(module_name) is not None
+    except ModuleNotFoundError:
+        result = False
+    return result
+
+
+def is_rate_limit_exception(exception):
+    result = (isinstance(exception, LlmClientRateLimitException) or
+              getattr(exception, "status_code", None) == RATE_LIMIT_STATUS_CODE)
+    return result
 
 
 PROMPT_STATE_WAITING_FOR_TICKET = 1
@@ -107,6 +164,9 @@ class LLMClientPromptStatus:
         self.state = PROMPT_STATE_DONE
 
 
+THROUGHPUT_RATE_SECONDS = 60
+
+
 class LLMClientStatus:
     def __init__(self, client_name: str):
         self.client_name = client_name
@@ -117,10 +177,19 @@ class LLMClientStatus:
         self.exception_count = 0
         self.rate_limit_count = 0
         self.slowest_prompt = 0
+        self.throughput_per_second = 0.0  # completions per second over the last THROUGHPUT_RATE_SECONDS
+        self.total_cost = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.ticket_wait_histogram = LatencyHistogram()
+        self.service_time_histogram = LatencyHistogram()
+        self.total_time_histogram = LatencyHistogram()
+        self.throughput = RollingThroughput()
 
     def calculate_all(self, current_time):
         self.in_flight_count = len(self.in_flight_prompt_dict)
         self.calculate_slowest_prompt(current_time)
+        self.throughput_per_second = self.throughput.get_rate(THROUGHPUT_RATE_SECONDS, current_time)
 
     def calculate_slowest_prompt(self, current_time):
         slowest = 0
@@ -130,9 +199,50 @@ class LLMClientStatus:
                 slowest = prompt_time
         self.slowest_prompt = slowest
 
+    def record_usage(self, input_tokens, output_tokens, cost):
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.total_cost += cost
+
+    def record_timing(self, ticket_wait, service_time):
+        self.ticket_wait_histogram.record(ticket_wait)
+        self.service_time_histogram.record(service_time)
+        self.total_time_histogram.record(ticket_wait + service_time)
+
+    # Copies the counters and histograms but not the in flight prompts or the throughput ring, cheap enough to take
+    # under the status lock.
+    def snapshot(self, current_time):
+        self.calculate_all(current_time)
+        result = copy.copy(self)
+        result.in_flight_prompt_dict = {}
+        result.throughput = None
+        result.ticket_wait_histogram = self.ticket_wait_histogram.copy()
+        result.service_time_histogram = self.service_time_histogram.copy()
+        result.total_time_histogram = self.total_time_histogram.copy()
+        return result
+
+    def add(self, other):
+        self.slowest_prompt = max(self.slowest_prompt, other.slowest_prompt)
+        self.in_flight_count += other.in_flight_count
+        self.waiting_for_ticket += other.waiting_for_ticket
+        self.completed_prompt_count += other.completed_prompt_count
+        self.exception_count += other.exception_count
+        self.rate_limit_count += other.rate_limit_count
+        self.throughput_per_second += other.throughput_per_second
+        self.total_cost += other.total_cost
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.ticket_wait_histogram.merge(other.ticket_wait_histogram)
+        self.service_time_histogram.merge(other.service_time_histogram)
+        self.total_time_histogram.merge(other.total_time_histogram)
+
     def to_dict(self):
         result = copy.copy(vars(self))
         del result["in_flight_prompt_dict"]
+        del result["throughput"]
+        result["ticket_wait_histogram"] = self.ticket_wait_histogram.to_dict()
+        result["service_time_histogram"] = self.service_time_histogram.to_dict()
+        result["total_time_histogram"] = self.total_time_histogram.to_dict()
         return result
 
 
@@ -149,7 +259,7 @@ class LLMClientStatusService (SecondTicketBucketListener):
         self.client_status_dict = {}
         self.status_lock = threading.Lock()
         self.timer = threading.Timer(interval=LLMClientStatusService.REPORT_INTERVAL, function=self.report_status)
-        self.completion_time_list: [float] = []
+        self.throughput = RollingThroughput()
         self.log_directory = log_directory
         self.running = False
 
@@ -168,24 +278,11 @@ class LLMClientStatusService (SecondTicketBucketListener):
         if self.log_directory is not None:
             self.write_completion_times()
 
+    # completions per second for the last DEFAULT_THROUGHPUT_WINDOW seconds of the run
     def write_completion_times(self):
-        if len(self.completion_time_list) > 0:
-            second_offset_list = []
-            first_time = self.completion_time_list[0]
-            for time_in_seconds in self.completion_time_list:
-                second_index = int(time_in_seconds - first_time)
-                second_offset_list.append(second_index)
-            max_offset = second_offset_list[len(second_offset_list) - 1]
-            second_count_dict = {}
-            for second in second_offset_list:
-                if second not in second_count_dict:
-                    second_count_dict[second] = 1
-                else:
-                    second_count_dict[second] += 1
-            second_count_list = []
-            for i in range(max_offset):
-                count = second_count_dict.get(i, 0)
-                second_count_list.append(count)
+        with self.status_lock:
+            second_count_list = self.throughput.get_second_counts()
+        if len(second_count_list) > 0:
             csv_string = ",".join([str(x) for x in second_count_list])
             with open(self.log_directory + "/second_request_counts.csv", "w") as file:
                 file.write(csv_string)
@@ -203,17 +300,21 @@ class LLMClientStatusService (SecondTicketBucketListener):
             for request in rate_exception_list:
                 self.unsafe_rate_limit_exceeded(request.user_request_id, request.model_name)
             for request in finished_request_list:
-                self.unsafe_prompt_done(request.user_request_id, request.model_name)
-                self.completion_time_list.append(request.finished_second_bucket_id)
+                self.unsafe_prompt_done(request.user_request_id, request.model_name, request.finished_second_bucket_id)
 
     def start_prompt(self, prompt_id, client_name):
         with self.status_lock:
             self.unsafe_start_prompt(prompt_id, client_name)
 
+    def unsafe_get_client_status(self, client_name) -> LLMClientStatus:
+        result = self.client_status_dict.get(client_name, None)
+        if result is None:
+            result = LLMClientStatus(client_name)
+            self.client_status_dict[client_name] = result
+        return result
+
     def unsafe_start_prompt(self, prompt_id, client_name):
-        if client_name not in self.client_status_dict:
-            self.client_status_dict[client_name] = LLMClientStatus(client_name)
-        client_status = self.client_status_dict[client_name]
+        client_status = self.unsafe_get_client_status(client_name)
         client_status.waiting_for_ticket += 1
         prompt_status = LLMClientPromptStatus(prompt_id, client_name)
         client_status.in_flight_prompt_dict[prompt_id] = prompt_status
@@ -243,17 +344,27 @@ class LLMClientStatusService (SecondTicketBucketListener):
     def prompt_done(self, prompt_id, client_name):
         current_time = time.time()
         with self.status_lock:
-            self.unsafe_prompt_done(prompt_id, client_name)
-            self.completion_time_list.append(current_time)
+            self.unsafe_prompt_done(prompt_id, client_name, current_time)
 
-    def unsafe_prompt_done(self, prompt_id, client_name):
+    def unsafe_prompt_done(self, prompt_id, client_name, done_time):
         client_status = self.client_status_dict[client_name]
         client_status.completed_prompt_count += 1
+        client_status.throughput.record(done_time)
+        self.throughput.record(done_time)
         del client_status.in_flight_prompt_dict[prompt_id]
 
+    # ticket_wait is the time waiting for a ratellmiter ticket and token room, service_time the provider call
+    def record_prompt_timing(self, client_name, ticket_wait, service_time):
+        with self.status_lock:
+            self.unsafe_get_client_status(client_name).record_timing(ticket_wait, service_time)
+
+    def record_prompt_usage(self, client_name, input_tokens, output_tokens, cost):
+        with self.status_lock:
+            self.unsafe_get_client_status(client_name).record_usage(input_tokens, output_tokens, cost)
+
     def prompt_failed(self, prompt_id, client_name):
         with self.status_lock:
-            self.prompt_failed(prompt_id, client_name)
+            self.unsafe_prompt_failed(prompt_id, client_name)
 
     def unsafe_prompt_failed(self, prompt_id, client_name):
         client_status = self.client_status_dict[client_name]
@@ -262,25 +373,16 @@ class LLMClientStatusService (SecondTicketBucketListener):
         del client_status.in_flight_prompt_dict[prompt_id]
 
     def copy_status(self):
+        current_time = time.time()
         with self.status_lock:
-            result = copy.deepcopy(self.client_status_dict)
+            result = [client_status.snapshot(current_time) for client_status in self.client_status_dict.values()]
         return result
 
     def get_all_status(self):
-        frozen_status_dict = self.copy_status()
-        client_status_list = []
+        client_status_list = self.copy_status()
         all_status = LLMClientStatus("All")
-        current_time = time.time()
-        for client_status in frozen_status_dict.values():
-            client_status.calculate_all(current_time)
-            if client_status.slowest_prompt > all_status.slowest_prompt:
-                all_status.slowest_prompt = client_status.slowest_prompt
-            client_status_list.append(client_status)
-            all_status.in_flight_count += client_status.in_flight_count
-            all_status.waiting_for_ticket += client_status.waiting_for_ticket
-            all_status.completed_prompt_count += client_status.completed_prompt_count
-            all_status.exception_count += client_status.exception_count
-            all_status.rate_limit_count += client_status.rate_limit_count
+        for client_status in client_status_list:
+            all_status.add(client_status)
         client_status_list.sort(key=lambda x: x.client_name)
         result = [all_status]
         result.extend(client_status_list)
@@ -294,14 +396,21 @@ class LLMClientStatusService (SecondTicketBucketListener):
         rate_exceptions = current_status.rate_limit_count
         completed = current_status.completed_prompt_count
         slowest = current_status.slowest_prompt
-        print(f"\n{current_status.client_name} in_flight:{in_flight} waiting_for_ticket:{waiting} completed:{completed} rate_exceptions:{rate_exceptions} slowest:{slowest:.3f}\n")
+        scheduler = llmonpy_scheduler()
+        queued = scheduler.get_queue_depth() if scheduler is not None else 0
+        throughput = current_status.throughput_per_second
+        print(f"\n{current_status.client_name} in_flight:{in_flight} waiting_for_ticket:{waiting} completed:{completed} rate_exceptions:{rate_exceptions} slowest:{slowest:.3f} queued:{queued} per_second:{throughput:.1f}\n")
         for client_status in all_status_list[1:]:
             in_flight = client_status.in_flight_count
             waiting = client_status.waiting_for_ticket
             rate_exceptions = client_status.rate_limit_count
             completed = client_status.completed_prompt_count
             slowest = client_status.slowest_prompt
-            print(f"{client_status.client_name} in_flight:{in_flight} waiting_for_ticket:{waiting} completed:{completed} rate_exceptions:{rate_exceptions} slowest:{slowest:.3f}")
+            total_time = client_status.total_time_histogram
+            p50 = total_time.get_percentile(0.50)
+            p95 = total_time.get_percentile(0.95)
+            p99 = total_time.get_percentile(0.99)
+            print(f"{client_status.client_name} in_flight:{in_flight} waiting_for_ticket:{waiting} completed:{completed} rate_exceptions:{rate_exceptions} slowest:{slowest:.3f} p50:{p50:.3f} p95:{p95:.3f} p99:{p99:.3f}")
         self.start_timer()
 
     @staticmethod
@@ -315,23 +424,387 @@ def llm_client_prompt_status_service() -> LLMClientStatusService:
 
 
 class LlmClientJSONFormatException(Exception):
-    def __init__(self, raw_text):
-        super().__init__("JSON parsing error " + raw_text)
+    def __init__(self, raw_text, output_tokens=None):
+        super().__init__("JSON parsing error " + str(raw_text))
+        self.raw_text = raw_text
+        self.output_tokens = output_tokens
         self.status_code = 500
+        self.error_class = ERROR_CLASS_JSON_FORMAT
+
+    # a response that used all of max_output was most likely cut off, not badly formed
+    def is_cut_off(self, max_output):
+        result = max_output is not None and self.output_tokens is not None and self.output_tokens >= max_output
+        return result
+
+
+"""
+  OutputLimit is the max_output of one logical prompt across its attempts.  A JSON response that doesn't parse or
+  validate after using the whole limit was cut off, sending it again with the same limit would fail the same way,
+  so the limit is doubled for the next attempt.
+"""
+
+
+class OutputLimit:
+    def __init__(self, max_output):
+        self.max_output = max_output
+
+    def record_failure(self, exception):
+        if isinstance(exception, LlmClientJSONFormatException) and exception.is_cut_off(self.max_output):
+            self.max_output *= 2
+
+    def run(self, attempt_function):
+        try:
+            result = attempt_function(self.max_output)
+        except Exception as e:
+            self.record_failure(e)
+            raise e
+        return result
+
+    async def arun(self, coroutine_function):
+        try:
+            result = await coroutine_function(self.max_output)
+        except Exception as e:
+            self.record_failure(e)
+            raise e
+        return result
 
 
 class LlmClientResponse:
-    def __init__(self, response_text, response_dict=None, input_cost=0.0, output_cost=0.0):
+    def __init__(self, response_text, response_dict=None, input_cost=0.0, output_cost=0.0, from_cache=False,
+                 coalesced=False, time_to_first_token=None, tokens_per_second=None, input_tokens=0, output_tokens=0,
+                 hedged_by=None, cached_input_tokens=0, cache_write_tokens=0, sample_text_list=None):
         self.response_text = response_text
         self.response_dict = response_dict
         self.input_cost = input_cost
         self.output_cost = output_cost
-
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        # both are part of input_tokens, priced at the provider's cache read and cache write rates
+        self.cached_input_tokens = cached_input_tokens
+        self.cache_write_tokens = cache_write_tokens
+        self.from_cache = from_cache
+        self.coalesced = coalesced
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        # model name of the hedge request when it answered first
+        self.hedged_by = hedged_by
+        # every choice of a call that asked for several samples, usage and costs are for the whole call
+        self.sample_text_list = sample_text_list
+
+    # a cached or coalesced response keeps the costs of the original call, but nothing was spent to get it this time
     def get_response_cost(self):
-        result = self.input_cost + self.output_cost
+        result = 0.0 if self.from_cache or self.coalesced else self.input_cost + self.output_cost
+        return result
+
+    def make_coalesced_copy(self):
+        result = copy.deepcopy(self)
+        result.coalesced = True
+        return result
+
+    def to_dict(self):
+        result = copy.deepcopy(vars(self))
+        del result["from_cache"]
+        del result["coalesced"]
+        del result["time_to_first_token"]
+        del result["tokens_per_second"]
+        del result["hedged_by"]
+        del result["sample_text_list"]
+        return result
+
+    @staticmethod
+    def from_dict(dictionary, from_cache=False):
+        result = LlmClientResponse(**dictionary, from_cache=from_cache)
+        return result
+
+
+class StreamState:
+    def __init__(self):
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.end_time = None
+        self.delta_list = []
+        self.input_tokens = None
+        self.output_tokens = None
+        self.cached_input_tokens = 0
+        self.cache_write_tokens = 0
+        self.json_parser: JsonyStreamParser = None
+
+    def add_delta(self, delta):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        self.delta_list.append(delta)
+
+    # providers report usage on different chunks, so either count can arrive alone
+    def set_usage(self, input_tokens=None, output_tokens=None, cached_input_tokens=None, cache_write_tokens=None):
+        if input_tokens is not None:
+            self.input_tokens = input_tokens
+        if output_tokens is not None:
+            self.output_tokens = output_tokens
+        if cached_input_tokens is not None:
+            self.cached_input_tokens = cached_input_tokens
+        if cache_write_tokens is not None:
+            self.cache_write_tokens = cache_write_tokens
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def get_text(self):
+        result = "".join(self.delta_list)
+        return result
+
+    # the repaired JSON when the response was parsed as it streamed
+    def get_json_text(self):
+        result = self.json_parser.finish() if self.json_parser is not None else self.get_text()
+        return result
+
+    def get_input_tokens(self, prompt_text):
+        result = self.input_tokens if self.input_tokens is not None else estimate_token_count(prompt_text)
+        return result
+
+    def get_output_tokens(self):
+        result = self.output_tokens if self.output_tokens is not None else estimate_token_count(self.get_text())
+        return result
+
+    def get_time_to_first_token(self):
+        result = None
+        if self.first_token_time is not None:
+            result = self.first_token_time - self.start_time
+        return result
+
+    def get_tokens_per_second(self):
+        result = None
+        if self.first_token_time is not None and self.end_time is not None and self.end_time > self.first_token_time:
+            result = self.get_output_tokens() / (self.end_time - self.first_token_time)
+        return result
+
+
+def close_stream(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception as e:
+            print("Error closing stream: " + str(e))
+
+
+# OpenAI reports prompt cache hits in prompt_tokens_details, Deepseek in prompt_cache_hit_tokens
+def get_cached_input_tokens(usage):
+    result = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    if result is None:
+        result = getattr(usage, "prompt_cache_hit_tokens", None)
+    result = result if result is not None else 0
+    return result
+
+
+# The response_format of OpenAI style chat APIs.  An OutputSchema becomes a json_schema format, strict when the
+# schema allows it, so the provider constrains the output to the schema.
+def chat_response_format(json_output, json_schema_supported=True):
+    output_schema = get_output_schema(json_output)
+    if output_schema is not None and json_schema_supported:
+        result = {"type": "json_schema",
+                  "json_schema": {"name": output_schema.get_name(), "schema": output_schema.get_schema(),
+                                  "strict": output_schema.strict}}
+    else:
+        result = {"type": "json_object" if json_output else "text"}
+    return result
+
+
+# Anthropic has no JSON mode, a schema for an object is sent as the one tool the model has to call
+def anthropic_tool_schema(json_output) -> OutputSchema:
+    output_schema = get_output_schema(json_output)
+    result = output_schema if output_schema is not None and output_schema.is_object_schema() else None
+    return result
+
+
+# OpenAI style chat streams, the usage arrives on the last chunk when the provider reports it
+def chat_completion_stream_deltas(stream, stream_state: StreamState):
+    try:
+        for chunk in stream:
+            usage = getattr(chunk, "usage", None)
+            if usage is None:
+                usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if usage is not None:
+                stream_state.set_usage(usage.prompt_tokens, usage.completion_tokens,
+                                       cached_input_tokens=get_cached_input_tokens(usage))
+            choice_list = getattr(chunk, "choices", None)
+            if choice_list is not None and len(choice_list) > 0 and choice_list[0].delta is not None:
+                delta = choice_list[0].delta.content
+                if delta:
+                    yield delta
+    finally:
+        close_stream(stream)
+
+
+"""
+  PrefixedPrompt is prompt text that starts with a static prefix, the part of a prompt that is the same across many
+  calls such as instructions and examples.  It is a str, so every client can send it as is, and clients with prompt
+  caching can send the prefix as a cacheable block.
+"""
+
+
+class PrefixedPrompt(str):
+    def __new__(cls, prefix_text, prompt_text):
+        result = super().__new__(cls, prefix_text + prompt_text)
+        result.prefix_length = len(prefix_text)
+        return result
+
+    def __getnewargs__(self):
+        return self.get_prefix(), self.get_suffix()
+
+    def get_prefix(self):
+        result = str(self)[:self.prefix_length]
+        return result
+
+    def get_suffix(self):
+        result = str(self)[self.prefix_length:]
+        return result
+
+
+# returns (prefix, rest), the prefix is None for plain prompt text
+def split_prompt_prefix(prompt_text):
+    if isinstance(prompt_text, PrefixedPrompt) and prompt_text.prefix_length > 0:
+        result = prompt_text.get_prefix(), prompt_text.get_suffix()
+    else:
+        result = None, prompt_text
+    return result
+
+
+# temp 0 is treated as deterministic, any other temp needs an explicit sample index to be reused
+def is_cacheable_request(temp, sample_index=None):
+    result = temp == 0.0 or sample_index is not None
+    return result
+
+
+"""
+  SingleFlightTable lets identical requests that are issued while the first one is still running share its result
+  instead of each taking a ratellmiter ticket.  The first caller runs the request, later callers wait on its future
+  and get a coalesced copy of the response.  Only requests that could be cached are coalesced, so two samples at
+  temp > 0 are never merged.  A follower only waits until its own deadline and its attempt_listener gets one
+  RetryAttempt for the wait.  Only what the provider did is shared, when the leader fails on its own deadline or
+  its own response_validator the follower runs the request itself.
+"""
+
+
+# the leader's deadline and validator aren't the follower's, so these errors say nothing about the follower's request
+def is_leader_only_exception(exception):
+    result = isinstance(exception, (LLMonPyDeadlineExceededException, LlmClientJSONFormatException))
+    return result
+
+
+class SingleFlightTable:
+    def __init__(self):
+        self.table_lock = threading.Lock()
+        self.in_flight_dict = {}
+        self.coalesced_count = 0
+
+    def join_or_lead(self, request_key):
+        with self.table_lock:
+            future = self.in_flight_dict.get(request_key, None)
+            is_leader = future is None
+            if is_leader:
+                future = concurrent.futures.Future()
+                self.in_flight_dict[request_key] = future
+            else:
+                self.coalesced_count += 1
+        return future, is_leader
+
+    def finish(self, request_key, future, result=None, exception=None):
+        with self.table_lock:
+            del self.in_flight_dict[request_key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def notify_follower(self, attempt_listener, start_time, exception=None):
+        if attempt_listener is not None:
+            error_class = classify_exception(exception) if exception is not None else None
+            error_message = str(exception) if exception is not None else None
+            attempt = RetryAttempt(1, start_time, time.time() - start_time, error_class, error_message)
+            try:
+                attempt_listener(attempt)
+            except Exception as e:
+                print("Error recording retry attempt: " + str(e))
+
+    # returns None when the leader failed for its own reasons and the follower has to run the request itself
+    def follow(self, future, deadline=None, attempt_listener=None):
+        start_time = time.time()
+        try:
+            response = future.result(timeout=remaining_time(deadline))
+        except concurrent.futures.TimeoutError:
+            e = LLMonPyDeadlineExceededException(deadline, "Coalesced prompt")
+            self.notify_follower(attempt_listener, start_time, e)
+            raise e
+        except Exception as e:
+            self.notify_follower(attempt_listener, start_time, e)
+            if is_leader_only_exception(e):
+                return None
+            raise e
+        self.notify_follower(attempt_listener, start_time)
+        result = response.make_coalesced_copy()
+        return result
+
+    async def afollow(self, future, deadline=None, attempt_listener=None):
+        start_time = time.time()
+        try:
+            # shield keeps a follower that gives up from cancelling the leader's future
+            response = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), remaining_time(deadline))
+        except asyncio.TimeoutError:
+            e = LLMonPyDeadlineExceededException(deadline, "Coalesced prompt")
+            self.notify_follower(attempt_listener, start_time, e)
+            raise e
+        except Exception as e:
+            self.notify_follower(attempt_listener, start_time, e)
+            if is_leader_only_exception(e):
+                return None
+            raise e
+        self.notify_follower(attempt_listener, start_time)
+        result = response.make_coalesced_copy()
+        return result
+
+    def run(self, request_key, function, deadline=None, attempt_listener=None):
+        if request_key is None:
+            return function()
+        future, is_leader = self.join_or_lead(request_key)
+        if is_leader is False:
+            result = self.follow(future, deadline, attempt_listener)
+            if result is None:
+                result = function()
+        else:
+            try:
+                result = function()
+            except BaseException as e:
+                self.finish(request_key, future, exception=e)
+                raise e
+            self.finish(request_key, future, result=result)
+        return result
+
+    async def arun(self, request_key, coroutine_function, deadline=None, attempt_listener=None):
+        if request_key is None:
+            return await coroutine_function()
+        future, is_leader = self.join_or_lead(request_key)
+        if is_leader is False:
+            result = await self.afollow(future, deadline, attempt_listener)
+            if result is None:
+                result = await coroutine_function()
+        else:
+            try:
+                result = await coroutine_function()
+            except BaseException as e:
+                self.finish(request_key, future, exception=e)
+                raise e
+            self.finish(request_key, future, result=result)
+        return result
+
+    def get_in_flight_count(self):
+        with self.table_lock:
+            result = len(self.in_flight_dict)
         return result
 
 
+IN_FLIGHT_PROMPTS = SingleFlightTable()
+
+
 """
   LllClient is a base class for all language model clients.  It handles rate limit exceptions for all models.  The
   model client should handle JSON parsing errors -- they tend to be model specific.
@@ -340,16 +813,38 @@ class LlmClientResponse:
 
 class LlmClient(RateLimitedService):
     all_client_list = []
-
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
-                 price_per_output_token=0.0):
+    api_key_name = None
+    sdk_module_name = None
+    endpoint_url = None
+    # provider prices for prompt cache reads and writes, as a fraction of the input token price
+    cached_input_price_ratio = 1.0
+    cache_write_price_ratio = 1.0
+    default_call_timeout = DEFAULT_CALL_TIMEOUT
+    # False when the SDK takes its key globally, so a client can only use one
+    multiple_api_keys_supported = True
+    # choices one request can return, clients of providers with an n parameter raise it
+    max_samples_per_call = 1
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
+                 price_per_output_token=0.0, register_client=True):
         self.model_name = model_name
         self.max_input = max_input
         self.rate_limiter = rate_limiter
-        self.thread_pool = thread_pool
+        self.provider_name = provider_name
+        self.retry_policy = None
+        self.token_rate_limiter = None
+        self.hedge_policy = None
+        self.latency_tracker = LatencyTracker()
+        self.health = ClientHealth()
+        self.circuit_breaker = CircuitBreaker(model_name)
+        self.api_key_pool = None
+        self.started = False
+        self.start_lock = threading.Lock()
+        self.http_client = None
         self.price_per_input_token = price_per_input_token
         self.price_per_output_token = price_per_output_token
-        LlmClient.all_client_list.append(self)
+        if register_client:
+            LlmClient.all_client_list.append(self)
         if rate_limiter is not None:
             rate_limiter.set_rate_limited_service(self)
 
@@ -360,41 +855,639 @@ class LlmClient(RateLimitedService):
         # this should init API.
         pass
 
+    # returns (client, async_client, http_client) for api_key, or for the key in the environment when it is None.
+    # http_client is None when the SDK manages its own transport.  SDK clients are built with their own retries off,
+    # so every request sent is an attempt the RetryPolicy counts and records.
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        raise Exception("Not implemented")
+
+    # the first key when the environment holds several, load_api_keys puts the others in the client's ApiKeyPool
+    def resolve_api_key(self, api_key: ApiKey = None) -> ApiKey:
+        result = api_key if api_key is not None else get_api_key_list(self.api_key_name, None)[0]
+        return result
+
+    def get_endpoint_key(self, api_key: ApiKey = None):
+        result = str(self.sdk_module_name) + "|" + str(self.endpoint_url)
+        if api_key is not None:
+            result += "|" + api_key.get_key_id()
+        return result
+
+    # SDK clients take the model as a request argument, so every model on an endpoint shares one set of clients and
+    # one connection pool
+    def start_shared_clients(self):
+        self.client, self.async_client, self.http_client = shared_endpoint_clients().get(self.get_endpoint_key(),
+                                                                                         self.make_sdk_clients)
+
+    # Calls are spread over api_key_list, each key gets its own ratellmiter bucket of its requests_per_minute, or the
+    # client's own rate when it has none, and its own SDK clients, shared with the other models using the key.  See
+    # ApiKeyPool.
+    def set_api_keys(self, api_key_list: [ApiKey]):
+        if self.multiple_api_keys_supported is False:
+            raise ValueError(self.model_name + " can only use one API key")
+        shard_list = []
+        for api_key in api_key_list:
+            requests_per_minute = api_key.requests_per_minute
+            if requests_per_minute is None:
+                requests_per_minute = self.get_requests_per_minute()
+            rate_limiter = BucketRateLimiter(requests_per_minute)
+            rate_limiter.set_rate_limited_service(self)
+            shard_list.append(ApiKeyShard(api_key, rate_limiter))
+        self.api_key_pool = ApiKeyPool(self.model_name, shard_list)
+
+    # A key variable that holds several keys puts the client on an ApiKeyPool of them.  A client that can only use
+    # one key raises ValueError instead of quietly using the first.
+    def load_api_keys(self):
+        if self.api_key_pool is None and self.api_key_name is not None:
+            key_list_text = get_api_key(self.api_key_name, exit_on_error=False)
+            if key_list_text is not None:
+                api_key_list = parse_api_key_list(key_list_text, None)
+                if len(api_key_list) > 1:
+                    self.set_api_keys(api_key_list)
+
+    def get_requests_per_minute(self):
+        result = self.rate_limiter.request_per_minute if self.rate_limiter is not None else None
+        return result
+
+    def get_api_key_pool(self) -> ApiKeyPool:
+        return self.api_key_pool
+
+    # the key this client's current attempt runs with, None when the client uses one key
+    def get_current_api_key_shard(self) -> ApiKeyShard:
+        result = CURRENT_API_KEY_SHARD.get()
+        if result is not None and (self.api_key_pool is None or result not in self.api_key_pool.get_shard_list()):
+            result = None
+        return result
+
+    def get_sdk_client(self):
+        shard = self.get_current_api_key_shard()
+        result = shard.sdk_clients[0] if shard is not None else self.client
+        return result
+
+    def get_async_sdk_client(self):
+        shard = self.get_current_api_key_shard()
+        result = shard.sdk_clients[1] if shard is not None else self.async_client
+        return result
+
+    def acquire_api_key_shard(self) -> ApiKeyShard:
+        result = self.api_key_pool.acquire()
+        if result.sdk_clients is None:
+            api_key = result.api_key
+            result.sdk_clients = shared_endpoint_clients().get(self.get_endpoint_key(api_key),
+                                                               lambda: self.make_sdk_clients(api_key))
+        return result
+
+    # runs one attempt with a key from the pool, everything in the attempt, ticket included, uses that key
+    def run_with_api_key(self, function):
+        if self.api_key_pool is None:
+            result = function()
+        else:
+            shard = self.acquire_api_key_shard()
+            token = CURRENT_API_KEY_SHARD.set(shard)
+            try:
+                result = function()
+                self.api_key_pool.record_success(shard)
+            finally:
+                CURRENT_API_KEY_SHARD.reset(token)
+                self.api_key_pool.release(shard)
+        return result
+
+    async def arun_with_api_key(self, coroutine_function):
+        if self.api_key_pool is None:
+            result = await coroutine_function()
+        else:
+            shard = self.acquire_api_key_shard()
+            token = CURRENT_API_KEY_SHARD.set(shard)
+            try:
+                result = await coroutine_function()
+                self.api_key_pool.record_success(shard)
+            finally:
+                CURRENT_API_KEY_SHARD.reset(token)
+                self.api_key_pool.release(shard)
+        return result
+
+    # every provider error is seen here, rate limits included, so a key that keeps failing leaves the rotation
+    def record_api_key_error(self, exception):
+        shard = self.get_current_api_key_shard()
+        if shard is not None:
+            self.api_key_pool.record_error(shard, exception)
+
+    # only the sync pool is warmed, an async pool's connections belong to the event loop that opened them
+    def prewarm(self, connection_count):
+        self.ensure_started()
+        if self.http_client is not None and self.endpoint_url is not None:
+            prewarm_http_client(self.http_client, self.endpoint_url, connection_count)
+
+    # checked by init_llm_clients without importing anything, start() runs on first use
+    def check_start_requirements(self):
+        if self.api_key_name is not None:
+            get_api_key(self.api_key_name)
+        if self.sdk_module_name is not None and is_sdk_installed(self.sdk_module_name) is False:
+            raise LLMonPyMissingSdkException(self.sdk_module_name)
+
+    def ensure_started(self):
+        if self.started is False:
+            with self.start_lock:
+                if self.started is False:
+                    self.start()
+                    self.started = True
+
     def get_model_name(self):
         return self.model_name
 
+    # the timeout passed to the SDK: the time left before the attempt's deadline, capped at default_call_timeout
+    def get_call_timeout(self):
+        result = remaining_call_time(self.default_call_timeout)
+        return result
+
+    # ratellmiter asks this after a rate limit.  Nothing is sent to find out, the next real prompt is the test and
+    # goes back to ratellmiter if it is rate limited again.  Only an open circuit keeps the client blocked.
     def ratellmiter_is_llm_blocked(self):
-        result = True
-        print("Testing if blocked")
-        try:
-            response = self.do_prompt("Hello? Respond with 'World'","You are a helpful assistant", False,
-                                      temp=0.0, max_output=10)
-            result = response.response_text is None
-            print("Blocked test response: " + str(result))
-        except Exception as e:
-            print("Blocked test exception: " + str(e))
-            result = True
+        result = self.circuit_breaker.is_open()
         return result
 
     def get_ratellmiter(self, model_name: str = None):
-        return self.rate_limiter
+        shard = self.get_current_api_key_shard()
+        result = shard.rate_limiter if shard is not None else self.rate_limiter
+        return result
 
-    def prompt(self, prompt_id, prompt_text, system_prompt=None, json_output=False, temp=0.0,
-               max_output=None) -> LlmClientResponse:
+    def make_prompt_key(self, prompt_text, system_prompt, json_output, temp, max_output, sample_index=None):
+        key_dict = {"model_name": self.model_name, "temp": temp, "system_prompt": system_prompt,
+                    "json_output": output_format_key(json_output), "max_output": max_output, "prompt_text": prompt_text,
+                    "sample_index": sample_index}
+        key_string = json.dumps(key_dict, sort_keys=True)
+        result = hashlib.sha256(key_string.encode("utf-8")).hexdigest()
+        return result
+
+    def get_cached_response(self, cache_key):
+        result = None
+        cache = llmonpy_response_cache()
+        if cache is not None and cache_key is not None:
+            response_dict = cache.get(cache_key)
+            if response_dict is not None:
+                result = LlmClientResponse.from_dict(response_dict, from_cache=True)
+        return result
+
+    def cache_response(self, cache_key, response: LlmClientResponse):
+        cache = llmonpy_response_cache()
+        if cache is not None and cache_key is not None and response is not None:
+            cache.put(cache_key, response.to_dict())
+
+    # key shared by the response cache and single flight coalescing, None when the request must not be reused
+    def get_request_key(self, prompt_text, system_prompt, json_output, temp, max_output, sample_index):
+        result = None
+        if is_cacheable_request(temp, sample_index):
+            result = self.make_prompt_key(prompt_text, system_prompt, json_output, temp, max_output, sample_index)
+        return result
+
+    def validate_response(self, response: LlmClientResponse, response_validator) -> LlmClientResponse:
+        if response_validator is not None:
+            try:
+                response_validator(response)
+            except Exception as e:
+                raise LlmClientJSONFormatException(response.response_text, response.output_tokens) from e
+        return response
+
+    def get_retry_policy(self) -> RetryPolicy:
+        result = self.retry_policy if self.retry_policy is not None else default_retry_policy()
+        return result
+
+    def set_retry_policy(self, retry_policy: RetryPolicy):
+        self.retry_policy = retry_policy
+
+    def get_hedge_policy(self) -> HedgePolicy:
+        result = self.hedge_policy if self.hedge_policy is not None else default_hedge_policy()
+        return result
+
+    def set_hedge_policy(self, hedge_policy: HedgePolicy):
+        self.hedge_policy = hedge_policy
+
+    def get_circuit_breaker(self) -> CircuitBreaker:
+        return self.circuit_breaker
+
+    def set_circuit_breaker_policy(self, policy: CircuitBreakerPolicy):
+        self.circuit_breaker.set_policy(policy)
+
+    # False while the circuit breaker would fail an attempt, so a model group sends the prompt to another member
+    def is_available(self):
+        result = self.circuit_breaker.is_available()
+        return result
+
+    # timing of a successful provider call, latency is the call alone and ticket_wait the ticket and token wait
+    # before it
+    def record_call_timing(self, ticket_wait, latency):
+        self.latency_tracker.record(latency)
+        self.circuit_breaker.record_call(latency)
+        status_service = llm_client_prompt_status_service()
+        if status_service is not None:
+            status_service.record_prompt_timing(self.model_name, ticket_wait, latency)
+
+    def get_median_latency(self):
+        result = self.latency_tracker.get_percentile(0.5)
+        return result
+
+    def get_health(self) -> ClientHealth:
+        return self.health
+
+    # the calls a new call would wait behind: running, plus queued in the scheduler.  Calls made outside the
+    # scheduler are only in the health's in flight count.
+    def get_load(self):
+        result = self.health.get_in_flight_count()
+        scheduler = llmonpy_scheduler()
+        if scheduler is not None:
+            queued_count, running_count = scheduler.get_model_load(self.model_name)
+            result = max(result, running_count) + queued_count
+        return result
+
+    # a client's own token limiter wins over the one its provider shares
+    def get_token_rate_limiter(self) -> TokenRateLimiter:
+        result = self.token_rate_limiter
+        if result is None:
+            result = PROVIDER_TOKEN_RATE_LIMITER_DICT.get(self.provider_name, None)
+        return result
+
+    def set_token_rate_limiter(self, token_rate_limiter: TokenRateLimiter):
+        self.token_rate_limiter = token_rate_limiter
+
+    # deadline is the call's, a prompt that can't get its tokens before it is rejected instead of sent late
+    def reserve_tokens(self, prompt_text, system_prompt, max_output, sample_count=1,
+                       deadline=None) -> TokenReservation:
         result = None
-        result = self.rate_llmiter_prompt(prompt_text, system_prompt, json_output, temp, max_output,
-                                         model_name_for_logging=self.model_name, user_request_id=prompt_id)
+        token_rate_limiter = self.get_token_rate_limiter()
+        if token_rate_limiter is not None:
+            output_tokens = max_output if max_output is not None else DEFAULT_OUTPUT_RESERVATION
+            output_tokens *= sample_count
+            tokens = estimate_token_count(prompt_text) + estimate_token_count(system_prompt) + output_tokens
+            result = token_rate_limiter.reserve(tokens, deadline)
+        return result
+
+    # A bad JSON response still used its tokens, so the estimate stands.  Any other failure is taken to have been
+    # rejected before the model ran.
+    def settle_tokens(self, reservation: TokenReservation, response: LlmClientResponse = None, exception=None):
+        if reservation is not None:
+            if response is not None:
+                reservation.reconcile(response.input_tokens + response.output_tokens)
+            elif isinstance(exception, LlmClientJSONFormatException) is False:
+                reservation.release()
+
+    # attempt_listener is called with a RetryAttempt for every attempt, so callers can put them on a trace.
+    # response_validator is called with each response and should raise if the response can't be used, that attempt
+    # is then retried as a format error.  stream=True reads the response with stream_prompt, which fills in the
+    # time to first token and tokens per second and lets a JSON response that goes off format be aborted early.
+    # hedge=True sends a second request when the first is slower than the client's HedgePolicy allows, cost_listener
+    # is called with the cost of the losing request, which is paid for but not returned.
+    # deadline is an absolute time.time(), each attempt gets the time left as its timeout and no attempt is started
+    # after it, see llmonpy_deadline.
+    def prompt(self, prompt_id, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+               max_output=None, sample_index=None, attempt_listener=None,
+               response_validator=None, stream=False, hedge=False, deadline=None,
+               cost_listener=None) -> LlmClientResponse:
+        request_key = self.get_request_key(prompt_text, system_prompt, json_output, temp, max_output, sample_index)
+        result = self.get_cached_response(request_key)
+        if result is None:
+            result = IN_FLIGHT_PROMPTS.run(request_key,
+                                           lambda: self.uncached_prompt(prompt_id, request_key, prompt_text,
+                                                                        system_prompt, json_output, temp,
+                                                                        max_output, attempt_listener,
+                                                                        response_validator, stream, hedge,
+                                                                        deadline, cost_listener),
+                                           deadline, attempt_listener)
+        return result
+
+    def uncached_prompt(self, prompt_id, request_key, prompt_text, system_prompt, json_output, temp,
+                        max_output, attempt_listener=None, response_validator=None,
+                        stream=False, hedge=False, deadline=None, cost_listener=None) -> LlmClientResponse:
+        self.ensure_started()
+        attempt_function = self.make_attempt_function(prompt_id, prompt_text, system_prompt, json_output, temp,
+                                                       max_output, response_validator, stream, deadline)
+        self.health.start_call()
+        try:
+            if hedge:
+                hedge_client = self.get_hedge_client()
+                hedge_attempt_function = hedge_client.make_attempt_function(prompt_id + "-hedge", prompt_text,
+                                                                            system_prompt, json_output, temp,
+                                                                            max_output, response_validator, stream,
+                                                                            deadline)
+                result = self.get_retry_policy().run(lambda: self.hedged_attempt(attempt_function,
+                                                                                 hedge_attempt_function,
+                                                                                 hedge_client, cost_listener),
+                                                     attempt_listener, deadline)
+            else:
+                result = self.get_retry_policy().run(attempt_function, attempt_listener, deadline)
+        finally:
+            self.health.finish_call()
+        # an answer from an equivalent model isn't cached as this model's answer
+        if result.hedged_by is None or result.hedged_by == self.model_name:
+            self.cache_response(request_key, result)
+        return result
+
+    # the deadline is set where the attempt runs, a hedged attempt runs on another thread
+    def make_attempt_function(self, prompt_id, prompt_text, system_prompt, json_output, temp, max_output,
+                              response_validator, stream, deadline=None):
+        output_limit = OutputLimit(max_output)
+        if stream:
+            attempt_function = lambda limit: self.streamed_prompt(prompt_id, prompt_text, system_prompt,
+                                                                  json_output, temp, limit)
+        else:
+            attempt_function = lambda limit: self.token_limited_prompt(prompt_id, prompt_text, system_prompt,
+                                                                       json_output, temp, limit)
+        result = lambda: run_before_deadline(deadline,
+                                             lambda: self.record_outcome(
+                                                 lambda: output_limit.run(
+                                                     lambda limit: self.validate_response(attempt_function(limit),
+                                                                                          response_validator))))
+        return result
+
+    # every attempt counts toward the client's health, including rate limits and unusable responses.  The circuit
+    # breaker is checked first, an attempt it stops is never started.
+    def record_outcome(self, attempt_function):
+        self.circuit_breaker.before_call()
+        try:
+            result = self.run_with_api_key(attempt_function)
+        except Exception as e:
+            self.health.record_outcome(False)
+            self.circuit_breaker.record_error(classify_exception(e))
+            raise e
+        self.health.record_outcome(True)
+        self.record_usage(result)
+        return result
+
+    def record_usage(self, response: LlmClientResponse):
+        status_service = llm_client_prompt_status_service()
+        if status_service is not None:
+            status_service.record_prompt_usage(self.model_name, response.input_tokens, response.output_tokens,
+                                               response.input_cost + response.output_cost)
+
+    # the hedge can go to a model or to a model group, the same model if it isn't active
+    def get_hedge_client(self):
+        result = self
+        hedge_model_name = self.get_hedge_policy().hedge_model_name
+        if hedge_model_name is not None:
+            try:
+                result = get_llm_client(hedge_model_name)
+            except KeyError:
+                result = self
+        result.ensure_started()
+        return result
+
+    # each attempt is hedged on its own, so a retry after a failed attempt can be hedged again
+    def hedged_attempt(self, attempt_function, hedge_attempt_function, hedge_client,
+                       cost_listener=None) -> LlmClientResponse:
+        hedge_delay = self.get_hedge_policy().get_hedge_delay(self.latency_tracker)
+        loser_listener = None
+        if cost_listener is not None:
+            loser_listener = lambda response: cost_listener(response.get_response_cost())
+        result, hedge_won = run_hedged(attempt_function, hedge_attempt_function, hedge_delay,
+                                       hedge_client.get_thread_pool(), loser_listener)
+        if hedge_won:
+            result.hedged_by = hedge_client.model_name
+        return result
+
+    # Asks for sample_count choices of one prompt in a single request, so they take one ticket and the input is
+    # paid for once.  The list has one response per choice in the order they came back, input cost is split evenly
+    # and a choice that isn't valid JSON is None.  A client without an n parameter answers with a single choice.
+    def prompt_samples(self, prompt_id, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                       max_output=None, sample_count=1, attempt_listener=None,
+                       deadline=None) -> [LlmClientResponse]:
+        self.ensure_started()
+        sample_count = max(min(sample_count, self.max_samples_per_call), 1)
+        if sample_count == 1:
+            result = [self.uncached_prompt(prompt_id, None, prompt_text, system_prompt, json_output, temp,
+                                           max_output, attempt_listener, deadline=deadline)]
+            return result
+        attempt_function = lambda: run_before_deadline(deadline,
+                                                       lambda: self.record_outcome(
+                                                           lambda: self.token_limited_prompt(prompt_id, prompt_text,
+                                                                                             system_prompt,
+                                                                                             json_output, temp,
+                                                                                             max_output,
+                                                                                             sample_count)))
+        self.health.start_call()
+        try:
+            response = self.get_retry_policy().run(attempt_function, attempt_listener, deadline)
+        finally:
+            self.health.finish_call()
+        result = self.split_samples(response, json_output)
+        return result
+
+    # usage is only reported for the whole call, so output tokens are split by the length of each choice
+    def split_samples(self, response: LlmClientResponse, json_output) -> [LlmClientResponse]:
+        result = []
+        text_list = response.sample_text_list
+        sample_count = len(text_list)
+        total_length = max(sum(len(text) for text in text_list), 1)
+        for text in text_list:
+            output_tokens = round(response.output_tokens * len(text) / total_length)
+            try:
+                sample = self.response_from_text(text, json_output, response.input_tokens // sample_count,
+                                                 output_tokens, response.cached_input_tokens // sample_count,
+                                                 response.cache_write_tokens // sample_count)
+                sample.input_cost = response.input_cost / sample_count
+            except LlmClientJSONFormatException:
+                sample = None
+            result.append(sample)
+        return result
+
+    # the choices aren't parsed here, one bad choice shouldn't cost the others a retry
+    def response_from_samples(self, text_list, input_tokens, output_tokens, cached_input_tokens=0,
+                              cache_write_tokens=0) -> LlmClientResponse:
+        input_cost, output_cost = self.calculate_costs(input_tokens, output_tokens, cached_input_tokens,
+                                                       cache_write_tokens)
+        result = LlmClientResponse(text_list[0], None, input_cost, output_cost, input_tokens=input_tokens,
+                                   output_tokens=output_tokens, cached_input_tokens=cached_input_tokens,
+                                   cache_write_tokens=cache_write_tokens, sample_text_list=text_list)
+        return result
+
+    # tokens are reserved before waiting for a ticket, so a prompt that has to wait for room doesn't hold a ticket
+    def token_limited_prompt(self, prompt_id, prompt_text, system_prompt, json_output, temp,
+                             max_output, sample_count=1) -> LlmClientResponse:
+        admission_start_time = time.time()
+        reservation = self.reserve_tokens(prompt_text, system_prompt, max_output, sample_count, get_call_deadline())
+        try:
+            result = self.rate_llmiter_prompt(prompt_text, system_prompt, json_output, temp, max_output,
+                                              model_name_for_logging=self.model_name, user_request_id=prompt_id,
+                                              admission_start_time=admission_start_time,
+                                              sample_count=sample_count)
+        except Exception as e:
+            self.settle_tokens(reservation, exception=e)
+            raise e
+        self.settle_tokens(reservation, result)
+        return result
+
+    # Yields the text deltas of one completion.  The ticket is taken from ratellmiter before the stream is opened,
+    # a rate limit before the first delta goes back to ratellmiter and the stream is reopened.  Nothing else is
+    # retried here, a JSON response that can't be valid raises LlmClientJSONFormatException as soon as that is
+    # certain and closes the stream.  field_listener is called with each top level field of a JSON response as soon
+    # as its value is complete.
+    def stream_prompt(self, prompt_id, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                      max_output=None, stream_state: StreamState = None, field_listener=None):
+        self.ensure_started()
+        stream_state = stream_state if stream_state is not None else StreamState()
+        if json_output:
+            stream_state.json_parser = JsonyStreamParser(field_listener)
+        json_parser = stream_state.json_parser
+        pending_rate_limit_list = []
+        stream_started = False
+        admission_start_time = time.time()
+        reservation = self.reserve_tokens(prompt_text, system_prompt, max_output, deadline=get_call_deadline())
+        try:
+            while stream_started is False:
+                self.rate_llmiter_admit(pending_rate_limit_list, user_request_id=prompt_id,
+                                        model_name_for_logging=self.model_name)
+                attempt_start_time = time.time()
+                self.health.record_admission_wait(attempt_start_time - admission_start_time)
+                try:
+                    for delta in self.do_stream(stream_state, prompt_text, system_prompt, json_output, temp,
+                                                max_output):
+                        stream_started = True
+                        stream_state.add_delta(delta)
+                        if json_parser is not None and json_parser.feed(delta) is False:
+                            raise LlmClientJSONFormatException(stream_state.get_text())
+                        yield delta
+                    stream_started = True
+                except Exception as e:
+                    self.record_api_key_error(e)
+                    if stream_started or is_rate_limit_exception(e) is False:
+                        raise e
+                    pending_rate_limit_list.append(e)
+            stream_state.finish()
+            self.record_call_timing(attempt_start_time - admission_start_time, time.time() - attempt_start_time)
+        finally:
+            # an aborted stream is charged for what it generated before it was closed
+            if reservation is not None and stream_started:
+                reservation.reconcile(stream_state.get_input_tokens(prompt_text) + stream_state.get_output_tokens())
+            elif reservation is not None:
+                reservation.release()
+
+    def streamed_prompt(self, prompt_id, prompt_text, system_prompt, json_output, temp,
+                        max_output) -> LlmClientResponse:
+        stream_state = StreamState()
+        for _ in self.stream_prompt(prompt_id, prompt_text, system_prompt, json_output, temp, max_output,
+                                    stream_state):
+            pass
+        full_prompt = prompt_text if system_prompt is None else system_prompt + prompt_text
+        result = self.response_from_text(stream_state.get_json_text(), json_output,
+                                         stream_state.get_input_tokens(full_prompt),
+                                         stream_state.get_output_tokens(), stream_state.cached_input_tokens,
+                                         stream_state.cache_write_tokens)
+        result.time_to_first_token = stream_state.get_time_to_first_token()
+        result.tokens_per_second = stream_state.get_tokens_per_second()
         return result
 
     @llmiter(user_request_id_arg="user_request_id", model_name_arg="model_name_for_logging")
     def rate_llmiter_prompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0,
-               max_output=None, user_request_id=None, model_name_for_logging=None) -> LlmClientResponse:
+               max_output=None, user_request_id=None, model_name_for_logging=None,
+               admission_start_time=None, sample_count=1) -> LlmClientResponse:
         result = None
-        result = self.do_prompt(prompt_text, system_prompt, json_output, temp, max_output)
+        start_time = time.time()
+        if admission_start_time is not None:
+            self.health.record_admission_wait(start_time - admission_start_time)
+        try:
+            if sample_count > 1:
+                result = self.do_prompt_samples(prompt_text, system_prompt, json_output, temp, max_output,
+                                                sample_count)
+            else:
+                result = self.do_prompt(prompt_text, system_prompt, json_output, temp, max_output)
+        except Exception as e:
+            self.record_api_key_error(e)
+            raise e
         if result is None:
             raise LlmClientRateLimitException()
+        ticket_wait = start_time - admission_start_time if admission_start_time is not None else 0.0
+        self.record_call_timing(ticket_wait, time.time() - start_time)
+        return result
+
+    async def aprompt(self, prompt_id, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                      max_output=None, sample_index=None, attempt_listener=None,
+                      response_validator=None, deadline=None) -> LlmClientResponse:
+        request_key = self.get_request_key(prompt_text, system_prompt, json_output, temp, max_output, sample_index)
+        result = self.get_cached_response(request_key)
+        if result is None:
+            result = await IN_FLIGHT_PROMPTS.arun(request_key,
+                                                  lambda: self.uncached_aprompt(prompt_id, request_key, prompt_text,
+                                                                                system_prompt, json_output, temp,
+                                                                                max_output, attempt_listener,
+                                                                                response_validator, deadline),
+                                                  deadline, attempt_listener)
         return result
 
+    async def uncached_aprompt(self, prompt_id, request_key, prompt_text, system_prompt, json_output, temp,
+                               max_output, attempt_listener=None, response_validator=None,
+                               deadline=None) -> LlmClientResponse:
+        self.ensure_started()
+        output_limit = OutputLimit(max_output)
+
+        async def limited_attempt(limit):
+            response = await self.arun_with_api_key(lambda: self.rate_llmiter_aprompt(prompt_id, prompt_text,
+                                                                                      system_prompt, json_output,
+                                                                                      temp, limit))
+            result = self.validate_response(response, response_validator)
+            return result
+
+        async def validated_attempt():
+            self.circuit_breaker.before_call()
+            try:
+                response = await output_limit.arun(limited_attempt)
+            except Exception as e:
+                self.health.record_outcome(False)
+                self.circuit_breaker.record_error(classify_exception(e))
+                raise e
+            self.health.record_outcome(True)
+            self.record_usage(response)
+            return response
+        self.health.start_call()
+        try:
+            result = await self.get_retry_policy().arun(lambda: arun_before_deadline(deadline, validated_attempt),
+                                                        attempt_listener, deadline)
+        finally:
+            self.health.finish_call()
+        self.cache_response(request_key, result)
+        return result
+
+    # mirrors the llmiter decorator: rate limits are retried here with a new ticket, everything else is raised to
+    # the retry policy
+    async def rate_llmiter_aprompt(self, prompt_id, prompt_text, system_prompt, json_output, temp,
+                                   max_output) -> LlmClientResponse:
+        loop = asyncio.get_running_loop()
+        pending_rate_limit_list = []
+        result = None
+        admission_start_time = time.time()
+        reservation = await loop.run_in_executor(TICKET_THREAD_POOL,
+                                                 functools.partial(self.reserve_tokens, prompt_text, system_prompt,
+                                                                   max_output, deadline=get_call_deadline()))
+        try:
+            while result is None:
+                # the ticket thread gets this context, so the ticket comes from the attempt's key
+                await loop.run_in_executor(TICKET_THREAD_POOL,
+                                           functools.partial(contextvars.copy_context().run, self.rate_llmiter_admit,
+                                                             pending_rate_limit_list, user_request_id=prompt_id,
+                                                             model_name_for_logging=self.model_name))
+                start_time = time.time()
+                self.health.record_admission_wait(start_time - admission_start_time)
+                try:
+                    result = await self.do_aprompt(prompt_text, system_prompt, json_output, temp, max_output)
+                    self.record_call_timing(start_time - admission_start_time, time.time() - start_time)
+                except Exception as e:
+                    self.record_api_key_error(e)
+                    if is_rate_limit_exception(e) is False:
+                        raise e
+                    pending_rate_limit_list.append(e)
+        except Exception as e:
+            self.settle_tokens(reservation, exception=e)
+            raise e
+        self.settle_tokens(reservation, result)
+        return result
+
+    # Gate used by the async and streaming paths so they share the ratellmiter tickets of the sync path.  If the
+    # last call hit a rate limit it is waiting in pending_rate_limit_list, raising here once lets ratellmiter record
+    # it and wait for a ticket after the rate limit.  The list is emptied first so the call llmiter makes after the
+    # wait goes through.
+    @llmiter(user_request_id_arg="user_request_id", model_name_arg="model_name_for_logging")
+    def rate_llmiter_admit(self, pending_rate_limit_list=None, user_request_id=None, model_name_for_logging=None):
+        if pending_rate_limit_list:
+            pending_rate_limit_list.clear()
+            raise LlmClientRateLimitException()
+        return True
+
     """    
     @retry(wait=wait_exponential(multiplier=1, min=5, max=15))
     def tenacity_prompt(self, prompt_id, prompt_text, system_prompt=None, json_output=False, temp=0.0,
@@ -409,500 +1502,986 @@ class LlmClient(RateLimitedService):
 
     def wait_for_ticket_after_rate_limit_exceeded(self, prompt_id, ticket):
         #llm_client_prompt_status_service().rate_limit_exceeded(prompt_id, self.model_name)
-        ticket = self.rate_limiter.wait_for_ticket_after_rate_limit_exceeded(ticket)
+        ticket = self.get_ratellmiter().wait_for_ticket_after_rate_limit_exceeded(ticket)
         #llm_client_prompt_status_service().got_ticket(prompt_id, self.model_name)
         return ticket
 
     def do_prompt(self, prompt_text, system_prompt=None, json_output=False, max_output=None, temp=0.0):
         raise Exception("Not implemented")
 
-    def get_thread_pool(self):
-        return self.thread_pool
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        raise Exception("Not implemented")
+
+    # returns response_from_samples with sample_count choices, only called when max_samples_per_call allows it
+    def do_prompt_samples(self, prompt_text, system_prompt, json_output, temp, max_output, sample_count):
+        raise Exception("Not implemented")
+
+    # generator of text deltas, sets the usage on stream_state when the provider reports it
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        raise Exception("Not implemented")
 
-    def calculate_costs(self, input_tokens, output_tokens):
-        input_cost = (input_tokens * self.price_per_input_token) / TOKEN_UNIT_FOR_COST
+    def response_from_text(self, response_text, json_output, input_tokens, output_tokens, cached_input_tokens=0,
+                           cache_write_tokens=0) -> LlmClientResponse:
+        response_dict = None
+        if json_output:
+            try:
+                response_text, response_dict = parse_json_response(response_text)
+                output_schema = get_output_schema(json_output)
+                if output_schema is not None:
+                    output_schema.validate(response_dict)
+            except Exception as e:
+                raise LlmClientJSONFormatException(response_text, output_tokens)
+        input_cost, output_cost = self.calculate_costs(input_tokens, output_tokens, cached_input_tokens,
+                                                       cache_write_tokens)
+        result = LlmClientResponse(response_text, response_dict, input_cost, output_cost, input_tokens=input_tokens,
+                                   output_tokens=output_tokens, cached_input_tokens=cached_input_tokens,
+                                   cache_write_tokens=cache_write_tokens)
+        return result
+
+    def get_provider_name(self):
+        return self.provider_name
+
+    def get_thread_pool(self) -> SchedulerLane:
+        result = llmonpy_scheduler().get_prompt_lane(self.provider_name, self.model_name)
+        return result
+
+    def calculate_costs(self, input_tokens, output_tokens, cached_input_tokens=0, cache_write_tokens=0):
+        uncached_tokens = input_tokens - cached_input_tokens - cache_write_tokens
+        priced_input_tokens = (uncached_tokens + cached_input_tokens * self.cached_input_price_ratio +
+                               cache_write_tokens * self.cache_write_price_ratio)
+        input_cost = (priced_input_tokens * self.price_per_input_token) / TOKEN_UNIT_FOR_COST
         output_cost = (output_tokens * self.price_per_output_token) / TOKEN_UNIT_FOR_COST
         return input_cost, output_cost
 
+    # checked against max_input before a prompt is sent, a client with an exact tokenizer can override it
+    def count_input_tokens(self, prompt_text, system_prompt=None):
+        result = estimate_token_count(prompt_text) + estimate_token_count(system_prompt)
+        return result
+
+    # an upper bound for a cost budget, the response is assumed to use all of max_output
+    def estimate_cost(self, prompt_text, system_prompt=None, max_output=None):
+        input_tokens = self.count_input_tokens(prompt_text, system_prompt)
+        output_tokens = max_output if max_output is not None else DEFAULT_OUTPUT_RESERVATION
+        input_cost, output_cost = self.calculate_costs(input_tokens, output_tokens)
+        result = input_cost + output_cost
+        return result
+
     @staticmethod
     def get_all_clients():
         return LlmClient.all_client_list
 
 
 class OpenAIModel(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "OPENAI_API_KEY"
+    sdk_module_name = "openai"
+    endpoint_url = "https://api.openai.com/v1"
+    # prefixes over 1024 tokens are cached automatically, a PrefixedPrompt already puts the prefix first
+    cached_input_price_ratio = 0.5
+    default_call_timeout = 90.0
+    max_samples_per_call = 128
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
 
     def start(self):
-        key = get_api_key("OPENAI_API_KEY")
-        self.client = OpenAI(api_key=key)
+        self.start_shared_clients()
+
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        openai = import_sdk("openai")
+        api_key = self.resolve_api_key(api_key)
+        http_client = make_http_client()
+        client = openai.OpenAI(api_key=api_key.key, organization=api_key.organization, http_client=http_client,
+                               max_retries=0)
+        async_client = openai.AsyncOpenAI(api_key=api_key.key, organization=api_key.organization,
+                                          http_client=make_async_http_client(), max_retries=0)
+        return client, async_client, http_client
+
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
+        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
+        result = {
+            "model": self.model_name,
+            "response_format": chat_response_format(json_output),
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt_text}
+            ],
+            "temperature": temp,
+            "timeout": self.get_call_timeout()
+        }
+        if max_output is not None:
+            # max_tokens is deprecated and rejected by the reasoning models
+            result["max_completion_tokens"] = max_output
+        return result
+
+    def response_from_completion(self, completion, json_output):
+        response_text = completion.choices[0].message.content
+        result = self.response_from_text(response_text, json_output, completion.usage.prompt_tokens,
+                                         completion.usage.completion_tokens, get_cached_input_tokens(completion.usage))
+        return result
 
     def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
                   temp=0.0, max_output=None):
-        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
-        result = None
-        response_text = None
-        response_format = "json_object" if json_output else "text"
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
-                response_format={"type": response_format},
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt_text}
-                ],
-                temperature=temp,
-                timeout=90
-            )
-            response_text = completion.choices[0].message.content
-            response_dict = None
-            if json_output:
-                try:
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    continue
-            input_cost, output_cost = self.calculate_costs(completion.usage.prompt_tokens,
-                                                           completion.usage.completion_tokens)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-        if result is None and json_output:
-            raise LlmClientJSONFormatException(response_text)
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = self.get_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = await self.get_async_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    def do_prompt_samples(self, prompt_text, system_prompt, json_output, temp, max_output, sample_count):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["n"] = sample_count
+        completion = self.get_sdk_client().chat.completions.create(**args)
+        result = self.response_from_samples([choice.message.content for choice in completion.choices],
+                                            completion.usage.prompt_tokens, completion.usage.completion_tokens,
+                                            get_cached_input_tokens(completion.usage))
         return result
 
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["stream"] = True
+        args["stream_options"] = {"include_usage": True}
+        stream = self.get_sdk_client().chat.completions.create(**args)
+        yield from chat_completion_stream_deltas(stream, stream_state)
+
 
 class DeepseekModel(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "DEEPSEEK_API_KEY"
+    sdk_module_name = "openai"
+    endpoint_url = "https://api.deepseek.com/"
+    cached_input_price_ratio = 0.1
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
 
     def start(self):
-        key = get_api_key("DEEPSEEK_API_KEY")
-        self.client = OpenAI(api_key=key, base_url="https://api.deepseek.com/")
-
-    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False):
-        completion = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=[
+        self.start_shared_clients()
+
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        openai = import_sdk("openai")
+        api_key = self.resolve_api_key(api_key)
+        http_client = make_http_client()
+        client = openai.OpenAI(api_key=api_key.key, base_url=self.endpoint_url, http_client=http_client,
+                               max_retries=0)
+        async_client = openai.AsyncOpenAI(api_key=api_key.key, base_url=self.endpoint_url,
+                                          http_client=make_async_http_client(), max_retries=0)
+        return client, async_client, http_client
+
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
+        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
+        result = {
+            "model": self.model_name,
+            "response_format": chat_response_format(json_output, json_schema_supported=False),
+            "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt_text}
             ],
-            temperature=0.0
-        )
-        result = completion.choices[0].message.content
+            "temperature": temp,
+            "timeout": self.get_call_timeout()
+        }
+        if max_output is not None:
+            result["max_tokens"] = max_output
+        return result
+
+    def response_from_completion(self, completion, json_output):
+        result = self.response_from_text(completion.choices[0].message.content, json_output,
+                                         completion.usage.prompt_tokens, completion.usage.completion_tokens,
+                                         get_cached_input_tokens(completion.usage))
+        return result
+
+    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
+                  temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = self.get_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = await self.get_async_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
         return result
 
 
+# Anthropic's input_tokens leaves out the tokens read from and written to the prompt cache
+def anthropic_input_usage(usage):
+    cached_input_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+    input_tokens = usage.input_tokens + cached_input_tokens + cache_write_tokens
+    return input_tokens, cached_input_tokens, cache_write_tokens
+
+
 class AnthropicModel(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "ANTHROPIC_API_KEY"
+    sdk_module_name = "anthropic"
+    endpoint_url = "https://api.anthropic.com"
+    cached_input_price_ratio = 0.1
+    cache_write_price_ratio = 1.25
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
 
     def start(self):
-        key = get_api_key("ANTHROPIC_API_KEY")
-        self.client = anthropic.Client(api_key=key)
-
-    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
-                  temp=0.0, max_output=4096):
+        self.start_shared_clients()
+
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        anthropic = import_sdk("anthropic")
+        api_key = self.resolve_api_key(api_key)
+        http_client = make_http_client()
+        client = anthropic.Client(api_key=api_key.key, http_client=http_client, max_retries=0)
+        async_client = anthropic.AsyncAnthropic(api_key=api_key.key, http_client=make_async_http_client(),
+                                                max_retries=0)
+        return client, async_client, http_client
+
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
         system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
         max_output = max_output if max_output is not None else 4096
+        prefix_text, rest_text = split_prompt_prefix(prompt_text)
+        content = prompt_text
+        if prefix_text is not None:
+            # a prefix under the model's minimum cacheable length is sent without being cached
+            content = [{"type": "text", "text": prefix_text, "cache_control": {"type": "ephemeral"}}]
+            if len(rest_text) > 0:
+                content.append({"type": "text", "text": rest_text})
         prompt_messages = [
             {
                 "role": "user",
-                "content": prompt_text
+                "content": content
             }
         ]
-        if json_output:
+        tool_schema = anthropic_tool_schema(json_output)
+        if json_output and tool_schema is None:
             prompt_messages.append({"role": "assistant", "content": "{"})
-        result = None
-        response_text = None
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            message = self.client.messages.create(
-                model=self.model_name,
-                max_tokens=max_output,
-                temperature=temp,
-                system=system_prompt,
-                messages=prompt_messages
-            )
+        result = {
+            "model": self.model_name,
+            "max_tokens": max_output,
+            "temperature": temp,
+            "system": system_prompt,
+            "messages": prompt_messages,
+            "timeout": self.get_call_timeout()
+        }
+        if tool_schema is not None:
+            result["tools"] = [{"name": tool_schema.get_name(), "description": "Record the response.",
+                                "input_schema": tool_schema.get_schema()}]
+            result["tool_choice"] = {"type": "tool", "name": tool_schema.get_name()}
+        return result
+
+    def response_from_completion(self, message, json_output):
+        if anthropic_tool_schema(json_output) is not None:
+            tool_input = next((block.input for block in message.content if block.type == "tool_use"), None)
+            response_text = json.dumps(tool_input) if tool_input is not None else message.content[0].text
+        else:
             response_text = message.content[0].text
-            response_dict = None
             if json_output:
-                try:
-                    response_text = "{ " + response_text
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    continue
-            input_cost, output_cost = self.calculate_costs(message.usage.input_tokens, message.usage.output_tokens)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-        if result is None and json_output:
-            raise LlmClientJSONFormatException(response_text)
+                response_text = "{ " + response_text
+        input_tokens, cached_input_tokens, cache_write_tokens = anthropic_input_usage(message.usage)
+        result = self.response_from_text(response_text, json_output, input_tokens, message.usage.output_tokens,
+                                         cached_input_tokens, cache_write_tokens)
         return result
 
+    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
+                  temp=0.0, max_output=4096):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        message = self.get_sdk_client().messages.create(**args)
+        result = self.response_from_completion(message, json_output)
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        message = await self.get_async_sdk_client().messages.create(**args)
+        result = self.response_from_completion(message, json_output)
+        return result
+
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["stream"] = True
+        stream = self.get_sdk_client().messages.create(**args)
+        # the "{" prefilled on the assistant turn isn't part of the stream, it goes out with the first delta
+        prefix = "{ " if json_output and anthropic_tool_schema(json_output) is None else ""
+        try:
+            for event in stream:
+                if event.type == "message_start":
+                    input_tokens, cached_input_tokens, cache_write_tokens = anthropic_input_usage(event.message.usage)
+                    stream_state.set_usage(input_tokens=input_tokens, cached_input_tokens=cached_input_tokens,
+                                           cache_write_tokens=cache_write_tokens)
+                elif event.type == "message_delta":
+                    stream_state.set_usage(output_tokens=event.usage.output_tokens)
+                elif event.type == "content_block_delta" and getattr(event.delta, "text", None):
+                    yield prefix + event.delta.text
+                    prefix = ""
+                elif event.type == "content_block_delta" and getattr(event.delta, "partial_json", None):
+                    yield event.delta.partial_json
+        finally:
+            close_stream(stream)
+
 
 class MistralLlmClient(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool, price_per_input_token=0.0,
+    api_key_name = "MISTRAL_API_KEY"
+    sdk_module_name = "mistralai"
+    endpoint_url = "https://api.mistral.ai"
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name, price_per_input_token=0.0,
                  price_per_output_token=0.0):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
 
     def start(self):
-        key = get_api_key("MISTRAL_API_KEY")
-        self.client = Mistral(api_key=key)
+        self.start_shared_clients()
+
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        mistralai = import_sdk("mistralai")
+        mistralai_utils = import_sdk("mistralai.utils")
+        api_key = self.resolve_api_key(api_key)
+        http_client = make_http_client()
+        client = mistralai.Mistral(api_key=api_key.key, client=http_client, async_client=make_async_http_client(),
+                                   retry_config=mistralai_utils.RetryConfig("none", None, False))
+        return client, None, http_client
+
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
+        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
+        result = {
+            "model": self.model_name,
+            "response_format": chat_response_format(json_output),
+            "max_tokens": max_output,
+            "temperature": temp,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt_text}
+            ],
+            "timeout_ms": int(self.get_call_timeout() * 1000)
+        }
+        return result
+
+    def response_from_completion(self, response, json_output):
+        response_text = response.choices[0].message.content
+        result = self.response_from_text(response_text, json_output, response.usage.prompt_tokens,
+                                         response.usage.completion_tokens)
+        return result
 
     def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False, temp=0.0,
                   max_output=None):
-        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
-        response_format = "json_object" if json_output else "text"
-        prompt_messages = [
-            { "role": "system", "content": system_prompt },
-            { "role": "user", "content": prompt_text }
-        ]
-        result = None
-        response_text = None
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            response = self.client.chat.complete(
-                model=self.model_name,
-                response_format={"type": response_format},
-                max_tokens=max_output,
-                temperature=temp,
-                messages=prompt_messages
-            )
-            response_text = response.choices[0].message.content
-            response_dict = None
-            if json_output:
-                try:
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    continue
-            input_cost, output_cost = self.calculate_costs(response.usage.prompt_tokens,
-                                                           response.usage.completion_tokens)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-        if result is None and json_output:
-            raise LlmClientJSONFormatException(response_text)
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        response = self.get_sdk_client().chat.complete(**args)
+        result = self.response_from_completion(response, json_output)
         return result
 
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        # the Mistral client exposes async variants of each call on the same object
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        response = await self.get_sdk_client().chat.complete_async(**args)
+        result = self.response_from_completion(response, json_output)
+        return result
+
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        stream = self.get_sdk_client().chat.stream(**args)
+        try:
+            for event in stream:
+                chunk = event.data
+                if chunk.usage is not None:
+                    stream_state.set_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            close_stream(stream)
+
+
+GEMINI_MIN_CACHE_TOKENS = 32768
+GEMINI_CACHE_TTL = 600  # seconds
+GEMINI_CACHE_RENEW_MARGIN = 60  # a cache is replaced this long before it expires
+
 
 # https://ai.google.dev/gemini-api/docs/get-started/tutorial?authuser=2&lang=python
 class GeminiModel(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "GEMINI_API_KEY"
+    sdk_module_name = "google.generativeai"
+    cached_input_price_ratio = 0.25
+    multiple_api_keys_supported = False
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.cached_model_dict = {}
+        self.cached_model_lock = threading.Lock()
 
     def start(self):
-        key = get_api_key("GEMINI_API_KEY")
-        genai.configure(api_key=key)
+        genai = import_sdk("google.generativeai")
+        genai.configure(api_key=self.resolve_api_key().key)
         self.client = genai.GenerativeModel(self.model_name)
         self.json_client = genai.GenerativeModel(self.model_name,
                                                  generation_config={"response_mime_type": "application/json"})
 
-    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
-                  temp=0.0, max_output=None):
+    # Gemini caches content explicitly and only above a minimum size.  A prefix that big is cached with the system
+    # prompt and a model is made from the cache, the call then sends only the rest of the prompt.
+    def select_model(self, prompt_text, system_prompt, json_output):
         prompt_client = self.json_client if json_output else self.client
-        full_prompt = str(system_prompt) + "\n\n" + prompt_text
+        contents = str(system_prompt) + "\n\n" + prompt_text
+        prefix_text, rest_text = split_prompt_prefix(prompt_text)
+        if (prefix_text is not None and len(rest_text) > 0 and
+                estimate_token_count(prefix_text) >= GEMINI_MIN_CACHE_TOKENS):
+            cached_model = self.get_cached_model(str(system_prompt) + "\n\n" + prefix_text, json_output)
+            if cached_model is not None:
+                prompt_client = cached_model
+                contents = rest_text
+        return prompt_client, contents
+
+    # An entry holds a future of the cached model, so the CachedContent.create round trip runs outside the lock and
+    # only calls with the same prefix wait for it.  A call that can't wait until the model is ready gets None.
+    def get_cached_model(self, prefix_contents, json_output):
+        cache_key = hashlib.sha256(prefix_contents.encode("utf-8")).hexdigest() + ("json" if json_output else "")
+        current_time = time.time()
+        is_creator = False
+        with self.cached_model_lock:
+            entry = self.cached_model_dict.get(cache_key, None)
+            if entry is None or entry[1] < current_time:
+                self.cached_model_dict = {key: value for key, value in self.cached_model_dict.items()
+                                          if value[1] >= current_time}
+                entry = (concurrent.futures.Future(), current_time + GEMINI_CACHE_TTL - GEMINI_CACHE_RENEW_MARGIN)
+                self.cached_model_dict[cache_key] = entry
+                is_creator = True
+        model_future = entry[0]
+        if is_creator:
+            model_future.set_result(self.create_cached_model(prefix_contents, json_output))
+        try:
+            result = model_future.result(timeout=self.get_call_timeout())
+        except concurrent.futures.TimeoutError:
+            result = None
+        return result
+
+    # None when the cache can't be created, the prefix is then sent with each call until the entry expires
+    def create_cached_model(self, prefix_contents, json_output):
         result = None
-        response_text = None
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            model_response = prompt_client.generate_content(full_prompt,
-                                                            safety_settings={
-                                                                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                                                                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                                                                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                                                                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE
-                                                            },
-                                                            generation_config=genai.GenerationConfig(temperature=temp))
-            response_text = model_response.text
-            response_dict = None
-            if json_output:
-                try:
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    continue
-            input_cost, output_cost = self.calculate_costs(model_response.usage_metadata.prompt_token_count,
-                                                           model_response.usage_metadata.candidates_token_count)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-            if result is None and json_output:
-                raise LlmClientJSONFormatException(response_text)
+        try:
+            genai = import_sdk("google.generativeai")
+            caching = import_sdk("google.generativeai.caching")
+            cached_content = caching.CachedContent.create(model="models/" + self.model_name,
+                                                          contents=[prefix_contents],
+                                                          ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL))
+            generation_config = {"response_mime_type": "application/json"} if json_output else None
+            result = genai.GenerativeModel.from_cached_content(cached_content, generation_config=generation_config)
+        except Exception as e:
+            print("Gemini cached content not created for " + self.model_name + ": " + str(e))
+        return result
+
+    # the schema goes in the call's generation config, which the model's own config is merged with
+    def completion_args(self, contents, temp, max_output, json_output=False):
+        genai = import_sdk("google.generativeai")
+        harm_category = import_sdk("google.generativeai.types").HarmCategory
+        block_none = import_sdk("google.generativeai.types").HarmBlockThreshold.BLOCK_NONE
+        result = {
+            "contents": contents,
+            "safety_settings": {
+                harm_category.HARM_CATEGORY_HATE_SPEECH: block_none,
+                harm_category.HARM_CATEGORY_HARASSMENT: block_none,
+                harm_category.HARM_CATEGORY_DANGEROUS_CONTENT: block_none,
+                harm_category.HARM_CATEGORY_SEXUALLY_EXPLICIT: block_none
+            },
+            "generation_config": genai.GenerationConfig(temperature=temp, max_output_tokens=max_output),
+            # retry None turns off the retry the generated client wraps generate_content in
+            "request_options": {"timeout": self.get_call_timeout(), "retry": None}
+        }
+        output_schema = get_output_schema(json_output)
+        gemini_schema = output_schema.get_gemini_schema() if output_schema is not None else None
+        if gemini_schema is not None:
+            result["generation_config"] = genai.GenerationConfig(temperature=temp, max_output_tokens=max_output,
+                                                                 response_mime_type="application/json",
+                                                                 response_schema=gemini_schema)
+        return result
+
+    def response_from_completion(self, model_response, json_output):
+        usage_metadata = model_response.usage_metadata
+        result = self.response_from_text(model_response.text, json_output, usage_metadata.prompt_token_count,
+                                         usage_metadata.candidates_token_count,
+                                         getattr(usage_metadata, "cached_content_token_count", None) or 0)
+        return result
+
+    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
+                  temp=0.0, max_output=None):
+        prompt_client, contents = self.select_model(prompt_text, system_prompt, json_output)
+        args = self.completion_args(contents, temp, max_output, json_output)
+        model_response = prompt_client.generate_content(**args)
+        result = self.response_from_completion(model_response, json_output)
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        prompt_client, contents = self.select_model(prompt_text, system_prompt, json_output)
+        args = self.completion_args(contents, temp, max_output, json_output)
+        model_response = await prompt_client.generate_content_async(**args)
+        result = self.response_from_completion(model_response, json_output)
         return result
 
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        prompt_client, contents = self.select_model(prompt_text, system_prompt, json_output)
+        args = self.completion_args(contents, temp, max_output, json_output)
+        model_response = prompt_client.generate_content(**args, stream=True)
+        for chunk in model_response:
+            usage_metadata = getattr(chunk, "usage_metadata", None)
+            if usage_metadata is not None:
+                stream_state.set_usage(usage_metadata.prompt_token_count, usage_metadata.candidates_token_count,
+                                       getattr(usage_metadata, "cached_content_token_count", None))
+            if chunk.text:
+                yield chunk.text
+
 
 class TogetherAIModel(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "TOGETHER_API_KEY"
+    sdk_module_name = "together"
+    max_samples_per_call = 128
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
 
     def start(self):
-        key = get_api_key("TOGETHER_API_KEY")
-        self.client = Together(api_key=key)
+        self.start_shared_clients()
+
+    # the Together SDK doesn't take an HTTP client, sharing the SDK client still shares its session.  It has no per
+    # request timeout either, so a call is held to default_call_timeout however much of its deadline is left.
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        together = import_sdk("together")
+        api_key = self.resolve_api_key(api_key)
+        result = together.Together(api_key=api_key.key, timeout=self.default_call_timeout, max_retries=0), \
+            together.AsyncTogether(api_key=api_key.key, timeout=self.default_call_timeout, max_retries=0), None
+        return result
 
-    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
-                  temp=0.0, max_output=None):
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
         system_prompt = system_prompt if system_prompt is not None else ""
-        result = None
-        response_text = None
         full_prompt = str(system_prompt) + "\n\n" + prompt_text
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            completion = self.client.completions.create(
-                model=self.model_name,
-                prompt=full_prompt,
-                temperature=temp
-            )
-            response_text = completion.choices[0].text
-            response_dict = None
-            if json_output:
-                try:
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    print("JSON parsing error " + response_text)
-                    continue
-            input_cost, output_cost = self.calculate_costs(completion.usage.prompt_tokens,
-                                                           completion.usage.completion_tokens)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-        if result is None and json_output:
-            raise LlmClientJSONFormatException(response_text)
+        output_schema = get_output_schema(json_output)
+        if output_schema is not None:
+            # the completions API has no JSON mode
+            full_prompt += output_schema.get_instruction_text()
+        result = {
+            "model": self.model_name,
+            "prompt": full_prompt,
+            "temperature": temp
+        }
+        if max_output is not None:
+            result["max_tokens"] = max_output
         return result
 
+    def response_from_completion(self, completion, json_output):
+        response_text = completion.choices[0].text
+        result = self.response_from_text(response_text, json_output, completion.usage.prompt_tokens,
+                                         completion.usage.completion_tokens, get_cached_input_tokens(completion.usage))
+        return result
+
+    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
+                  temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = self.get_sdk_client().completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = await self.get_async_sdk_client().completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    def do_prompt_samples(self, prompt_text, system_prompt, json_output, temp, max_output, sample_count):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["n"] = sample_count
+        completion = self.get_sdk_client().completions.create(**args)
+        result = self.response_from_samples([choice.text for choice in completion.choices],
+                                            completion.usage.prompt_tokens, completion.usage.completion_tokens,
+                                            get_cached_input_tokens(completion.usage))
+        return result
+
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["stream"] = True
+        stream = self.get_sdk_client().completions.create(**args)
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    stream_state.set_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if chunk.choices is not None and len(chunk.choices) > 0 and chunk.choices[0].text:
+                    yield chunk.choices[0].text
+        finally:
+            close_stream(stream)
+
 
 class FireworksAIModel(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "FIREWORKS_API_KEY"
+    sdk_module_name = "fireworks.client"
+    max_samples_per_call = 128
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0, system_role_supported=True):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
         self.system_role_supported = system_role_supported
 
     def start(self):
-        key = get_api_key("FIREWORKS_API_KEY")
-        self.client = Fireworks(api_key=key)
+        self.start_shared_clients()
+
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        fireworks_client = import_sdk("fireworks.client")
+        api_key = self.resolve_api_key(api_key)
+        # fireworks.client has no retries of its own, a failed request is raised as is
+        result = fireworks_client.Fireworks(api_key=api_key.key), \
+            fireworks_client.AsyncFireworks(api_key=api_key.key), None
+        return result
 
-    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
-                  temp=0.0, max_output=None):
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
         system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
-        result = None
-        response_text = None
         response_format = "json_object" if json_output else "text"
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            if self.system_role_supported:
-                completion = self.client.chat.completions.create(
-
-                    model=self.model_name,
-                    # response_format={"type": response_format},
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": prompt_text}
-                    ],
-                    temperature=temp
-                )
-            else:
-                full_prompt = str(system_prompt) + "\n\n" + prompt_text
-                completion = self.client.chat.completions.create(
-                    model=self.model_name,
-                    response_format={"type": response_format},
-                    messages=[
-                        {"role": "user", "content": full_prompt}
-                    ],
-                    temperature=temp
-                )
-            response_text = completion.choices[0].message.content
-            response_dict = None
-            if json_output:
-                try:
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    continue
-            input_cost, output_cost = self.calculate_costs(completion.usage.prompt_tokens,
-                                                           completion.usage.completion_tokens)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-        if result is None and json_output:
-            raise LlmClientJSONFormatException(response_text)
+        output_schema = get_output_schema(json_output)
+        if self.system_role_supported:
+            result = {
+                "model": self.model_name,
+                # "response_format": {"type": response_format},
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt_text}
+                ],
+                "temperature": temp
+            }
+            if output_schema is not None:
+                # a schema is enforced with grammar based decoding, which works on every model
+                result["response_format"] = {"type": "json_object", "schema": output_schema.get_schema()}
+        else:
+            full_prompt = str(system_prompt) + "\n\n" + prompt_text
+            result = {
+                "model": self.model_name,
+                "response_format": {"type": response_format},
+                "messages": [
+                    {"role": "user", "content": full_prompt}
+                ],
+                "temperature": temp
+            }
+            if output_schema is not None:
+                result["response_format"]["schema"] = output_schema.get_schema()
+        result["request_timeout"] = self.get_call_timeout()
+        if max_output is not None:
+            result["max_tokens"] = max_output
+        return result
+
+    def response_from_completion(self, completion, json_output):
+        response_text = completion.choices[0].message.content
+        result = self.response_from_text(response_text, json_output, completion.usage.prompt_tokens,
+                                         completion.usage.completion_tokens, get_cached_input_tokens(completion.usage))
+        return result
+
+    def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
+                  temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = self.get_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = await self.get_async_sdk_client().chat.completions.acreate(**args)
+        result = self.response_from_completion(completion, json_output)
         return result
 
+    def do_prompt_samples(self, prompt_text, system_prompt, json_output, temp, max_output, sample_count):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["n"] = sample_count
+        completion = self.get_sdk_client().chat.completions.create(**args)
+        result = self.response_from_samples([choice.message.content for choice in completion.choices],
+                                            completion.usage.prompt_tokens, completion.usage.completion_tokens,
+                                            get_cached_input_tokens(completion.usage))
+        return result
+
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["stream"] = True
+        stream = self.get_sdk_client().chat.completions.create(**args)
+        yield from chat_completion_stream_deltas(stream, stream_state)
+
+
 class AI21Model(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "AI21_API_KEY"
+    sdk_module_name = "ai21"
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
 
     def start(self):
-        key = get_api_key("AI21_API_KEY")
-        self.client = AI21Client(api_key=key)
+        self.start_shared_clients()
+
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        ai21 = import_sdk("ai21")
+        api_key = self.resolve_api_key(api_key)
+        # the AI21 SDK only takes a timeout per client, so a call is held to default_call_timeout
+        result = ai21.AI21Client(api_key=api_key.key, timeout_sec=self.default_call_timeout, num_retries=0), \
+            ai21.AsyncAI21Client(api_key=api_key.key, timeout_sec=self.default_call_timeout, num_retries=0), None
+        return result
+
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
+        ai21_chat = import_sdk("ai21.models.chat")
+        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
+        result = {
+            "model": self.model_name,
+            "temperature": temp,
+            "messages": [
+                ai21_chat.SystemMessage(content=system_prompt),
+                ai21_chat.UserMessage(content=prompt_text)
+            ]
+        }
+        if json_output:
+            # Jamba's JSON mode takes no schema, so the schema goes in the prompt as well
+            output_schema = get_output_schema(json_output)
+            if output_schema is not None:
+                result["messages"][1] = ai21_chat.UserMessage(content=prompt_text +
+                                                              output_schema.get_instruction_text())
+            result["response_format"] = ai21_chat.ResponseFormat(type="json_object")
+        if max_output is not None:
+            result["max_tokens"] = max_output
+        return result
+
+    def response_from_completion(self, completion, json_output):
+        response_text = completion.choices[0].message.content
+        result = self.response_from_text(response_text, json_output, completion.usage.prompt_tokens,
+                                         completion.usage.completion_tokens, get_cached_input_tokens(completion.usage))
+        return result
 
     def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
                   temp=0.0, max_output=None):
-        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
-        result = None
-        response_text = None
-        response_format = "json_object" if json_output else "text"
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
-                temperature=temp,
-                messages=[
-                    SystemMessage(content=system_prompt),
-                    UserMessage(content=prompt_text)
-                ],
-            )
-            result = completion.choices[0].message.content
-            response_dict = None
-            if json_output:
-                try:
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    continue
-            input_cost, output_cost = self.calculate_costs(completion.usage.prompt_tokens,
-                                                           completion.usage.completion_tokens)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-        if result is None and json_output:
-            raise LlmClientJSONFormatException(response_text)
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = self.get_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = await self.get_async_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
         return result
 
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["stream"] = True
+        stream = self.get_sdk_client().chat.completions.create(**args)
+        yield from chat_completion_stream_deltas(stream, stream_state)
+
 
 class GroqModel(LlmClient):
-    def __init__(self, model_name, max_input, rate_limiter, thread_pool=None, price_per_input_token=0.0,
+    api_key_name = "GROQ_API_KEY"
+    sdk_module_name = "groq"
+    endpoint_url = "https://api.groq.com"
+    # the API takes an n parameter but only accepts 1
+    max_samples_per_call = 1
+
+    def __init__(self, model_name, max_input, rate_limiter, provider_name=None, price_per_input_token=0.0,
                  price_per_output_token=0.0, system_role_supported=True):
-        super().__init__(model_name, max_input, rate_limiter, thread_pool, price_per_input_token, price_per_output_token)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token, price_per_output_token)
         self.client = None
+        self.async_client = None
         self.system_role_supported = system_role_supported
 
     def start(self):
-        key = get_api_key("GROQ_API_KEY")
-        self.client = Groq(api_key=key)
+        self.start_shared_clients()
+
+    def make_sdk_clients(self, api_key: ApiKey = None):
+        groq = import_sdk("groq")
+        api_key = self.resolve_api_key(api_key)
+        http_client = make_http_client()
+        client = groq.Groq(api_key=api_key.key, http_client=http_client, max_retries=0)
+        async_client = groq.AsyncGroq(api_key=api_key.key, http_client=make_async_http_client(), max_retries=0)
+        return client, async_client, http_client
+
+    def completion_args(self, prompt_text, system_prompt, json_output, temp, max_output):
+        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
+        if self.system_role_supported:
+            message_list = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt_text}
+            ]
+        else:
+            full_prompt = str(system_prompt) + "\n\n" + prompt_text
+            message_list = [
+                {"role": "user", "content": full_prompt}
+            ]
+        # json_schema is only on some Groq models, the schema is checked when the response is parsed
+        result = {
+            "model": self.model_name,
+            "response_format": chat_response_format(json_output, json_schema_supported=False),
+            "messages": message_list,
+            "temperature": temp,
+            "timeout": self.get_call_timeout()
+        }
+        if max_output is not None:
+            result["max_tokens"] = max_output
+        return result
+
+    def response_from_completion(self, completion, json_output):
+        response_text = completion.choices[0].message.content
+        result = self.response_from_text(response_text, json_output, completion.usage.prompt_tokens,
+                                         completion.usage.completion_tokens, get_cached_input_tokens(completion.usage))
+        return result
 
     def do_prompt(self, prompt_text, system_prompt="You are an expert at analyzing text.", json_output=False,
                   temp=0.0, max_output=None):
-        system_prompt = system_prompt if system_prompt is not None else "You are an expert at analyzing text."
-        result = None
-        response_text = None
-        response_format = "json_object" if json_output else "text"
-        # retries just for json format errors
-        for attempt in range(PROMPT_RETRIES):
-            if self.system_role_supported:
-                completion = self.client.chat.completions.create(
-                    model=self.model_name,
-                    response_format={"type": response_format},
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": prompt_text}
-                    ],
-                    temperature=temp
-                )
-            else:
-                full_prompt = str(system_prompt) + "\n\n" + prompt_text
-                completion = self.client.chat.completions.create(
-                    model=self.model_name,
-                    response_format={"type": response_format},
-                    messages=[
-                        {"role": "user", "content": full_prompt}
-                    ],
-                    temperature=temp
-                )
-            response_text = completion.choices[0].message.content
-            response_dict = None
-            if json_output:
-                try:
-                    response_text = fix_common_json_encoding_errors(response_text)
-                    response_dict = json.loads(response_text)
-                except Exception as e:
-                    continue
-            input_cost, output_cost = self.calculate_costs(completion.usage.prompt_tokens,
-                                                           completion.usage.completion_tokens)
-            result = LlmClientResponse(response_text, response_dict, input_cost, output_cost)
-        if result is None and json_output:
-            raise LlmClientJSONFormatException(response_text)
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = self.get_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
         return result
 
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0, max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        completion = await self.get_async_sdk_client().chat.completions.create(**args)
+        result = self.response_from_completion(completion, json_output)
+        return result
+
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        args = self.completion_args(prompt_text, system_prompt, json_output, temp, max_output)
+        args["stream"] = True
+        stream = self.get_sdk_client().chat.completions.create(**args)
+        yield from chat_completion_stream_deltas(stream, stream_state)
+
 
 # MIXTRAL tokenizer generates 20% more tokens than openai, so after reduce max_input to 80% of openai
-MINISTRAL_3B = MistralLlmClient("ministral-3b-latest", 12000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 0.04, 0.04)
-MINISTRAL_8B = MistralLlmClient("ministral-8b-latest", 12000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 0.10, 0.10)
-MISTRAL_7B = MistralLlmClient("open-mistral-7b", 12000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 0.25, 0.25)
-MISTRAL_NEMO_12B = MistralLlmClient("open-mistral-nemo-2407", 12000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 0.15, 0.15)
-MISTRAL_8X22B = MistralLlmClient("open-mixtral-8x22b", 8000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 2.0, 6.0)
-MISTRAL_SMALL = MistralLlmClient("mistral-small-2409", 24000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 0.2, 0.6)
-MISTRAL_8X7B = MistralLlmClient("open-mixtral-8x7b", 24000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 0.7, 0.7)
-MISTRAL_LARGE = MistralLlmClient("mistral-large-2407", 120000, MISTRAL_RATE_LIMITER, MISTRAL_THREAD_POOL, 2.0, 6.0)
-GPT3_5 = OpenAIModel('gpt-3.5-turbo-0125', 15000, BucketRateLimiter(10000), OPENAI_THREAD_POOL, 0.5, 1.5)
-GPT4 = OpenAIModel('gpt-4-turbo-2024-04-09', 120000, BucketRateLimiter(10000), OPENAI_THREAD_POOL, 10.0, 30.0)
-GPT4o = OpenAIModel('gpt-4o-2024-08-06', 120000, BucketRateLimiter(10000), OPENAI_THREAD_POOL, 2.5, 10.0)
-GPT4omini = OpenAIModel('gpt-4o-mini', 120000, BucketRateLimiter(10000), OPENAI_THREAD_POOL, 0.15, 0.60)
-ANTHROPIC_OPUS = AnthropicModel("claude-3-opus-20240229", 180000, BucketRateLimiter(240), ANTHROPIC_THREAD_POOL,
+MINISTRAL_3B = MistralLlmClient("ministral-3b-latest", 12000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 0.04, 0.04)
+MINISTRAL_8B = MistralLlmClient("ministral-8b-latest", 12000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 0.10, 0.10)
+MISTRAL_7B = MistralLlmClient("open-mistral-7b", 12000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 0.25, 0.25)
+MISTRAL_NEMO_12B = MistralLlmClient("open-mistral-nemo-2407", 12000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 0.15, 0.15)
+MISTRAL_8X22B = MistralLlmClient("open-mixtral-8x22b", 8000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 2.0, 6.0)
+MISTRAL_SMALL = MistralLlmClient("mistral-small-2409", 24000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 0.2, 0.6)
+MISTRAL_8X7B = MistralLlmClient("open-mixtral-8x7b", 24000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 0.7, 0.7)
+MISTRAL_LARGE = MistralLlmClient("mistral-large-2407", 120000, MISTRAL_RATE_LIMITER, MISTRAL_PROVIDER, 2.0, 6.0)
+GPT3_5 = OpenAIModel('gpt-3.5-turbo-0125', 15000, BucketRateLimiter(10000), OPENAI_PROVIDER, 0.5, 1.5)
+GPT4 = OpenAIModel('gpt-4-turbo-2024-04-09', 120000, BucketRateLimiter(10000), OPENAI_PROVIDER, 10.0, 30.0)
+GPT4o = OpenAIModel('gpt-4o-2024-08-06', 120000, BucketRateLimiter(10000), OPENAI_PROVIDER, 2.5, 10.0)
+GPT4omini = OpenAIModel('gpt-4o-mini', 120000, BucketRateLimiter(10000), OPENAI_PROVIDER, 0.15, 0.60)
+ANTHROPIC_OPUS = AnthropicModel("claude-3-opus-20240229", 180000, BucketRateLimiter(240), ANTHROPIC_PROVIDER,
                                 15.0, 75.0)
 ANTHROPIC_SONNET = AnthropicModel("claude-3-5-sonnet-20241022", 180000, BucketRateLimiter(480),
-                                  ANTHROPIC_THREAD_POOL, 3.0, 15.0)
-ANTHROPIC_HAIKU = AnthropicModel("claude-3-haiku-20240307", 180000, BucketRateLimiter(240), ANTHROPIC_THREAD_POOL,
+                                  ANTHROPIC_PROVIDER, 3.0, 15.0)
+ANTHROPIC_HAIKU = AnthropicModel("claude-3-haiku-20240307", 180000, BucketRateLimiter(240), ANTHROPIC_PROVIDER,
                                  0.25, 1.25)
 # DEEPSEEK = DeepseekModel("deepseek-chat", 24000, RateLlmiter(20, MINUTE_TIME_WINDOW), DEEPSEEK_EXECUTOR)
-OLD_GEMINI_FLASH = GeminiModel("gemini-1.5-flash", 120000, BucketRateLimiter(240), GEMINI_THREAD_POOL, 0.075, .35)
-GEMINI_FLASH_2 = GeminiModel("gemini-2.0-flash-exp", 120000, BucketRateLimiter(240), GEMINI_THREAD_POOL, 0.075, .35)
-GEMINI_FLASH = GeminiModel("gemini-1.5-flash-002", 120000, BucketRateLimiter(240), GEMINI_THREAD_POOL, 0.075, .35)
-GEMINI_FLASH_8B = GeminiModel("gemini-1.5-flash-8b", 120000, BucketRateLimiter(240), GEMINI_THREAD_POOL, 0.0375, .15)
-GEMINI_PRO = GeminiModel("gemini-1.5-pro", 120000, BucketRateLimiter(240), GEMINI_THREAD_POOL, 1.25, 2.50)
+OLD_GEMINI_FLASH = GeminiModel("gemini-1.5-flash", 120000, BucketRateLimiter(240), GEMINI_PROVIDER, 0.075, .35)
+GEMINI_FLASH_2 = GeminiModel("gemini-2.0-flash-exp", 120000, BucketRateLimiter(240), GEMINI_PROVIDER, 0.075, .35)
+GEMINI_FLASH = GeminiModel("gemini-1.5-flash-002", 120000, BucketRateLimiter(240), GEMINI_PROVIDER, 0.075, .35)
+GEMINI_FLASH_8B = GeminiModel("gemini-1.5-flash-8b", 120000, BucketRateLimiter(240), GEMINI_PROVIDER, 0.0375, .15)
+GEMINI_PRO = GeminiModel("gemini-1.5-pro", 120000, BucketRateLimiter(240), GEMINI_PROVIDER, 1.25, 2.50)
 FIREWORKS_LLAMA3_2_1B = FireworksAIModel("accounts/fireworks/models/llama-v3p2-1b-instruct", 120000,
-                                         FIREWORKS_RATE_LIMITER, FIREWORKS_THREAD_POOL, 0.10, 0.20)
+                                         FIREWORKS_RATE_LIMITER, FIREWORKS_PROVIDER, 0.10, 0.20)
 FIREWORKS_LLAMA3_2_3B = FireworksAIModel("accounts/fireworks/models/llama-v3p2-3b-instruct", 120000,
-                                         FIREWORKS_RATE_LIMITER, FIREWORKS_THREAD_POOL, 0.10, 0.20)
+                                         FIREWORKS_RATE_LIMITER, FIREWORKS_PROVIDER, 0.10, 0.20)
 FIREWORKS_LLAMA3_1_8B = FireworksAIModel("accounts/fireworks/models/llama-v3p1-8b-instruct", 120000,
-                                         FIREWORKS_RATE_LIMITER, FIREWORKS_THREAD_POOL, 0.20, 0.20)
+                                         FIREWORKS_RATE_LIMITER, FIREWORKS_PROVIDER, 0.20, 0.20)
 FIREWORKS_LLAMA3_1_405B = FireworksAIModel("accounts/fireworks/models/llama-v3p1-405b-instruct", 120000,
-                                           FIREWORKS_RATE_LIMITER, FIREWORKS_THREAD_POOL, 3.00, 3.00)
+                                           FIREWORKS_RATE_LIMITER, FIREWORKS_PROVIDER, 3.00, 3.00)
 FIREWORKS_LLAMA3_1_70B = FireworksAIModel("accounts/fireworks/models/llama-v3p1-70b-instruct", 120000,
-                                          FIREWORKS_RATE_LIMITER, FIREWORKS_THREAD_POOL, 0.90, 0.90)
+                                          FIREWORKS_RATE_LIMITER, FIREWORKS_PROVIDER, 0.90, 0.90)
 FIREWORKS_GEMMA2_9B = FireworksAIModel("accounts/fireworks/models/gemma2-9b-it", 7500, FIREWORKS_RATE_LIMITER,
-                                       FIREWORKS_THREAD_POOL, 0.20, 0.20, system_role_supported=False)
+                                       FIREWORKS_PROVIDER, 0.20, 0.20, system_role_supported=False)
 FIREWORKS_MYTHOMAXL2_13B = FireworksAIModel("accounts/fireworks/models/mythomax-l2-13b", 4000, FIREWORKS_RATE_LIMITER,
-                                            FIREWORKS_THREAD_POOL, 0.20, 0.20)
+                                            FIREWORKS_PROVIDER, 0.20, 0.20)
 FIREWORKS_QWEN2_72B = FireworksAIModel("accounts/fireworks/models/qwen2p5-72b-instruct", 32000, FIREWORKS_RATE_LIMITER,
-                                       FIREWORKS_THREAD_POOL, 0.90, 0.90)
+                                       FIREWORKS_PROVIDER, 0.90, 0.90)
 FIREWORKS_DEEPSEEK_V3 = FireworksAIModel("accounts/fireworks/models/deepseek-v3", 32000, FIREWORKS_RATE_LIMITER,
-                                       FIREWORKS_THREAD_POOL, 0.90, 0.90)
+                                       FIREWORKS_PROVIDER, 0.90, 0.90)
 TOMBU_LLAMA3_1_8B = FireworksAIModel("accounts/fireworks/models/llama-v3p1-8b-instruct#accounts/tombu-8c8576/deployments/ffdd8605", 120000,
-                                         TOMBU_RATE_LIMITER, TOMBU_THREAD_POOL, 0.20, 0.20)
+                                         TOMBU_RATE_LIMITER, TOMBU_PROVIDER, 0.20, 0.20)
 TOMBU_DOLPHIN_QWEN2_72B= FireworksAIModel("accounts/fireworks/models/dolphin-2-9-2-qwen2-72b#accounts/tombu-8c8576/deployments/39b81ca3", 120000,
-                                         TOMBU_RATE_LIMITER, TOMBU_THREAD_POOL, 0.20, 0.20)
+                                         TOMBU_RATE_LIMITER, TOMBU_PROVIDER, 0.20, 0.20)
 TOMBU_NEMO_12B= FireworksAIModel("accounts/fireworks/models/mistral-nemo-instruct-2407#accounts/tombu-8c8576/deployments/0fdd946e", 120000,
-                                         TOMBU_RATE_LIMITER, TOMBU_THREAD_POOL, 0.20, 0.20)
+                                         TOMBU_RATE_LIMITER, TOMBU_PROVIDER, 0.20, 0.20)
 GROQ_LLAMA3_1_70B= GroqModel("llama-3.1-70b-versatile", 120000,
-                                         BucketRateLimiter(100), GROQ_THREAD_POOL, 0.70, 0.70)
+                                         BucketRateLimiter(100), GROQ_PROVIDER, 0.70, 0.70)
 GROQ_LLAMA3_1_8B= GroqModel("llama-3.1-8b-instant", 120000,
-                                         BucketRateLimiter(30), GROQ_THREAD_POOL, 0.20, 0.20)
+                                         BucketRateLimiter(30), GROQ_PROVIDER, 0.20, 0.20)
 AI21_JAMBA_1_5_MINI = AI21Model("jamba-1.5-mini", 120000,
-                                AI21_RATE_LIMITER, AI21_THREAD_POOL,0.20, 0.40)
+                                AI21_RATE_LIMITER, AI21_PROVIDER,0.20, 0.40)
 AI21_JAMBA_1_5_LARGE = AI21Model("jamba-1.5-large", 120000,
-                                AI21_RATE_LIMITER, AI21_THREAD_POOL,2.00, 8.00)
+                                AI21_RATE_LIMITER, AI21_PROVIDER,2.00, 8.00)
+# equivalent deployments, a step that names the group gets whichever member is healthiest when it runs
+LLAMA3_1_8B_GROUP = add_llm_client_group(LlmClientGroup("llama-3.1-8b", [FIREWORKS_LLAMA3_1_8B, TOMBU_LLAMA3_1_8B,
+                                                                         GROQ_LLAMA3_1_8B]))
+MISTRAL_NEMO_12B_GROUP = add_llm_client_group(LlmClientGroup("mistral-nemo-12b", [MISTRAL_NEMO_12B, TOMBU_NEMO_12B]))
 ACTIVE_LLM_CLIENT_DICT = {}
 
 
-def init_llm_clients(data_directory="data"):
+# one client per endpoint is enough, the endpoint's models share its pool
+def prewarm_llm_clients(client_list, connection_count):
+    endpoint_client_dict = {}
+    for client in client_list:
+        if client.endpoint_url is not None:
+            endpoint_client_dict.setdefault(client.get_endpoint_key(), client)
+    for client in endpoint_client_dict.values():
+        try:
+            client.prewarm(connection_count)
+        except Exception as e:
+            print("Prewarm of " + client.model_name + " failed: " + str(e))
+
+
+def init_llm_clients(data_directory="data", pool_settings: HttpPoolSettings = None):
+    if pool_settings is not None:
+        set_http_pool_settings(pool_settings)
     log_directory = os.path.join(data_directory, "rate_llmiter_logs")
     client_list = LlmClient.get_all_clients()
     clients_with_keys = []
     missing_key_map = {}
+    # imported here because llmonpy_simulated builds on this module
+    from llmonpy.llmonpy_simulated import simulation_settings_from_environment, SimulatedLlmClient
+    simulation_settings = simulation_settings_from_environment()
+    if simulation_settings is not None:
+        print("Simulating all LLM clients")
+        simulated_rate_limiter = BucketRateLimiter(simulation_settings.requests_per_second, "SIMULATED")
+        for client in client_list:
+            simulated_client = SimulatedLlmClient.shadow_of(client, simulation_settings, simulated_rate_limiter)
+            ACTIVE_LLM_CLIENT_DICT[client.model_name] = simulated_client
+            clients_with_keys.append(simulated_client)
+        client_list = []
+    missing_sdk_map = {}
+    # clients only check for a key and an installed SDK here, each one starts the first time it is used
     for client in client_list:
         try:
-            client.start()
+            client.check_start_requirements()
+            client.load_api_keys()
             ACTIVE_LLM_CLIENT_DICT[client.model_name] = client
             clients_with_keys.append(client)
         except LLMonPyNoKeyForApiException as key_exception:
             missing_key_map[key_exception.api_key_name] = key_exception.api_key_name
             continue
+        except LLMonPyMissingSdkException as sdk_exception:
+            missing_sdk_map[sdk_exception.sdk_module_name] = sdk_exception.sdk_module_name
+            continue
     for key in missing_key_map:
         print("No key found for " + key)
+    for sdk_module_name in missing_sdk_map:
+        print("SDK not installed: " + sdk_module_name)
+    prewarm_connections = http_pool_settings().prewarm_connections
+    if prewarm_connections > 0 and simulation_settings is None:
+        prewarm_thread = threading.Thread(target=prewarm_llm_clients, args=(clients_with_keys, prewarm_connections),
+                                          daemon=True)
+        prewarm_thread.start()
     status_service = LLMClientStatusService(log_directory)
     status_service.start()
     add_service_to_stop(status_service)
@@ -931,8 +2510,29 @@ def filter_clients_that_didnt_start(client_list):
     return result
 
 
+# a group name resolves to its healthiest active member at call time
 def get_llm_client(model_name):
-    return ACTIVE_LLM_CLIENT_DICT[model_name]
+    group = get_llm_client_group(model_name)
+    if group is not None:
+        active_member_list = [ACTIVE_LLM_CLIENT_DICT[client.model_name] for client in group.get_client_list()
+                              if client.model_name in ACTIVE_LLM_CLIENT_DICT]
+        # members with an open circuit are passed over, unless every member's is open and the prompt fails fast
+        available_member_list = [client for client in active_member_list if client.is_available()]
+        if len(available_member_list) > 0:
+            active_member_list = available_member_list
+        result = group.select_client(active_member_list)
+    else:
+        result = ACTIVE_LLM_CLIENT_DICT[model_name]
+    return result
+
+
+# the fewest choices any client the name can resolve to returns from one request, 1 for a name that isn't active
+def get_max_samples_per_call(model_name):
+    group = get_llm_client_group(model_name)
+    name_list = [client.model_name for client in group.get_client_list()] if group is not None else [model_name]
+    client_list = [ACTIVE_LLM_CLIENT_DICT[name] for name in name_list if name in ACTIVE_LLM_CLIENT_DICT]
+    result = min([client.max_samples_per_call for client in client_list], default=1)
+    return result
 
 
 if __name__ == "__main__":
@@ -949,8 +2549,10 @@ if __name__ == "__main__":
     for client in ACTIVE_LLM_CLIENT_DICT.values():
         print("Testing " + client.model_name)
         try:
-            response = client.ratellmiter_is_llm_blocked()
-            print(client.model_name + "blocked: " + str(response))
+            client.ensure_started()
+            response = client.do_prompt("Hello? Respond with 'World'", "You are a helpful assistant", False,
+                                        temp=0.0, max_output=10)
+            print(client.model_name + " response: " + str(response.response_text))
             #response = client.prompt(str(uuid.uuid4()), TEST_PROMPT, json_output=True)
             #print(str(response.response_dict) + " input cost: " + str(response.input_cost) + " output cost: " + str(
             #    response.output_cost))
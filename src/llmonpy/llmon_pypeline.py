@@ -3,7 +3,9 @@ import copy
 import traceback
 
 from llmonpy.llmonpy_step import LLMonPyStep, TraceLogRecorderInterface, STEP_TYPE_PYPELINE, \
-    get_step_name_from_class_hierarchy, DEFAULT_TIMEOUT_TIME
+    get_step_name_from_class_hierarchy
+from llmonpy.llmonpy_budget import CostBudget
+from llmonpy.llmonpy_deadline import deadline_after, remaining_time, check_deadline
 from llmonpy.trace_log import trace_log_service
 
 
@@ -34,71 +36,56 @@ class LLMonPypeline:
         result = copy.copy(vars(self))
         return result
 
-    def create_step(self, parent_recorder: TraceLogRecorderInterface):
-        return LLMonPypelineRunner(parent_recorder, self)
+    # budget_usd caps what this step and every step below it can spend, see CostBudget.  timeout is the seconds from
+    # now this step and every step below it have to finish in, see llmonpy_deadline.
+    def create_step(self, parent_recorder: TraceLogRecorderInterface, budget_usd=None, timeout=None):
+        result = LLMonPypelineRunner(parent_recorder, self)
+        if budget_usd is not None:
+            result.get_recorder().set_cost_budget(CostBudget(budget_usd))
+        if timeout is not None:
+            result.get_recorder().set_deadline(deadline_after(timeout))
+        return result
+
+    # how many of prompt_count prompts the cost budget is expected to cover, all of them when there is no budget
+    def get_affordable_prompt_count(self, recorder: TraceLogRecorderInterface, prompt_count):
+        cost_budget = recorder.get_cost_budget()
+        result = cost_budget.get_affordable_prompt_count(prompt_count) if cost_budget is not None else prompt_count
+        return result
 
-    # step are returned in the order they complete, not the order they were submitted.  Also, if a step timesout, it
-    # will be retried once.  If it fails again, it will not be included in the result list.
-    # this does not work because the TimeoutError is caught at the highest level, not at the level the exception is
-    # thrown.
-    '''def run_parallel_steps_with_retry(self, step_list, timeout_time=DEFAULT_TIMEOUT_TIME, handle_result_function=None):
+    # steps are returned in the order they complete, not the order they were submitted.  When the steps have a
+    # deadline, the ones that haven't finished by it are left out of the result: queued steps are cancelled and
+    # running ones are given up on, their own calls time out at the same deadline.
+    def run_parallel_steps(self, step_list, handle_result_function=None):
         future_list = []
         result_dict = {}
-        timeout_exception = None
+        deadline_list = []
         for step in step_list:
             future = step.get_thread_pool().submit(step.record_step)
+            cost_budget = step.get_recorder().get_cost_budget()
+            if cost_budget is not None:
+                cost_budget.track_future(future)
             future_list.append(future)
-        for future in concurrent.futures.as_completed(future_list, timeout=timeout_time):
-            try:
-                returned_step = future.result()
-                result_dict[returned_step.get_step_id()] = returned_step
-                if handle_result_function is not None:
-                    handle_result_function(returned_step)
-            except TimeoutError as te:
-                timeout_exception = te
-                print("TimeoutError")
-            except Exception as e:
-                print(str(e)) # exception was logged in record_step
-                pass
-        if len(result_dict) < len(step_list):
-            retry_list = []
-            for step in step_list:
-                if step.get_step_id() not in result_dict:
-                    step.get_recorder().log_exception(timeout_exception)
-                    retry_list.append(step)
-            print("Retrying steps that timed out " + str(len(retry_list)))
-            for step in retry_list:
-                future = step.get_thread_pool().submit(step.retry_step)
-                future_list.append(future)
-            for future in concurrent.futures.as_completed(future_list, timeout=(timeout_time * 2)):
+            deadline_list.append(step.get_recorder().get_deadline())
+        deadline = max(deadline_list) if len(deadline_list) > 0 and None not in deadline_list else None
+        try:
+            for future in concurrent.futures.as_completed(future_list, timeout=remaining_time(deadline)):
                 try:
                     returned_step = future.result()
                     result_dict[returned_step.get_step_id()] = returned_step
                     if handle_result_function is not None:
                         handle_result_function(returned_step)
+                except concurrent.futures.CancelledError:
+                    pass  # cancelled by the cost budget or the deadline before it started
                 except Exception as e:
-                    print(str(e))
+                    stack_trace = traceback.format_exc()
+                    print(stack_trace)
+                    print(str(e)) # exception was logged in record_step
                     pass
-        result_list = list(result_dict.values())
-        return result_list'''
-
-    def run_parallel_steps(self, step_list, handle_result_function=None):
-        future_list = []
-        result_dict = {}
-        for step in step_list:
-            future = step.get_thread_pool().submit(step.record_step)
-            future_list.append(future)
-        for future in concurrent.futures.as_completed(future_list):
-            try:
-                returned_step = future.result()
-                result_dict[returned_step.get_step_id()] = returned_step
-                if handle_result_function is not None:
-                    handle_result_function(returned_step)
-            except Exception as e:
-                stack_trace = traceback.format_exc()
-                print(stack_trace)
-                print(str(e)) # exception was logged in record_step
-                pass
+        except concurrent.futures.TimeoutError:
+            CostBudget.cancel_futures(future_list)
+            running_count = len([future for future in future_list if future.done() is False])
+            print("Deadline passed, " + str(len(future_list) - len(result_dict)) + " steps left out, " +
+                  str(running_count) + " still running")
         result_list = list(result_dict.values())
         return result_list
 
@@ -127,6 +114,7 @@ class LLMonPypelineRunner(LLMonPyStep):
     def execute_step(self):
         result = None
         try:
+            check_deadline(self.get_recorder().get_deadline())
             result = self.pypeline.execute_step(self.get_recorder())
         except Exception as e:
             self.get_recorder().log_exception(e)
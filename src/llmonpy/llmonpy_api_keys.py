@@ -0,0 +1,145 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import contextvars
+import hashlib
+import threading
+import time
+
+from llmonpy.llmonpy_retry import classify_exception, get_status_code, ERROR_CLASS_RATE_LIMIT
+
+AUTH_FAILURE_STATUS_CODE_SET = {401, 403}
+KEY_RATE_LIMIT_BENCH_COUNT = 3  # rate limits in a row before a key is taken out of rotation
+KEY_BENCH_TIME = 60.0  # seconds
+
+
+class ApiKey:
+    def __init__(self, key, requests_per_minute, organization=None, label=None):
+        self.key = key
+        self.requests_per_minute = requests_per_minute
+        self.organization = organization
+        self.label = label
+
+    # safe to log, the key itself never is
+    def get_label(self):
+        result = self.label if self.label is not None else "..." + self.key[-4:]
+        return result
+
+    def get_key_id(self):
+        key_string = self.key + "|" + str(self.organization)
+        result = hashlib.sha256(key_string.encode("utf-8")).hexdigest()[:16]
+        return result
+
+
+# "key1,key2:org-id" gives two keys, the second one for an organization
+def parse_api_key_list(key_list_text, requests_per_minute):
+    result = []
+    for entry in key_list_text.split(","):
+        entry = entry.strip()
+        if len(entry) > 0:
+            key, _, organization = entry.partition(":")
+            result.append(ApiKey(key, requests_per_minute, organization if len(organization) > 0 else None))
+    return result
+
+
+class ApiKeyShard:
+    def __init__(self, api_key: ApiKey, rate_limiter):
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter
+        self.sdk_clients = None  # (client, async_client, http_client), made the first time the key is used
+        self.in_flight_count = 0
+        self.rate_limit_count = 0
+        self.benched_until = 0.0
+        self.auth_failed = False
+
+    def is_usable(self, current_time):
+        result = self.auth_failed is False and self.benched_until <= current_time
+        return result
+
+    def to_dict(self):
+        result = {"label": self.api_key.get_label(), "in_flight_count": self.in_flight_count,
+                  "rate_limit_count": self.rate_limit_count, "benched_until": self.benched_until,
+                  "auth_failed": self.auth_failed}
+        return result
+
+
+"""
+  ApiKeyPool spreads one client's calls over several API keys or organizations, each with its own ratellmiter
+  bucket, so a client can go past the rate limit of a single key.  Each attempt takes the usable key with the fewest
+  calls in flight.  A key that is rate limited several times in a row is benched for a while, and one that fails to
+  authenticate is taken out of rotation for good.  When no key is usable the one that comes back first is used.
+"""
+
+CURRENT_API_KEY_SHARD = contextvars.ContextVar("llmonpy_api_key_shard", default=None)
+
+
+class ApiKeyPool:
+    def __init__(self, service_name, shard_list: [ApiKeyShard]):
+        self.service_name = service_name
+        self.shard_list = shard_list
+        self.pool_lock = threading.Lock()
+        self.next_index = 0
+
+    def get_shard_list(self):
+        return self.shard_list
+
+    def acquire(self) -> ApiKeyShard:
+        current_time = time.time()
+        with self.pool_lock:
+            shard_count = len(self.shard_list)
+            # ties go round robin, so idle keys all get used
+            rotated_list = [self.shard_list[(self.next_index + i) % shard_count] for i in range(shard_count)]
+            self.next_index = (self.next_index + 1) % shard_count
+            usable_list = [shard for shard in rotated_list if shard.is_usable(current_time)]
+            if len(usable_list) > 0:
+                result = min(usable_list, key=lambda shard: (shard.in_flight_count, shard.rate_limit_count))
+            else:
+                result = min(rotated_list, key=lambda shard: (shard.auth_failed, shard.benched_until))
+            result.in_flight_count += 1
+        return result
+
+    def release(self, shard: ApiKeyShard):
+        with self.pool_lock:
+            shard.in_flight_count -= 1
+
+    def record_success(self, shard: ApiKeyShard):
+        with self.pool_lock:
+            shard.rate_limit_count = 0
+
+    def record_error(self, shard: ApiKeyShard, exception):
+        if get_status_code(exception) in AUTH_FAILURE_STATUS_CODE_SET:
+            with self.pool_lock:
+                shard.auth_failed = True
+            print("API key " + shard.api_key.get_label() + " of " + self.service_name +
+                  " taken out of rotation: " + str(exception))
+        elif classify_exception(exception) == ERROR_CLASS_RATE_LIMIT:
+            with self.pool_lock:
+                shard.rate_limit_count += 1
+                benched = shard.rate_limit_count >= KEY_RATE_LIMIT_BENCH_COUNT
+                if benched:
+                    shard.benched_until = time.time() + KEY_BENCH_TIME
+                    shard.rate_limit_count = 0
+            if benched:
+                print("API key " + shard.api_key.get_label() + " of " + self.service_name + " benched for " +
+                      str(KEY_BENCH_TIME) + " seconds after repeated rate limits")
+
+    def to_dict(self):
+        with self.pool_lock:
+            result = {"service_name": self.service_name,
+                      "shard_list": [shard.to_dict() for shard in self.shard_list]}
+        return result
+
+
+def get_current_api_key_shard():
+    return CURRENT_API_KEY_SHARD.get()
@@ -0,0 +1,177 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import concurrent.futures
+import threading
+
+from llmonpy.llmonpy_deadline import check_deadline, remaining_time
+from llmonpy.llmonpy_scheduler import llmonpy_scheduler
+
+
+class LLMonPyBudgetExceededException(Exception):
+    def __init__(self, budget_usd, spent_usd, estimated_cost):
+        super().__init__("Cost budget of $" + str(budget_usd) + " exceeded, spent: $" + str(round(spent_usd, 6)) +
+                         " next prompt estimated at: $" + str(round(estimated_cost, 6)))
+        self.budget_usd = budget_usd
+        self.spent_usd = spent_usd
+        self.estimated_cost = estimated_cost
+
+
+class BudgetReservation:
+    def __init__(self, cost_budget, estimated_cost):
+        self.cost_budget = cost_budget
+        self.estimated_cost = estimated_cost
+        self.settled = False
+
+    # replace the estimate with what the prompt actually cost
+    def settle(self, actual_cost):
+        if self.settled is False:
+            self.settled = True
+            self.cost_budget.settle(self, actual_cost)
+
+    # the prompt failed, so it isn't counted
+    def release(self):
+        self.settle(0.0)
+
+
+"""
+  CostBudget caps what one trace can spend.  It is attached to the recorder of a root step with
+  create_step(None, budget_usd=...) and every prompt below that step reserves its estimated cost before it is sent.
+  When the reservation doesn't fit next to what is already spent and reserved, the prompt waits for the ones in flight
+  to settle, since estimates assume the full output reservation and usually come in high.  Once even the settled
+  spend leaves no room the budget is exhausted: the prompt is rejected with LLMonPyBudgetExceededException, every step
+  still queued for the trace is cancelled and no new prompt is accepted.  Pipelines call get_affordable_prompt_count
+  before a round of prompts so they can shrink it instead of having most of it rejected.
+"""
+
+
+class CostBudget:
+    def __init__(self, budget_usd):
+        self.budget_usd = budget_usd
+        self.budget_condition = threading.Condition()
+        self.spent_usd = 0.0
+        self.reserved_usd = 0.0
+        self.reserved_count = 0
+        self.settled_count = 0
+        self.exhausted = False
+        self.pending_future_set = set()
+
+    # a prompt waiting for room gives up with LLMonPyDeadlineExceededException when its deadline passes
+    def reserve(self, estimated_cost, deadline=None) -> BudgetReservation:
+        cancel_list = None
+        with self.budget_condition:
+            while (self.exhausted is False and self.reserved_count > 0 and
+                   self.spent_usd + self.reserved_usd + estimated_cost > self.budget_usd):
+                if self.spent_usd + estimated_cost > self.budget_usd:
+                    self.unsafe_set_exhausted()
+                else:
+                    check_deadline(deadline, "Budget reservation")
+                    self.budget_condition.wait(remaining_time(deadline))
+            if self.exhausted is False and self.spent_usd + self.reserved_usd + estimated_cost > self.budget_usd:
+                self.unsafe_set_exhausted()
+            if self.exhausted:
+                cancel_list = list(self.pending_future_set)
+                self.pending_future_set.clear()
+                spent_usd = self.spent_usd
+            else:
+                self.reserved_usd += estimated_cost
+                self.reserved_count += 1
+        if cancel_list is not None:
+            self.cancel_futures(cancel_list)
+            raise LLMonPyBudgetExceededException(self.budget_usd, spent_usd, estimated_cost)
+        result = BudgetReservation(self, estimated_cost)
+        return result
+
+    def unsafe_set_exhausted(self):
+        self.exhausted = True
+        self.budget_condition.notify_all()
+
+    def settle(self, reservation: BudgetReservation, actual_cost):
+        with self.budget_condition:
+            self.reserved_usd -= reservation.estimated_cost
+            self.reserved_count -= 1
+            self.spent_usd += actual_cost
+            self.settled_count += 1
+            self.budget_condition.notify_all()
+
+    # spend that was never reserved, like the losing request of a hedged prompt
+    def charge(self, cost):
+        with self.budget_condition:
+            self.spent_usd += cost
+            self.budget_condition.notify_all()
+
+    # futures of steps that haven't started yet are cancelled when the budget runs out
+    def track_future(self, future: concurrent.futures.Future):
+        with self.budget_condition:
+            exhausted = self.exhausted
+            if exhausted is False:
+                self.pending_future_set.add(future)
+        if exhausted:
+            self.cancel_futures([future])
+        else:
+            future.add_done_callback(self.untrack_future)
+
+    def untrack_future(self, future: concurrent.futures.Future):
+        with self.budget_condition:
+            self.pending_future_set.discard(future)
+
+    @staticmethod
+    def cancel_futures(future_list):
+        for future in future_list:
+            future.cancel()
+        scheduler = llmonpy_scheduler()
+        if scheduler is not None:
+            scheduler.discard_cancelled_tasks()
+
+    def is_exhausted(self):
+        with self.budget_condition:
+            result = self.exhausted
+        return result
+
+    def get_spent(self):
+        with self.budget_condition:
+            result = self.spent_usd
+        return result
+
+    def get_remaining(self):
+        with self.budget_condition:
+            result = max(self.budget_usd - self.spent_usd - self.reserved_usd, 0.0)
+        return result
+
+    # settled prompts are the better guide, before any settle the estimates are all there is
+    def get_average_prompt_cost(self):
+        with self.budget_condition:
+            if self.settled_count > 0:
+                result = self.spent_usd / self.settled_count
+            elif self.reserved_count > 0:
+                result = self.reserved_usd / self.reserved_count
+            else:
+                result = None
+        return result
+
+    def get_affordable_prompt_count(self, prompt_count):
+        average_prompt_cost = self.get_average_prompt_cost()
+        if self.is_exhausted():
+            result = 0
+        elif average_prompt_cost is None or average_prompt_cost <= 0.0:
+            result = prompt_count
+        else:
+            result = min(prompt_count, int(self.get_remaining() / average_prompt_cost))
+        return result
+
+    def to_dict(self):
+        with self.budget_condition:
+            result = {"budget_usd": self.budget_usd, "spent_usd": self.spent_usd, "reserved_usd": self.reserved_usd,
+                      "exhausted": self.exhausted}
+        return result
@@ -0,0 +1,156 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_CACHE_TTL = 30 * 24 * 60 * 60  # seconds, None means entries never expire
+CACHE_FILE_NAME = "response_cache.db"
+CACHE_TABLE_NAME = "response_cache"
+
+"""
+  Content addressed store for LLM responses.  Keys are computed by the caller (see LlmClient.make_prompt_key), values
+  are the dict form of an LlmClientResponse.  Eviction is LRU on last access, bounded by total bytes, and entries older
+  than ttl_seconds are dropped when they are read or when the cache is over its size bound.
+"""
+
+
+class SqliteLLMonPyResponseCache:
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(SqliteLLMonPyResponseCache, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, data_directory, max_bytes=DEFAULT_CACHE_MAX_BYTES, ttl_seconds=DEFAULT_CACHE_TTL):
+        self.database_path = os.path.join(data_directory, CACHE_FILE_NAME)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.cache_lock = threading.Lock()
+        self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        self.hit_count = 0
+        self.miss_count = 0
+        self.create_table()
+        self.total_bytes = self.read_total_bytes()
+
+    def create_table(self):
+        with self.cache_lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS " + CACHE_TABLE_NAME +
+                                    " (cache_key TEXT PRIMARY KEY, json_string TEXT, size INTEGER, "
+                                    "created_time REAL, last_access_time REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS " + CACHE_TABLE_NAME + "_last_access_index ON " +
+                                    CACHE_TABLE_NAME + " (last_access_time)")
+            self.connection.commit()
+
+    def read_total_bytes(self):
+        with self.cache_lock:
+            row = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM " + CACHE_TABLE_NAME).fetchone()
+        return row[0]
+
+    def stop(self):
+        with self.cache_lock:
+            self.connection.close()
+
+    def is_expired(self, created_time, current_time):
+        result = self.ttl_seconds is not None and (current_time - created_time) > self.ttl_seconds
+        return result
+
+    def get(self, cache_key):
+        result = None
+        current_time = time.time()
+        with self.cache_lock:
+            row = self.connection.execute("SELECT json_string, size, created_time FROM " + CACHE_TABLE_NAME +
+                                          " WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row is not None and self.is_expired(row[2], current_time):
+                self.unsafe_delete(cache_key, row[1])
+                self.connection.commit()
+                row = None
+            if row is not None:
+                self.connection.execute("UPDATE " + CACHE_TABLE_NAME + " SET last_access_time = ? WHERE cache_key = ?",
+                                        (current_time, cache_key))
+                self.connection.commit()
+                result = json.loads(row[0])
+                self.hit_count += 1
+            else:
+                self.miss_count += 1
+        return result
+
+    def put(self, cache_key, value_dict):
+        json_string = json.dumps(value_dict)
+        size = len(json_string)
+        current_time = time.time()
+        with self.cache_lock:
+            row = self.connection.execute("SELECT size FROM " + CACHE_TABLE_NAME + " WHERE cache_key = ?",
+                                          (cache_key,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.connection.execute("INSERT OR REPLACE INTO " + CACHE_TABLE_NAME +
+                                    " (cache_key, json_string, size, created_time, last_access_time) "
+                                    "VALUES (?, ?, ?, ?, ?)", (cache_key, json_string, size, current_time,
+                                                               current_time))
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.unsafe_evict(current_time)
+            self.connection.commit()
+
+    def unsafe_delete(self, cache_key, size):
+        self.connection.execute("DELETE FROM " + CACHE_TABLE_NAME + " WHERE cache_key = ?", (cache_key,))
+        self.total_bytes -= size
+
+    def unsafe_evict(self, current_time):
+        if self.ttl_seconds is not None:
+            expired_time = current_time - self.ttl_seconds
+            self.connection.execute("DELETE FROM " + CACHE_TABLE_NAME + " WHERE created_time < ?", (expired_time,))
+            self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM " +
+                                                       CACHE_TABLE_NAME).fetchone()[0]
+        # evict down to 90% so a full cache doesn't evict on every put
+        target_bytes = int(self.max_bytes * 0.9)
+        cursor = self.connection.execute("SELECT cache_key, size FROM " + CACHE_TABLE_NAME +
+                                         " ORDER BY last_access_time ASC")
+        eviction_list = []
+        bytes_to_free = self.total_bytes - target_bytes
+        for cache_key, size in cursor:
+            if bytes_to_free <= 0:
+                break
+            eviction_list.append((cache_key,))
+            bytes_to_free -= size
+            self.total_bytes -= size
+        cursor.close()
+        self.connection.executemany("DELETE FROM " + CACHE_TABLE_NAME + " WHERE cache_key = ?", eviction_list)
+
+    def clear(self):
+        with self.cache_lock:
+            self.connection.execute("DELETE FROM " + CACHE_TABLE_NAME)
+            self.connection.commit()
+            self.total_bytes = 0
+
+    @staticmethod
+    def get_instance():
+        return SqliteLLMonPyResponseCache._instance
+
+
+def init_response_cache(data_directory, max_bytes=DEFAULT_CACHE_MAX_BYTES, ttl_seconds=DEFAULT_CACHE_TTL):
+    result = SqliteLLMonPyResponseCache(data_directory, max_bytes, ttl_seconds)
+    return result
+
+
+def llmonpy_response_cache() -> SqliteLLMonPyResponseCache:
+    result = SqliteLLMonPyResponseCache.get_instance()
+    return result
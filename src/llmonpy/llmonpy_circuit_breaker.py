@@ -0,0 +1,208 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import threading
+import time
+from collections import deque
+
+from llmonpy.llmonpy_retry import ERROR_CLASS_CIRCUIT_OPEN, ERROR_CLASS_SERVER, ERROR_CLASS_TIMEOUT, \
+    ERROR_CLASS_UNKNOWN
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+CIRCUIT_STATE_LIST = [CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN]
+# rate limits, client errors and unusable responses mean the provider is up, they don't count against it
+CIRCUIT_FAILURE_CLASS_SET = {ERROR_CLASS_SERVER, ERROR_CLASS_TIMEOUT, ERROR_CLASS_UNKNOWN}
+
+DEFAULT_CIRCUIT_WINDOW = 20  # recent provider calls the failure rate is taken over
+DEFAULT_CIRCUIT_MIN_CALLS = 10
+DEFAULT_FAILURE_RATE_THRESHOLD = 0.5
+DEFAULT_OPEN_DURATION = 30.0  # seconds
+DEFAULT_MAX_OPEN_DURATION = 300.0
+
+
+class LLMonPyCircuitOpenException(Exception):
+    def __init__(self, service_name, retry_after):
+        super().__init__("Circuit for " + str(service_name) + " is open, next trial in " +
+                         str(round(retry_after, 1)) + " seconds")
+        self.service_name = service_name
+        self.retry_after = retry_after
+        self.error_class = ERROR_CLASS_CIRCUIT_OPEN
+
+
+class CircuitBreakerPolicy:
+    def __init__(self, window_size=DEFAULT_CIRCUIT_WINDOW, min_calls=DEFAULT_CIRCUIT_MIN_CALLS,
+                 failure_rate_threshold=DEFAULT_FAILURE_RATE_THRESHOLD, slow_call_threshold=None,
+                 open_duration=DEFAULT_OPEN_DURATION, max_open_duration=DEFAULT_MAX_OPEN_DURATION,
+                 open_duration_multiplier=2.0):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        # seconds, a call that takes longer counts as a failure.  None only counts calls that time out.
+        self.slow_call_threshold = slow_call_threshold
+        self.open_duration = open_duration
+        self.max_open_duration = max_open_duration
+        # each failed trial keeps the circuit open this much longer than the last time
+        self.open_duration_multiplier = open_duration_multiplier
+
+    def is_failure(self, error_class):
+        result = error_class in CIRCUIT_FAILURE_CLASS_SET
+        return result
+
+    def is_slow(self, latency):
+        result = self.slow_call_threshold is not None and latency is not None and latency > self.slow_call_threshold
+        return result
+
+    def should_open(self, outcome_list):
+        result = False
+        if len(outcome_list) >= self.min_calls:
+            failure_count = len([succeeded for succeeded in outcome_list if succeeded is False])
+            result = failure_count / len(outcome_list) >= self.failure_rate_threshold
+        return result
+
+    def get_next_open_duration(self, open_duration):
+        result = self.open_duration
+        if open_duration is not None:
+            result = min(open_duration * self.open_duration_multiplier, self.max_open_duration)
+        return result
+
+
+DEFAULT_CIRCUIT_BREAKER_POLICY = CircuitBreakerPolicy()
+
+
+def default_circuit_breaker_policy() -> CircuitBreakerPolicy:
+    return DEFAULT_CIRCUIT_BREAKER_POLICY
+
+
+def set_default_circuit_breaker_policy(policy: CircuitBreakerPolicy):
+    global DEFAULT_CIRCUIT_BREAKER_POLICY
+    DEFAULT_CIRCUIT_BREAKER_POLICY = policy
+
+
+"""
+  CircuitBreaker keeps a client from sending work to a provider that is failing.  It only watches real traffic:
+  every provider call that answers is recorded as a success, or as a failure when it was slower than the policy
+  allows, and every attempt that ends in a server error, timeout or connection error as a failure.  When the failure
+  rate over the recent calls crosses the threshold the circuit opens, and attempts fail at once with
+  LLMonPyCircuitOpenException instead of waiting on the provider.  When the open time is up the circuit is half open:
+  the next attempt is let through as the trial while everything else still fails fast.  A trial that succeeds closes
+  the circuit, one that fails opens it again for longer.
+"""
+
+
+class CircuitBreaker:
+    def __init__(self, service_name, policy: CircuitBreakerPolicy = None):
+        self.service_name = service_name
+        self.policy = policy
+        self.breaker_lock = threading.Lock()
+        self.state = CIRCUIT_CLOSED
+        self.outcome_queue = deque()
+        self.open_until = 0.0
+        self.open_duration = None
+        self.trial_in_flight = False
+        self.open_count = 0
+
+    def get_policy(self) -> CircuitBreakerPolicy:
+        result = self.policy if self.policy is not None else default_circuit_breaker_policy()
+        return result
+
+    def set_policy(self, policy: CircuitBreakerPolicy):
+        self.policy = policy
+
+    # called before each attempt, raises LLMonPyCircuitOpenException unless the attempt may go to the provider
+    def before_call(self):
+        with self.breaker_lock:
+            if self.state == CIRCUIT_OPEN and time.time() >= self.open_until:
+                self.state = CIRCUIT_HALF_OPEN
+            if self.state == CIRCUIT_HALF_OPEN and self.trial_in_flight is False:
+                self.trial_in_flight = True
+            elif self.state != CIRCUIT_CLOSED:
+                raise LLMonPyCircuitOpenException(self.service_name, max(self.open_until - time.time(), 0.0))
+
+    # the provider answered, latency is the time of the call alone
+    def record_call(self, latency=None):
+        policy = self.get_policy()
+        self.record_outcome(policy.is_slow(latency) is False, policy)
+
+    # an attempt failed, only the failures that say the provider is unwell are counted
+    def record_error(self, error_class):
+        policy = self.get_policy()
+        if policy.is_failure(error_class):
+            self.record_outcome(False, policy)
+        else:
+            with self.breaker_lock:
+                self.trial_in_flight = False
+
+    def record_outcome(self, succeeded, policy: CircuitBreakerPolicy):
+        with self.breaker_lock:
+            if self.state == CIRCUIT_HALF_OPEN:
+                if succeeded:
+                    self.unsafe_close()
+                else:
+                    self.unsafe_open(policy)
+            elif self.state == CIRCUIT_CLOSED:
+                self.outcome_queue.append(succeeded)
+                while len(self.outcome_queue) > policy.window_size:
+                    self.outcome_queue.popleft()
+                if policy.should_open(self.outcome_queue):
+                    self.unsafe_open(policy)
+
+    def unsafe_open(self, policy: CircuitBreakerPolicy):
+        self.open_duration = policy.get_next_open_duration(self.open_duration)
+        self.open_until = time.time() + self.open_duration
+        self.state = CIRCUIT_OPEN
+        self.trial_in_flight = False
+        self.outcome_queue.clear()
+        self.open_count += 1
+        print("Circuit for " + str(self.service_name) + " opened for " + str(round(self.open_duration, 1)) +
+              " seconds")
+
+    def unsafe_close(self):
+        self.state = CIRCUIT_CLOSED
+        self.open_duration = None
+        self.trial_in_flight = False
+        print("Circuit for " + str(self.service_name) + " closed")
+
+    def get_state(self):
+        with self.breaker_lock:
+            result = self.state
+            if result == CIRCUIT_OPEN and time.time() >= self.open_until:
+                result = CIRCUIT_HALF_OPEN
+        return result
+
+    def is_open(self):
+        result = self.get_state() == CIRCUIT_OPEN
+        return result
+
+    # True when an attempt made now would reach the provider
+    def is_available(self):
+        with self.breaker_lock:
+            result = (self.state == CIRCUIT_CLOSED or
+                      (self.state == CIRCUIT_OPEN and time.time() >= self.open_until) or
+                      (self.state == CIRCUIT_HALF_OPEN and self.trial_in_flight is False))
+        return result
+
+    def get_open_count(self):
+        with self.breaker_lock:
+            result = self.open_count
+        return result
+
+    def to_dict(self):
+        state = self.get_state()
+        with self.breaker_lock:
+            result = {"service_name": self.service_name, "state": state, "open_count": self.open_count,
+                      "retry_after": max(self.open_until - time.time(), 0.0) if state == CIRCUIT_OPEN else 0.0,
+                      "recent_call_count": len(self.outcome_queue)}
+        return result
@@ -0,0 +1,95 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import contextvars
+import time
+
+from llmonpy.llmonpy_retry import ERROR_CLASS_DEADLINE
+
+DEFAULT_CALL_TIMEOUT = 600.0  # seconds a provider call is given when its step has no deadline
+
+
+class LLMonPyDeadlineExceededException(Exception):
+    def __init__(self, deadline, what="Step"):
+        super().__init__(what + " passed its deadline " + str(round(time.time() - deadline, 3)) + " seconds ago")
+        self.deadline = deadline
+        self.error_class = ERROR_CLASS_DEADLINE
+
+
+"""
+  A deadline is an absolute time.time() a step has to be done by.  It is set on a step's recorder with
+  create_step(..., timeout=...) and covers every step below it, a child can only make it tighter.  Each attempt of a
+  prompt runs with the deadline in CALL_DEADLINE, so the client gives the SDK whatever time is left as the call's
+  timeout instead of letting a hung socket wait forever.
+"""
+
+CALL_DEADLINE = contextvars.ContextVar("llmonpy_call_deadline", default=None)
+
+
+def deadline_after(seconds):
+    result = time.time() + seconds if seconds is not None else None
+    return result
+
+
+def earliest_deadline(deadline, other_deadline):
+    if deadline is None:
+        result = other_deadline
+    elif other_deadline is None:
+        result = deadline
+    else:
+        result = min(deadline, other_deadline)
+    return result
+
+
+# None when there is no deadline, never less than zero
+def remaining_time(deadline):
+    result = max(deadline - time.time(), 0.0) if deadline is not None else None
+    return result
+
+
+def check_deadline(deadline, what="Step"):
+    if deadline is not None and time.time() >= deadline:
+        raise LLMonPyDeadlineExceededException(deadline, what)
+
+
+def get_call_deadline():
+    return CALL_DEADLINE.get()
+
+
+# the time left for the current call, default_timeout when it has no deadline or the default is sooner
+def remaining_call_time(default_timeout=None):
+    result = remaining_time(CALL_DEADLINE.get())
+    if result is None or (default_timeout is not None and default_timeout < result):
+        result = default_timeout
+    return result
+
+
+def run_before_deadline(deadline, function):
+    check_deadline(deadline, "Prompt")
+    token = CALL_DEADLINE.set(deadline)
+    try:
+        result = function()
+    finally:
+        CALL_DEADLINE.reset(token)
+    return result
+
+
+async def arun_before_deadline(deadline, coroutine_function):
+    check_deadline(deadline, "Prompt")
+    token = CALL_DEADLINE.set(deadline)
+    try:
+        result = await coroutine_function()
+    finally:
+        CALL_DEADLINE.reset(token)
+    return result
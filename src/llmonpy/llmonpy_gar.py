@@ -36,6 +36,10 @@ class GenerateAggregateRankStep(LLMonPypeline):
         step_output_list = [judged_output.step_output for judged_output in judged_output_list]
         recorder.set_step_examples(self.generation_prompt.get_step_name(), step_output_list)
         for i in range(0, self.repeat_aggregation_layer):
+            aggregation_count = len(self.aggregation_model_info_list)
+            if self.get_affordable_prompt_count(recorder, aggregation_count) < aggregation_count:
+                recorder.log_message("aggregation layer " + str(i) + " skipped, cost budget too low")
+                break
             generate_step = TournamentResponseGenerator(self.generation_prompt, self.aggregation_model_info_list).create_step(recorder)
             generate_step.record_step()
             judged_output_list = generate_step.get_step_output().response_list
@@ -89,6 +93,9 @@ class GenerateAggregateRankCycleStep(LLMonPypeline):
         first_round_result_list = gar.get_step_output().ordered_response_list
         self.update_example_list(first_round_result_list, recorder)
         for i in range(1, self.max_cycles):
+            if self.get_affordable_prompt_count(recorder, len(self.generation_model_info_list)) == 0:
+                recorder.log_message("cycle " + str(i) + " skipped, cost budget exhausted")
+                break
             gar = GenerateAggregateRankStep(self.generation_prompt, self.generation_model_info_list,
                                                self.aggregation_model_info_list, 1,
                                        self.judgement_prompt, self.judgement_model_info_list).create_step(recorder)
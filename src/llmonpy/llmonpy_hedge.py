@@ -0,0 +1,131 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import concurrent.futures
+import threading
+from collections import deque
+
+from llmonpy.llmonpy_scheduler import llmonpy_scheduler
+
+DEFAULT_LATENCY_WINDOW = 256  # recent successful calls kept per model
+DEFAULT_HEDGE_PERCENTILE = 0.95
+DEFAULT_HEDGE_MIN_SAMPLES = 20  # no hedging until a model has this much history
+DEFAULT_MIN_HEDGE_DELAY = 0.5  # seconds, keeps a fast model from being hedged on noise
+HEDGE_THREAD_POOL_SIZE = 256
+
+
+class LatencyTracker:
+    def __init__(self, window_size=DEFAULT_LATENCY_WINDOW):
+        self.tracker_lock = threading.Lock()
+        self.latency_queue = deque(maxlen=window_size)
+
+    def record(self, latency):
+        with self.tracker_lock:
+            self.latency_queue.append(latency)
+
+    def get_sample_count(self):
+        with self.tracker_lock:
+            result = len(self.latency_queue)
+        return result
+
+    # nearest rank percentile of the recent latencies, None with no history
+    def get_percentile(self, percentile):
+        with self.tracker_lock:
+            latency_list = sorted(self.latency_queue)
+        result = None
+        if len(latency_list) > 0:
+            index = min(int(percentile * len(latency_list)), len(latency_list) - 1)
+            result = latency_list[index]
+        return result
+
+
+"""
+  HedgePolicy decides when a prompt gets a second request.  If the first request hasn't finished by the model's
+  percentile latency a duplicate is sent, to the same model or to hedge_model_name, and whichever succeeds first is
+  used.  The duplicate goes through the scheduler like any other prompt, so it waits for the model's and provider's
+  concurrency limits, and a duplicate still queued when the first request finishes is never sent.  The loser can't
+  be cancelled once it is on the wire, so its response is ignored, and paid for.  At the 95th percentile about 5% of
+  calls are hedged.
+"""
+
+
+class HedgePolicy:
+    def __init__(self, percentile=DEFAULT_HEDGE_PERCENTILE, hedge_model_name=None,
+                 min_samples=DEFAULT_HEDGE_MIN_SAMPLES, min_hedge_delay=DEFAULT_MIN_HEDGE_DELAY):
+        self.percentile = percentile
+        self.hedge_model_name = hedge_model_name
+        self.min_samples = min_samples
+        self.min_hedge_delay = min_hedge_delay
+
+    # seconds to wait before hedging, None when there isn't enough history to know what slow is
+    def get_hedge_delay(self, latency_tracker: LatencyTracker):
+        result = None
+        if latency_tracker.get_sample_count() >= self.min_samples:
+            result = max(latency_tracker.get_percentile(self.percentile), self.min_hedge_delay)
+        return result
+
+
+DEFAULT_HEDGE_POLICY = HedgePolicy()
+# only the first request of a prompt that may be hedged runs here, the caller has to be free to take the duplicate's
+# response if it comes back first
+HEDGE_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_THREAD_POOL_SIZE,
+                                                          thread_name_prefix="llmonpy_hedge")
+
+
+def default_hedge_policy() -> HedgePolicy:
+    return DEFAULT_HEDGE_POLICY
+
+
+def set_default_hedge_policy(hedge_policy: HedgePolicy):
+    global DEFAULT_HEDGE_POLICY
+    DEFAULT_HEDGE_POLICY = hedge_policy
+
+
+# Runs primary_function, and submits hedge_function to hedge_lane as well if primary_function is still running after
+# hedge_delay.  With no hedge_delay nothing can be hedged, so primary_function runs on the caller's thread.  Returns
+# (result, hedge_won).  An exception is raised only when every request that was sent failed, the primary's first.
+# loser_listener is called with the result of the request that lost, if it succeeds after the winner.
+def run_hedged(primary_function, hedge_function, hedge_delay, hedge_lane, loser_listener=None):
+    if hedge_delay is None:
+        return primary_function(), False
+    primary_future = HEDGE_THREAD_POOL.submit(primary_function)
+    done_set, pending_set = concurrent.futures.wait([primary_future], timeout=hedge_delay)
+    if len(done_set) > 0:
+        return primary_future.result(), False
+    hedge_future = hedge_lane.submit(hedge_function)
+    pending_set = {primary_future, hedge_future}
+    while len(pending_set) > 0:
+        done_set, pending_set = concurrent.futures.wait(pending_set, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done_set:
+            if future.exception() is None:
+                loser_future = hedge_future if future is primary_future else primary_future
+                finish_loser(loser_future, loser_listener)
+                return future.result(), future is hedge_future
+    return primary_future.result(), False
+
+
+# a hedge still waiting in the scheduler is cancelled, a request already sent is left to finish
+def finish_loser(loser_future, loser_listener):
+    if loser_future.cancel():
+        llmonpy_scheduler().discard_cancelled_tasks()
+    elif loser_listener is not None:
+        loser_future.add_done_callback(lambda future: notify_loser(future, loser_listener))
+
+
+def notify_loser(loser_future, loser_listener):
+    if loser_future.exception() is None:
+        try:
+            loser_listener(loser_future.result())
+        except Exception as e:
+            print("Error recording hedge loser: " + str(e))
@@ -0,0 +1,154 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import math
+import time
+
+DEFAULT_MIN_VALUE = 0.001  # seconds, smaller values go in the first bucket
+DEFAULT_MAX_VALUE = 3600.0  # seconds, larger values go in the last bucket
+DEFAULT_BUCKETS_PER_DOUBLING = 8  # about 9% relative error on a percentile
+DEFAULT_THROUGHPUT_WINDOW = 3600  # seconds of per second counts kept
+
+
+"""
+  LatencyHistogram counts values in log spaced buckets, so its memory is fixed however many values it sees and a
+  percentile is accurate to the bucket width.  It isn't thread safe, the owner locks around it.
+"""
+
+
+class LatencyHistogram:
+    def __init__(self, min_value=DEFAULT_MIN_VALUE, max_value=DEFAULT_MAX_VALUE,
+                 buckets_per_doubling=DEFAULT_BUCKETS_PER_DOUBLING):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.buckets_per_doubling = buckets_per_doubling
+        bucket_count = int(math.ceil(math.log2(max_value / min_value) * buckets_per_doubling)) + 1
+        self.bucket_list = [0] * bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max_recorded = 0.0
+
+    def get_bucket_index(self, value):
+        if value <= self.min_value:
+            result = 0
+        else:
+            result = int(math.log2(value / self.min_value) * self.buckets_per_doubling) + 1
+            result = min(result, len(self.bucket_list) - 1)
+        return result
+
+    # values in a bucket are reported as the bucket's upper bound
+    def get_bucket_value(self, index):
+        result = self.min_value * math.pow(2.0, index / self.buckets_per_doubling)
+        return result
+
+    def record(self, value):
+        self.bucket_list[self.get_bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max_recorded:
+            self.max_recorded = value
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.bucket_list):
+            self.bucket_list[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max_recorded = max(self.max_recorded, other.max_recorded)
+
+    def copy(self):
+        result = LatencyHistogram(self.min_value, self.max_value, self.buckets_per_doubling)
+        result.merge(self)
+        return result
+
+    def get_percentile(self, percentile):
+        result = 0.0
+        if self.count > 0:
+            rank = max(int(math.ceil(percentile * self.count)), 1)
+            running_count = 0
+            for index, bucket_count in enumerate(self.bucket_list):
+                running_count += bucket_count
+                if running_count >= rank:
+                    result = min(self.get_bucket_value(index), self.max_recorded)
+                    break
+        return result
+
+    # number of values up to upper_bound, the bucket holding upper_bound is counted so none are missed, which can
+    # add values up to one bucket width above it
+    def get_cumulative_count(self, upper_bound):
+        result = sum(self.bucket_list[:self.get_bucket_index(upper_bound) + 1])
+        return result
+
+    def get_mean(self):
+        result = self.total / self.count if self.count > 0 else 0.0
+        return result
+
+    def to_dict(self):
+        result = {"count": self.count, "mean": self.get_mean(), "p50": self.get_percentile(0.50),
+                  "p95": self.get_percentile(0.95), "p99": self.get_percentile(0.99), "max": self.max_recorded}
+        return result
+
+
+"""
+  RollingThroughput counts events per second in a ring of window_seconds slots.  A slot is reused when its second
+  comes around again, so memory is fixed and only the last window_seconds are kept.  Not thread safe.
+"""
+
+
+class RollingThroughput:
+    def __init__(self, window_seconds=DEFAULT_THROUGHPUT_WINDOW):
+        self.window_seconds = window_seconds
+        self.count_list = [0] * window_seconds
+        self.second_list = [-1] * window_seconds
+
+    def record(self, event_time=None, count=1):
+        second = int(event_time if event_time is not None else time.time())
+        index = second % self.window_seconds
+        if self.second_list[index] < second:
+            self.second_list[index] = second
+            self.count_list[index] = 0
+        if self.second_list[index] == second:
+            self.count_list[index] += count
+
+    def merge(self, other):
+        for index, second in enumerate(other.second_list):
+            if second >= 0:
+                self.record(second, other.count_list[index])
+
+    def copy(self):
+        result = RollingThroughput(self.window_seconds)
+        result.count_list = list(self.count_list)
+        result.second_list = list(self.second_list)
+        return result
+
+    def get_count(self, second):
+        index = second % self.window_seconds
+        result = self.count_list[index] if self.second_list[index] == second else 0
+        return result
+
+    # events per second over the last seconds, the current partial second left out
+    def get_rate(self, seconds=60, current_time=None):
+        current_second = int(current_time if current_time is not None else time.time())
+        seconds = min(seconds, self.window_seconds - 1)
+        total = sum(self.get_count(second) for second in range(current_second - seconds, current_second))
+        result = total / seconds if seconds > 0 else 0.0
+        return result
+
+    # per second counts from the first second still in the window to the last second with an event
+    def get_second_counts(self):
+        last_second = max(self.second_list)
+        result = []
+        if last_second >= 0:
+            second_list = [second for second in self.second_list if second > last_second - self.window_seconds]
+            result = [self.get_count(second) for second in range(min(second_list), last_second + 1)]
+        return result
@@ -0,0 +1,141 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import concurrent.futures
+import copy
+import importlib
+import importlib.util
+import threading
+
+DEFAULT_MAX_CONNECTIONS = 200
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 100
+DEFAULT_KEEPALIVE_EXPIRY = 120.0  # seconds an idle connection is kept open
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_REQUEST_TIMEOUT = 600.0  # the SDKs set their own per request timeouts, this only applies when they don't
+DEFAULT_PREWARM_CONNECTIONS = 0
+
+
+def is_http2_available():
+    try:
+        result = importlib.util.find_spec("h2") is not None
+    except ModuleNotFoundError:
+        result = False
+    return result
+
+
+class HttpPoolSettings:
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_keepalive_connections=DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY, http2=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT, prewarm_connections=DEFAULT_PREWARM_CONNECTIONS):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        # None uses HTTP/2 when the h2 package is installed
+        self.http2 = http2
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        # connections opened per provider endpoint by init_llm_clients, 0 leaves the pools cold
+        self.prewarm_connections = prewarm_connections
+
+    def use_http2(self):
+        result = self.http2 if self.http2 is not None else is_http2_available()
+        return result
+
+    def to_dict(self):
+        result = copy.copy(vars(self))
+        return result
+
+
+HTTP_POOL_SETTINGS = HttpPoolSettings()
+
+
+def http_pool_settings() -> HttpPoolSettings:
+    return HTTP_POOL_SETTINGS
+
+
+def set_http_pool_settings(settings: HttpPoolSettings):
+    global HTTP_POOL_SETTINGS
+    HTTP_POOL_SETTINGS = settings
+
+
+def make_httpx_options(settings: HttpPoolSettings):
+    httpx = importlib.import_module("httpx")
+    result = {
+        "limits": httpx.Limits(max_connections=settings.max_connections,
+                               max_keepalive_connections=settings.max_keepalive_connections,
+                               keepalive_expiry=settings.keepalive_expiry),
+        "timeout": httpx.Timeout(settings.request_timeout, connect=settings.connect_timeout),
+        "http2": settings.use_http2()
+    }
+    return result
+
+
+def make_http_client(settings: HttpPoolSettings = None):
+    settings = settings if settings is not None else http_pool_settings()
+    httpx = importlib.import_module("httpx")
+    result = httpx.Client(**make_httpx_options(settings))
+    return result
+
+
+def make_async_http_client(settings: HttpPoolSettings = None):
+    settings = settings if settings is not None else http_pool_settings()
+    httpx = importlib.import_module("httpx")
+    result = httpx.AsyncClient(**make_httpx_options(settings))
+    return result
+
+
+"""
+  SharedEndpointClients holds one set of SDK clients per provider endpoint, so every model of a provider shares one
+  connection pool.  SDK clients don't depend on the model, the model is a per request argument.
+"""
+
+
+class SharedEndpointClients:
+    def __init__(self):
+        self.endpoint_lock = threading.Lock()
+        self.endpoint_dict = {}
+
+    def get(self, endpoint_key, factory):
+        with self.endpoint_lock:
+            result = self.endpoint_dict.get(endpoint_key, None)
+            if result is None:
+                result = factory()
+                self.endpoint_dict[endpoint_key] = result
+        return result
+
+    def get_endpoint_keys(self):
+        with self.endpoint_lock:
+            result = list(self.endpoint_dict.keys())
+        return result
+
+
+SHARED_ENDPOINT_CLIENTS = SharedEndpointClients()
+
+
+def shared_endpoint_clients() -> SharedEndpointClients:
+    return SHARED_ENDPOINT_CLIENTS
+
+
+# Opens connection_count connections to url at the same time, so TLS handshakes are done before the first burst.
+# Any response, even a 401 or 404, leaves a warm connection in the pool.
+def prewarm_http_client(http_client, url, connection_count):
+    def open_connection():
+        try:
+            http_client.get(url)
+        except Exception as e:
+            print("Prewarm of " + url + " failed: " + str(e))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(connection_count, 1)) as executor:
+        for _ in range(connection_count):
+            executor.submit(open_connection)
@@ -0,0 +1,211 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llmonpy.llm_client import llm_client_prompt_status_service, get_active_llm_clients
+from llmonpy.llmonpy_circuit_breaker import CIRCUIT_STATE_LIST
+from llmonpy.llmonpy_histogram import LatencyHistogram
+from llmonpy.llmonpy_scheduler import llmonpy_scheduler
+from llmonpy.trace_log import trace_log_service
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+DEFAULT_METRICS_PORT = 9464
+METRICS_PATH = "/metrics"
+# the log buckets are far too fine to export, these are the bounds a dashboard needs
+LATENCY_BUCKET_BOUND_LIST = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+
+
+def escape_label_value(value):
+    result = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return result
+
+
+def format_labels(label_dict):
+    result = ""
+    if label_dict:
+        label_list = [key + "=\"" + escape_label_value(value) + "\"" for key, value in label_dict.items()]
+        result = "{" + ",".join(label_list) + "}"
+    return result
+
+
+class MetricFamily:
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.sample_list = []
+
+    def add_sample(self, value, label_dict=None, suffix=""):
+        self.sample_list.append(self.name + suffix + format_labels(label_dict) + " " + repr(float(value)))
+
+    def add_histogram(self, histogram: LatencyHistogram, label_dict):
+        for bound in LATENCY_BUCKET_BOUND_LIST:
+            bucket_label_dict = dict(label_dict)
+            bucket_label_dict["le"] = repr(bound)
+            self.add_sample(histogram.get_cumulative_count(bound), bucket_label_dict, "_bucket")
+        bucket_label_dict = dict(label_dict)
+        bucket_label_dict["le"] = "+Inf"
+        self.add_sample(histogram.count, bucket_label_dict, "_bucket")
+        self.add_sample(histogram.count, label_dict, "_count")
+        self.add_sample(histogram.total, label_dict, "_sum")
+
+    def to_text(self):
+        line_list = ["# TYPE " + self.name + " " + self.metric_type, "# HELP " + self.name + " " + self.help_text]
+        line_list.extend(self.sample_list)
+        result = "\n".join(line_list)
+        return result
+
+
+def client_metric_families():
+    in_flight = MetricFamily("llmonpy_client_in_flight", "gauge", "Prompts started and not yet finished")
+    waiting = MetricFamily("llmonpy_client_waiting_for_ticket", "gauge", "Prompts waiting for a ratellmiter ticket")
+    completed = MetricFamily("llmonpy_client_completed", "counter", "Prompts finished")
+    exceptions = MetricFamily("llmonpy_client_exceptions", "counter", "Prompts that failed")
+    rate_limits = MetricFamily("llmonpy_client_rate_limits", "counter", "Rate limit responses from the provider")
+    cost = MetricFamily("llmonpy_client_cost_usd", "counter", "Cost of provider calls")
+    input_tokens = MetricFamily("llmonpy_client_input_tokens", "counter", "Input tokens sent to the provider")
+    output_tokens = MetricFamily("llmonpy_client_output_tokens", "counter", "Output tokens generated")
+    ticket_wait = MetricFamily("llmonpy_client_ticket_wait_seconds", "histogram",
+                               "Wait for a ratellmiter ticket and token room before a provider call")
+    service_time = MetricFamily("llmonpy_client_service_time_seconds", "histogram", "Provider call time")
+    total_time = MetricFamily("llmonpy_client_total_time_seconds", "histogram", "Ticket wait plus provider call time")
+    result = [in_flight, waiting, completed, exceptions, rate_limits, cost, input_tokens, output_tokens, ticket_wait,
+              service_time, total_time]
+    status_service = llm_client_prompt_status_service()
+    if status_service is not None:
+        for client_status in status_service.get_all_status()[1:]:
+            label_dict = {"model": client_status.client_name}
+            in_flight.add_sample(client_status.in_flight_count, label_dict)
+            waiting.add_sample(client_status.waiting_for_ticket, label_dict)
+            completed.add_sample(client_status.completed_prompt_count, label_dict, "_total")
+            exceptions.add_sample(client_status.exception_count, label_dict, "_total")
+            rate_limits.add_sample(client_status.rate_limit_count, label_dict, "_total")
+            cost.add_sample(client_status.total_cost, label_dict, "_total")
+            input_tokens.add_sample(client_status.input_tokens, label_dict, "_total")
+            output_tokens.add_sample(client_status.output_tokens, label_dict, "_total")
+            ticket_wait.add_histogram(client_status.ticket_wait_histogram, label_dict)
+            service_time.add_histogram(client_status.service_time_histogram, label_dict)
+            total_time.add_histogram(client_status.total_time_histogram, label_dict)
+    return result
+
+
+def circuit_breaker_metric_families():
+    state = MetricFamily("llmonpy_client_circuit", "stateset", "Circuit breaker state of each client")
+    opened = MetricFamily("llmonpy_client_circuit_opened", "counter", "Times a client's circuit opened")
+    result = [state, opened]
+    for client in get_active_llm_clients():
+        circuit_breaker = client.get_circuit_breaker()
+        circuit_state = circuit_breaker.get_state()
+        for state_name in CIRCUIT_STATE_LIST:
+            state.add_sample(1 if state_name == circuit_state else 0,
+                             {"model": client.model_name, "llmonpy_client_circuit": state_name})
+        opened.add_sample(circuit_breaker.get_open_count(), {"model": client.model_name}, "_total")
+    return result
+
+
+def scheduler_metric_families():
+    running = MetricFamily("llmonpy_scheduler_running", "gauge", "Tasks running in a scheduler lane")
+    queued = MetricFamily("llmonpy_scheduler_queued", "gauge", "Tasks queued in a scheduler lane")
+    lane_running = MetricFamily("llmonpy_scheduler_lane_running", "gauge", "Prompts running per provider or model")
+    lane_queued = MetricFamily("llmonpy_scheduler_lane_queued", "gauge", "Prompts queued per provider or model")
+    result = [running, queued, lane_running, lane_queued]
+    scheduler = llmonpy_scheduler()
+    if scheduler is not None:
+        status = scheduler.get_status()
+        running.add_sample(status.running_prompt_count, {"lane": "prompt"})
+        running.add_sample(status.running_pypeline_count, {"lane": "pypeline"})
+        queued.add_sample(status.queued_prompt_count, {"lane": "prompt"})
+        queued.add_sample(status.queued_pypeline_count, {"lane": "pypeline"})
+        for key, count in status.running_count_dict.items():
+            lane_running.add_sample(count, {"key": key})
+        for key, count in status.queued_count_dict.items():
+            lane_queued.add_sample(count, {"key": key})
+    return result
+
+
+def trace_store_metric_families():
+    backlog = MetricFamily("llmonpy_trace_store_backlog", "gauge", "Trace records waiting to be written")
+    result = [backlog]
+    service = trace_log_service()
+    if service is not None:
+        for kind, count in service.get_write_backlog().items():
+            backlog.add_sample(count, {"kind": kind})
+    return result
+
+
+def render_openmetrics():
+    family_list = (client_metric_families() + circuit_breaker_metric_families() + scheduler_metric_families() +
+                   trace_store_metric_families())
+    text_list = [family.to_text() for family in family_list]
+    text_list.append("# EOF\n")
+    result = "\n".join(text_list)
+    return result
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        body = render_openmetrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+  MetricsServer serves /metrics on its own thread, for processes that don't run the llmonpy_viewer Flask app.
+"""
+
+
+class MetricsServer:
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(MetricsServer, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, port=DEFAULT_METRICS_PORT, host="127.0.0.1"):
+        self.port = port
+        self.host = host
+        self.http_server = None
+        self.server_thread = None
+
+    def start(self):
+        self.http_server = ThreadingHTTPServer((self.host, self.port), MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+        self.server_thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+    @staticmethod
+    def get_instance():
+        return MetricsServer._instance
+
+
+def metrics_server() -> MetricsServer:
+    return MetricsServer.get_instance()
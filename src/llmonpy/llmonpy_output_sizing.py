@@ -0,0 +1,143 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import math
+import threading
+from collections import deque
+
+from llmonpy.trace_log import trace_log_service
+
+DEFAULT_OUTPUT_WINDOW = 500  # recent outputs kept per step name
+DEFAULT_OUTPUT_PERCENTILE = 0.99
+DEFAULT_OUTPUT_MARGIN = 1.5  # the percentile is multiplied by this before it is rounded up
+DEFAULT_OUTPUT_MIN_SAMPLES = 20  # no learned max_output until a step has this much history
+DEFAULT_MIN_MAX_OUTPUT = 64  # tokens, the smallest max_output ever learned
+
+
+class OutputLengthTracker:
+    def __init__(self, window_size=DEFAULT_OUTPUT_WINDOW):
+        self.tracker_lock = threading.Lock()
+        self.output_tokens_queue = deque(maxlen=window_size)
+
+    def record(self, output_tokens):
+        with self.tracker_lock:
+            self.output_tokens_queue.append(output_tokens)
+
+    def get_sample_count(self):
+        with self.tracker_lock:
+            result = len(self.output_tokens_queue)
+        return result
+
+    # nearest rank percentile of the recent output lengths, None with no history
+    def get_percentile(self, percentile):
+        with self.tracker_lock:
+            output_tokens_list = sorted(self.output_tokens_queue)
+        result = None
+        if len(output_tokens_list) > 0:
+            index = min(int(percentile * len(output_tokens_list)), len(output_tokens_list) - 1)
+            result = output_tokens_list[index]
+        return result
+
+
+"""
+  OutputSizingPolicy turns a step's output history into the max_output its prompts are sent with: the percentile of
+  recent completion tokens times the margin, rounded up to a power of two.  The rounding keeps the value, and the
+  response cache keys it is part of, from changing with every response.  A response cut off at the limit is recorded
+  at the limit even when it can't be used, and its retry is sent with the limit doubled, so the margin lets a step
+  whose outputs grow raise its own limit.
+"""
+
+
+class OutputSizingPolicy:
+    def __init__(self, percentile=DEFAULT_OUTPUT_PERCENTILE, margin=DEFAULT_OUTPUT_MARGIN,
+                 min_samples=DEFAULT_OUTPUT_MIN_SAMPLES, min_max_output=DEFAULT_MIN_MAX_OUTPUT,
+                 window_size=DEFAULT_OUTPUT_WINDOW):
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.min_max_output = min_max_output
+        self.window_size = window_size
+
+    # None when there isn't enough history, the client's default applies
+    def get_max_output(self, tracker: OutputLengthTracker):
+        result = None
+        if tracker.get_sample_count() >= self.min_samples:
+            max_output = max(tracker.get_percentile(self.percentile) * self.margin, self.min_max_output)
+            result = 2 ** int(math.ceil(math.log2(max_output)))
+        return result
+
+
+"""
+  OutputSizer learns a max_output for each prompt step name, so a judge that answers {"winner": 1} isn't given room
+  for thousands of tokens.  A step name's history is loaded from the trace store the first time it is asked for and
+  kept up to date with every response after that.
+"""
+
+
+class OutputSizer:
+    def __init__(self, policy: OutputSizingPolicy = None):
+        self.policy = policy if policy is not None else OutputSizingPolicy()
+        self.sizer_lock = threading.Lock()
+        self.tracker_dict = {}
+
+    def get_tracker(self, step_name) -> OutputLengthTracker:
+        with self.sizer_lock:
+            result = self.tracker_dict.get(step_name, None)
+            is_new = result is None
+            if is_new:
+                result = OutputLengthTracker(self.policy.window_size)
+                self.tracker_dict[step_name] = result
+        if is_new:
+            self.load_history(step_name, result)
+        return result
+
+    def load_history(self, step_name, tracker: OutputLengthTracker):
+        service = trace_log_service()
+        if service is not None:
+            try:
+                output_tokens_list = service.get_output_tokens_for_step_name(step_name, self.policy.window_size)
+            except Exception as e:
+                print("Output history of " + step_name + " not loaded: " + str(e))
+                output_tokens_list = []
+            # newest first from the store, the tracker's window keeps the newest last
+            for output_tokens in reversed(output_tokens_list):
+                tracker.record(output_tokens)
+
+    def record_output_tokens(self, step_name, output_tokens):
+        if output_tokens is not None and output_tokens > 0:
+            self.get_tracker(step_name).record(output_tokens)
+
+    def get_max_output(self, step_name):
+        result = self.policy.get_max_output(self.get_tracker(step_name))
+        return result
+
+    def set_policy(self, policy: OutputSizingPolicy):
+        self.policy = policy
+
+    def to_dict(self):
+        with self.sizer_lock:
+            step_name_list = list(self.tracker_dict.keys())
+        result = {step_name: self.get_max_output(step_name) for step_name in step_name_list}
+        return result
+
+
+OUTPUT_SIZER = OutputSizer()
+
+
+def output_sizer() -> OutputSizer:
+    return OUTPUT_SIZER
+
+
+def set_output_sizing_policy(policy: OutputSizingPolicy):
+    OUTPUT_SIZER.set_policy(policy)
@@ -15,12 +15,19 @@
 import concurrent
 import json
 import random
+import threading
 import time
 
 from jinja2 import Template
 
 from llmonpy.llmonpy_step import *
-from llmonpy.llm_client import LlmClient
+from llmonpy.llm_client import LlmClient, LlmClientResponse, PrefixedPrompt, get_llm_client, \
+    get_max_samples_per_call
+from llmonpy.llmonpy_budget import BudgetReservation
+from llmonpy.llmonpy_deadline import remaining_time
+from llmonpy.llmonpy_output_sizing import output_sizer
+from llmonpy.llmonpy_schema import OutputSchema, output_schema_for_class
+from llmonpy.llmonpy_scheduler import SchedulerLane
 from llmonpy.trace_log import LlmModelInfo, trace_log_service
 
 DEFAULT_OUTPUT_DICT_KEY = "response_string"
@@ -32,9 +39,18 @@ class LLMonPyPromptInterface:
     def get_prompt_text(self):
         raise NotImplementedError
 
+    # template for the part of the prompt that is the same on every call, sent ahead of the prompt text so
+    # providers can cache it.  None when the prompt has no static prefix.
+    def get_prompt_prefix_text(self):
+        return None
+
     def get_json_output(self):
         raise NotImplementedError
 
+    # schema the provider constrains a JSON response to, None to only ask for a JSON object
+    def get_output_schema(self) -> OutputSchema:
+        return None
+
     def get_output_format(self):
         raise NotImplementedError
 
@@ -61,14 +77,18 @@ class LLMonPyPromptInterface:
 
 
 class LLMonPySimplePrompt(LLMonPyPromptInterface):
-    def __init__(self, name, prompt_text, output_format = LLMONPY_OUTPUT_FORMAT_TEXT):
+    def __init__(self, name, prompt_text, output_format = LLMONPY_OUTPUT_FORMAT_TEXT, prompt_prefix_text=None):
         self.name = name
         self.prompt_text = prompt_text
         self.output_format = output_format
+        self.prompt_prefix_text = prompt_prefix_text
 
     def get_prompt_text(self):
         return self.prompt_text
 
+    def get_prompt_prefix_text(self):
+        return self.prompt_prefix_text
+
     def get_json_output(self):
         return self.output_format == LLMONPY_OUTPUT_FORMAT_JSON
 
@@ -121,9 +141,21 @@ class LLMonPyPrompt (LLMonPyPromptInterface):
     def get_prompt_text(self):
         return self.__class__.prompt_text
 
+    # a subclass marks its static prefix with a prompt_prefix_text class attribute
+    def get_prompt_prefix_text(self):
+        result = getattr(self.__class__, "prompt_prefix_text", None)
+        return result
+
     def get_json_output(self):
         return self.__class__.output_format == LLMONPY_OUTPUT_FORMAT_JSON
 
+    # from the LLMonPyOutput class, see schema_from_output_class
+    def get_output_schema(self) -> OutputSchema:
+        result = None
+        if self.get_json_output():
+            result = output_schema_for_class(self.__class__.LLMonPyOutput)
+        return result
+
     def get_output_format(self):
         result = self.__class__.output_format
         return result
@@ -153,24 +185,122 @@ class LLMonPyPrompt (LLMonPyPromptInterface):
         return result
 
 
+class LLMonPyInputTooLongException(Exception):
+    def __init__(self, model_name, input_tokens, max_input):
+        super().__init__("Prompt of about " + str(input_tokens) + " tokens is over the " + str(max_input) +
+                         " token max_input of " + model_name)
+        self.model_name = model_name
+        self.input_tokens = input_tokens
+        self.max_input = max_input
+
+
 class JudgePrompt(LLMonPyPrompt):
     def __init__(self):
         super().__init__()
 
 
+"""
+  PromptSampleGroup lets runners that ask one model the same prompt at the same temp share a single request that
+  returns a choice for each of them.  The first runner of the group to execute sends it, every runner takes the next
+  unclaimed choice.  A runner whose prompt rendered differently, or whose choice didn't come back or can't be used,
+  sends its own request.
+"""
+
+
+class PromptSampleGroup:
+    def __init__(self, sample_count):
+        self.sample_count = sample_count
+        self.group_lock = threading.Lock()
+        self.prompt_text = None
+        self.sample_future = None
+        self.leader_step_id = None
+        self.next_sample = 0
+
+    def get_sample(self, runner, prompt_text, json_output, max_output) -> LlmClientResponse:
+        with self.group_lock:
+            is_leader = self.sample_future is None
+            if is_leader:
+                self.sample_future = concurrent.futures.Future()
+                self.prompt_text = prompt_text
+                self.leader_step_id = runner.get_step_id()
+            elif self.prompt_text != prompt_text:
+                return None
+            sample_number = self.next_sample
+            self.next_sample += 1
+        if is_leader:
+            self.request_samples(runner, prompt_text, json_output, max_output)
+        result = None
+        try:
+            sample_list = self.sample_future.result(timeout=remaining_time(runner.get_recorder().get_deadline()))
+            if sample_number < len(sample_list):
+                result = sample_list[sample_number]
+        except Exception as e:
+            if is_leader:
+                raise e
+        if result is not None:
+            runner.get_recorder().log_message("sample " + str(sample_number + 1) + " of " +
+                                              str(len(sample_list)) + " from the request of step " +
+                                              str(self.leader_step_id))
+        return result
+
+    def request_samples(self, runner, prompt_text, json_output, max_output):
+        recorder = runner.get_recorder()
+        model_info = runner.get_model_info()
+        try:
+            sample_list = runner.get_llm_client().prompt_samples(runner.get_step_id(), prompt_text, None, json_output,
+                                                                 model_info.get_temp(), max_output,
+                                                                 sample_count=self.sample_count,
+                                                                 attempt_listener=recorder.record_attempt,
+                                                                 deadline=recorder.get_deadline())
+            self.sample_future.set_result(sample_list)
+        except Exception as e:
+            self.sample_future.set_exception(e)
+
+
+# model infos whose runners can share a request, None for one that has to be sent on its own
+def get_sample_group_key(model_info: LlmModelInfo):
+    result = None
+    temp = model_info.get_temp()
+    # at temp 0 the same prompt is already sent once and shared, see SingleFlightTable
+    if (temp is not None and temp > 0.0 and model_info.get_sample_index() is None and
+            model_info.get_stream() is False and model_info.get_hedge() is False):
+        result = json.dumps(model_info.to_dict(), sort_keys=True, default=str)
+    return result
+
+
+def make_sample_groups(model_info_list: [LlmModelInfo]):
+    key_list = [get_sample_group_key(model_info) for model_info in model_info_list]
+    result = [None] * len(model_info_list)
+    for key in set(key for key in key_list if key is not None):
+        index_list = [index for index, model_info_key in enumerate(key_list) if model_info_key == key]
+        max_samples = get_max_samples_per_call(model_info_list[index_list[0]].get_model_name())
+        for start in range(0, len(index_list), max_samples):
+            group_index_list = index_list[start:start + max_samples]
+            if len(group_index_list) > 1:
+                sample_group = PromptSampleGroup(len(group_index_list))
+                for index in group_index_list:
+                    result[index] = sample_group
+    return result
+
+
 # make different evaluators if they handle errors different
 class LLMonPyPromptRunner(LLMonPyStep):
-    def __init__(self, parent_recorder: TraceLogRecorderInterface, prompt: LLMonPyPromptInterface, llm_model_info: LlmModelInfo):
+    def __init__(self, parent_recorder: TraceLogRecorderInterface, prompt: LLMonPyPromptInterface, llm_model_info: LlmModelInfo,
+                 sample_group: PromptSampleGroup = None):
         super().__init__()
         self.llm_model_info = llm_model_info
+        self.sample_group = sample_group
+        self.llm_client = None
         self.prompt = copy.deepcopy(prompt)
         self.template = Template(prompt.get_prompt_text())
+        prompt_prefix_text = prompt.get_prompt_prefix_text()
+        self.prefix_template = Template(prompt_prefix_text) if prompt_prefix_text is not None else None
         if parent_recorder is None:
             self.recorder = trace_log_service().create_root_recorder(None, None, None, self)
         else:
             self.recorder = parent_recorder.create_child_recorder(self)
 
-    def get_thread_pool(self) -> concurrent.futures.ThreadPoolExecutor:
+    def get_thread_pool(self) -> SchedulerLane:
         result = self.get_llm_client().get_thread_pool()
         return result
 
@@ -189,8 +319,11 @@ class LLMonPyPromptRunner(LLMonPyStep):
         result.update(super_result)
         return result
 
+    # resolved once, so a model group picks one member for both the lane and the call
     def get_llm_client(self) -> LlmClient:
-        result = self.llm_model_info.get_llm_client()
+        if self.llm_client is None:
+            self.llm_client = self.llm_model_info.get_llm_client()
+        result = self.llm_client
         return result
 
     def get_model_info(self):
@@ -200,26 +333,171 @@ class LLMonPyPromptRunner(LLMonPyStep):
     def execute_step(self):
         recorder = self.get_recorder()
         prompt_dict = recorder.get_input_dict()
-        recorder.log_prompt_template(self.prompt.get_prompt_text())
-        prompt_text = self.template.render(prompt_dict)
+        prompt_prefix_text = self.prompt.get_prompt_prefix_text()
+        prompt_template_text = self.prompt.get_prompt_text()
+        if prompt_prefix_text is not None:
+            prompt_template_text = prompt_prefix_text + prompt_template_text
+        recorder.log_prompt_template(prompt_template_text)
+        prompt_text = self.fit_to_max_input(prompt_dict)
+        json_output = self.prompt.get_json_output()
+        output_schema = self.prompt.get_output_schema() if json_output else None
+        json_output = output_schema if output_schema is not None else json_output
+        max_output = self.get_max_output()
+        budget_reservation = self.reserve_budget(prompt_text, max_output)
+        # retries are handled by the client's RetryPolicy, every attempt is recorded on this step's trace.  A
+        # response that can't be turned into the prompt's output is retried as a format error.
+        try:
+            response = self.get_group_sample(prompt_text, json_output, max_output)
+            if response is None:
+                response = self.get_llm_client().prompt(self.get_step_id(), prompt_text, None, json_output,
+                                                        self.llm_model_info.get_temp(), max_output,
+                                                        sample_index=self.llm_model_info.get_sample_index(),
+                                                        attempt_listener=self.record_attempt,
+                                                        response_validator=self.output_from_response,
+                                                        stream=self.llm_model_info.get_stream(),
+                                                        hedge=self.llm_model_info.get_hedge(),
+                                                        deadline=recorder.get_deadline(),
+                                                        cost_listener=self.record_hedge_cost)
+        except Exception as e:
+            if budget_reservation is not None:
+                budget_reservation.release()
+            # the last attempt's output is kept on the trace, so a step that keeps being cut off still has history
+            if getattr(e, "output_tokens", None) is not None:
+                recorder.record_output_tokens(e.output_tokens, max_output)
+            raise e
+        if budget_reservation is not None:
+            budget_reservation.settle(response.get_response_cost())
+        recorder.record_cost(response.get_response_cost())
+        recorder.record_output_tokens(response.output_tokens, max_output)
+        if response.from_cache is False and response.coalesced is False:
+            output_sizer().record_output_tokens(self.get_step_name(), response.output_tokens)
+        if response.time_to_first_token is not None and response.from_cache is False:
+            recorder.record_stream_metrics(response.time_to_first_token, response.tokens_per_second)
+        recorder.log_prompt_response(prompt_text, response.response_text)
+        result = self.output_from_response(response)
+        return result
+
+    # A response that fails validation, like JSON cut off at max_output, is never returned.  Its length is still
+    # recorded so the learned max_output can grow past it.
+    def record_attempt(self, attempt):
+        self.get_recorder().record_attempt(attempt)
+        if attempt.output_tokens is not None:
+            output_sizer().record_output_tokens(self.get_step_name(), attempt.output_tokens)
+
+    # the losing request of a hedged prompt is paid for too
+    def record_hedge_cost(self, cost):
+        recorder = self.get_recorder()
+        recorder.record_cost(cost)
+        cost_budget = recorder.get_cost_budget()
+        if cost_budget is not None:
+            cost_budget.charge(cost)
+
+    # this runner's choice from its sample group's shared request, None when it has to send its own
+    def get_group_sample(self, prompt_text, json_output, max_output) -> LlmClientResponse:
         result = None
-        for i in range(0, 3):
+        if self.sample_group is not None:
+            result = self.sample_group.get_sample(self, prompt_text, json_output, max_output)
+        if result is not None:
             try:
-                response = self.get_llm_client().prompt(self.get_step_id(), prompt_text, None, self.prompt.get_json_output(),
-                                                  self.llm_model_info.get_temp())
-                recorder.record_cost(response.get_response_cost())
-                recorder.log_prompt_response(prompt_text, response.response_text)
-                if self.prompt.get_json_output():
-                    result = self.prompt.output_from_dict(response.response_dict)
-                else:
-                    result = self.prompt.output_from_string(response.response_text)
-                break
-            except Exception as e:
-                recorder.record_exception(e)
-                if i == 2:
-                    raise e
-                else:
-                    continue
+                self.output_from_response(result)
+            except Exception:
+                result = None
+        return result
+
+    def render_prompt_text(self, prompt_dict):
+        result = self.template.render(prompt_dict)
+        if self.prefix_template is not None:
+            result = PrefixedPrompt(self.prefix_template.render(prompt_dict), result)
+        return result
+
+    # Renders the prompt and checks its estimated size against the model's max_input before anything is sent.  What
+    # happens to a prompt that doesn't fit is the model info's input_overflow setting: send it anyway, the default,
+    # drop examples, send it to the overflow model or reject it.  When dropping examples or routing can't make it fit
+    # the prompt is rejected, a rejected prompt raises LLMonPyInputTooLongException.
+    def fit_to_max_input(self, prompt_dict):
+        recorder = self.get_recorder()
+        prompt_text = self.render_prompt_text(prompt_dict)
+        llm_client = self.get_llm_client()
+        input_tokens = llm_client.count_input_tokens(prompt_text)
+        input_overflow = None
+        if input_tokens > llm_client.max_input:
+            input_overflow_setting = self.llm_model_info.get_input_overflow()
+            if (input_overflow_setting == INPUT_OVERFLOW_TRUNCATE_EXAMPLES and
+                    len(prompt_dict.get(EXAMPLE_LIST_KEY, None) or []) > 0):
+                prompt_text, input_tokens, dropped_count = self.truncate_examples(prompt_dict, llm_client)
+                input_overflow = "dropped " + str(dropped_count) + " examples"
+            elif input_overflow_setting == INPUT_OVERFLOW_ROUTE:
+                overflow_client = self.get_overflow_client(input_tokens)
+                if overflow_client is not None:
+                    self.llm_client = overflow_client
+                    input_overflow = "routed to " + overflow_client.model_name
+            llm_client = self.get_llm_client()
+            if input_overflow_setting == INPUT_OVERFLOW_SEND:
+                input_overflow = INPUT_OVERFLOW_SEND
+            elif input_tokens > llm_client.max_input:
+                input_overflow = INPUT_OVERFLOW_REJECT
+        recorder.record_input_tokens(input_tokens, llm_client.max_input, input_overflow)
+        if input_overflow == INPUT_OVERFLOW_REJECT:
+            raise LLMonPyInputTooLongException(llm_client.model_name, input_tokens, llm_client.max_input)
+        return prompt_text
+
+    # keeps the longest tail of the example list that fits, pypelines put their best examples last
+    def truncate_examples(self, prompt_dict, llm_client):
+        example_list = prompt_dict.get(EXAMPLE_LIST_KEY, None) or []
+        truncated_dict = dict(prompt_dict)
+        low = 0
+        high = len(example_list)
+        best_result = None
+        # binary search on the number of examples dropped, the prompt only gets shorter as more are dropped
+        while low <= high:
+            dropped_count = (low + high) // 2
+            truncated_dict[EXAMPLE_LIST_KEY] = example_list[dropped_count:]
+            prompt_text = self.render_prompt_text(truncated_dict)
+            input_tokens = llm_client.count_input_tokens(prompt_text)
+            if input_tokens <= llm_client.max_input:
+                best_result = (prompt_text, input_tokens, dropped_count)
+                high = dropped_count - 1
+            else:
+                low = dropped_count + 1
+        if best_result is None:
+            # nothing fits, the prompt with no examples is what gets rejected
+            best_result = (prompt_text, input_tokens, len(example_list))
+        result = best_result
+        return result
+
+    def get_overflow_client(self, input_tokens) -> LlmClient:
+        result = None
+        overflow_model_name = self.llm_model_info.get_overflow_model_name()
+        if overflow_model_name is not None:
+            try:
+                overflow_client = get_llm_client(overflow_model_name)
+                if overflow_client.max_input >= input_tokens:
+                    result = overflow_client
+            except KeyError:
+                print("Overflow model " + overflow_model_name + " is not active")
+        return result
+
+    # the model info's max_output, or the one learned from this step's output history
+    def get_max_output(self):
+        result = self.llm_model_info.get_max_output()
+        if result is None:
+            result = output_sizer().get_max_output(self.get_step_name())
+        return result
+
+    # raises LLMonPyBudgetExceededException when the trace's cost budget can't cover the prompt
+    def reserve_budget(self, prompt_text, max_output=None) -> BudgetReservation:
+        result = None
+        cost_budget = self.get_recorder().get_cost_budget()
+        if cost_budget is not None:
+            estimated_cost = self.get_llm_client().estimate_cost(prompt_text, max_output=max_output)
+            result = cost_budget.reserve(estimated_cost, self.get_recorder().get_deadline())
+        return result
+
+    def output_from_response(self, response):
+        if self.prompt.get_json_output():
+            result = self.prompt.output_from_dict(response.response_dict)
+        else:
+            result = self.prompt.output_from_string(response.response_text)
         return result
 
     @staticmethod
@@ -227,13 +505,17 @@ class LLMonPyPromptRunner(LLMonPyStep):
         prompt_dict = prompt.to_dict()
         template = Template(prompt.get_prompt_text())
         prompt_text = template.render(prompt_dict)
+        prompt_prefix_text = prompt.get_prompt_prefix_text()
+        if prompt_prefix_text is not None:
+            prompt_text = Template(prompt_prefix_text).render(prompt_dict) + prompt_text
         return prompt_text
 
 
 def create_prompt_steps(parent_recorder: TraceLogRecorderInterface, prompt: LLMonPyPrompt, model_info_list: [LlmModelInfo]):
     result = []
-    for model_info in model_info_list:
-        result.append(LLMonPyPromptRunner(parent_recorder, prompt, model_info))
+    sample_group_list = make_sample_groups(model_info_list)
+    for model_info, sample_group in zip(model_info_list, sample_group_list):
+        result.append(LLMonPyPromptRunner(parent_recorder, prompt, model_info, sample_group))
     return result
 
 
@@ -0,0 +1,210 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import asyncio
+import copy
+import random
+import time
+
+ERROR_CLASS_RATE_LIMIT = "rate_limit"
+ERROR_CLASS_JSON_FORMAT = "json_format"
+ERROR_CLASS_TIMEOUT = "timeout"
+ERROR_CLASS_SERVER = "server_error"
+ERROR_CLASS_CLIENT = "client_error"
+ERROR_CLASS_UNKNOWN = "unknown"
+ERROR_CLASS_DEADLINE = "deadline"
+ERROR_CLASS_CIRCUIT_OPEN = "circuit_open"
+
+DEFAULT_MAX_TOTAL_ATTEMPTS = 6
+REQUEST_TIMEOUT_STATUS_CODE = 408
+RATE_LIMIT_STATUS_CODE = 429
+
+
+def get_status_code(exception):
+    result = None
+    for attribute_name in ["status_code", "status", "code"]:
+        value = getattr(exception, attribute_name, None)
+        if isinstance(value, int):
+            result = value
+            break
+    if result is None:
+        response = getattr(exception, "response", None)
+        value = getattr(response, "status_code", None)
+        result = value if isinstance(value, int) else None
+    return result
+
+
+# exceptions raised by llmonpy set error_class, provider SDK exceptions are classified by status code and type
+def classify_exception(exception) -> str:
+    result = getattr(exception, "error_class", None)
+    if result is None:
+        status_code = get_status_code(exception)
+        exception_type_name = type(exception).__name__.lower()
+        if status_code == RATE_LIMIT_STATUS_CODE or "ratelimit" in exception_type_name:
+            result = ERROR_CLASS_RATE_LIMIT
+        elif (status_code == REQUEST_TIMEOUT_STATUS_CODE or isinstance(exception, TimeoutError) or
+              "timeout" in exception_type_name):
+            result = ERROR_CLASS_TIMEOUT
+        elif status_code is not None and status_code >= 500:
+            result = ERROR_CLASS_SERVER
+        elif status_code is not None and 400 <= status_code < 500:
+            result = ERROR_CLASS_CLIENT
+        else:
+            result = ERROR_CLASS_UNKNOWN
+    return result
+
+
+class RetryRule:
+    def __init__(self, max_attempts, base_delay=1.0, max_delay=30.0, multiplier=2.0, jitter=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    # attempt is the number of attempts already made for this error class, full jitter keeps retries from lining up
+    def get_delay(self, attempt):
+        result = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        if self.jitter:
+            result = random.uniform(0, result)
+        return result
+
+
+class RetryAttempt:
+    def __init__(self, attempt_number, start_time, elapsed, error_class=None, error_message=None, delay=0.0,
+                 output_tokens=None):
+        self.attempt_number = attempt_number
+        self.start_time = start_time
+        self.elapsed = elapsed
+        self.error_class = error_class
+        self.error_message = error_message
+        self.delay = delay
+        self.output_tokens = output_tokens  # set when a failed attempt still got a response, such as bad JSON
+
+    def succeeded(self):
+        return self.error_class is None
+
+    def to_dict(self):
+        result = copy.copy(vars(self))
+        return result
+
+    @staticmethod
+    def from_dict(dictionary):
+        return RetryAttempt(**dictionary)
+
+
+def make_default_rule_dict():
+    result = {
+        ERROR_CLASS_RATE_LIMIT: RetryRule(6, base_delay=2.0, max_delay=60.0),
+        ERROR_CLASS_JSON_FORMAT: RetryRule(3, base_delay=0.0, max_delay=0.0),
+        ERROR_CLASS_TIMEOUT: RetryRule(3, base_delay=1.0, max_delay=30.0),
+        ERROR_CLASS_SERVER: RetryRule(4, base_delay=1.0, max_delay=30.0),
+        ERROR_CLASS_CLIENT: RetryRule(1),
+        ERROR_CLASS_UNKNOWN: RetryRule(2, base_delay=1.0, max_delay=10.0),
+        ERROR_CLASS_DEADLINE: RetryRule(1),
+        ERROR_CLASS_CIRCUIT_OPEN: RetryRule(1)
+    }
+    return result
+
+
+"""
+  RetryPolicy is the only place llmonpy retries a prompt.  Each error class has its own rule, and
+  max_total_attempts caps the attempts for one logical prompt no matter how the errors are mixed.  Rate limits are
+  first handled by ratellmiter inside each attempt; this policy only sees the ones that escape it.  When the prompt
+  has a deadline, a retry whose delay would end past it is not made.
+"""
+
+
+class RetryPolicy:
+    def __init__(self, rule_dict=None, max_total_attempts=DEFAULT_MAX_TOTAL_ATTEMPTS):
+        self.rule_dict = rule_dict if rule_dict is not None else make_default_rule_dict()
+        self.max_total_attempts = max_total_attempts
+
+    def get_rule(self, error_class) -> RetryRule:
+        result = self.rule_dict.get(error_class, None)
+        if result is None:
+            result = self.rule_dict[ERROR_CLASS_UNKNOWN]
+        return result
+
+    # returns the delay before the next attempt, or None if the exception should be raised
+    def next_delay(self, exception, error_class, attempt_number, class_attempt_count, deadline=None):
+        result = None
+        rule = self.get_rule(error_class)
+        if attempt_number < self.max_total_attempts and class_attempt_count < rule.max_attempts:
+            result = rule.get_delay(class_attempt_count)
+            if deadline is not None and time.time() + result >= deadline:
+                result = None
+        return result
+
+    def run(self, function, attempt_listener=None, deadline=None):
+        class_attempt_count_dict = {}
+        attempt_number = 0
+        while True:
+            attempt_number += 1
+            start_time = time.time()
+            try:
+                result = function()
+                self.notify(attempt_listener, RetryAttempt(attempt_number, start_time, time.time() - start_time))
+                return result
+            except Exception as e:
+                delay = self.handle_exception(e, attempt_number, start_time, class_attempt_count_dict,
+                                              attempt_listener, deadline)
+                time.sleep(delay)
+
+    async def arun(self, coroutine_function, attempt_listener=None, deadline=None):
+        class_attempt_count_dict = {}
+        attempt_number = 0
+        while True:
+            attempt_number += 1
+            start_time = time.time()
+            try:
+                result = await coroutine_function()
+                self.notify(attempt_listener, RetryAttempt(attempt_number, start_time, time.time() - start_time))
+                return result
+            except Exception as e:
+                delay = self.handle_exception(e, attempt_number, start_time, class_attempt_count_dict,
+                                              attempt_listener, deadline)
+                await asyncio.sleep(delay)
+
+    def handle_exception(self, exception, attempt_number, start_time, class_attempt_count_dict, attempt_listener,
+                         deadline=None):
+        error_class = classify_exception(exception)
+        class_attempt_count = class_attempt_count_dict.get(error_class, 0) + 1
+        class_attempt_count_dict[error_class] = class_attempt_count
+        delay = self.next_delay(exception, error_class, attempt_number, class_attempt_count, deadline)
+        attempt = RetryAttempt(attempt_number, start_time, time.time() - start_time, error_class, str(exception),
+                               delay if delay is not None else 0.0, getattr(exception, "output_tokens", None))
+        self.notify(attempt_listener, attempt)
+        if delay is None:
+            raise exception
+        return delay
+
+    def notify(self, attempt_listener, attempt: RetryAttempt):
+        if attempt_listener is not None:
+            try:
+                attempt_listener(attempt)
+            except Exception as e:
+                print("Error recording retry attempt: " + str(e))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def default_retry_policy() -> RetryPolicy:
+    return DEFAULT_RETRY_POLICY
+
+
+def set_default_retry_policy(retry_policy: RetryPolicy):
+    global DEFAULT_RETRY_POLICY
+    DEFAULT_RETRY_POLICY = retry_policy
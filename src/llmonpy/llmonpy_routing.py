@@ -0,0 +1,148 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import math
+import threading
+import time
+from collections import deque
+
+DEFAULT_OUTCOME_WINDOW = 50  # recent attempts used for the error rate
+HEALTH_HALF_LIFE = 30.0  # seconds for an old observation to count half as much
+MIN_SUCCESS_RATE = 0.05
+ADMISSION_WAIT_SMOOTHING = 0.2
+
+
+def decay_weight(age):
+    result = math.pow(0.5, age / HEALTH_HALF_LIFE)
+    return result
+
+
+"""
+  ClientHealth is what a client knows about itself for routing: how many calls it has running, how recent attempts
+  turned out, and how long calls have been waiting for a ratellmiter ticket or token room.  The admission wait is
+  the live measure of how close the client is to its rate limits.  Old observations fade, so an endpoint that was
+  degraded gets tried again once it has been left alone for a while.
+"""
+
+
+class ClientHealth:
+    def __init__(self, outcome_window=DEFAULT_OUTCOME_WINDOW):
+        self.health_lock = threading.Lock()
+        self.outcome_queue = deque(maxlen=outcome_window)  # (time, succeeded)
+        self.in_flight_count = 0
+        self.admission_wait = 0.0
+        self.admission_wait_time = 0.0
+
+    def start_call(self):
+        with self.health_lock:
+            self.in_flight_count += 1
+
+    def finish_call(self):
+        with self.health_lock:
+            self.in_flight_count -= 1
+
+    def record_outcome(self, succeeded):
+        with self.health_lock:
+            self.outcome_queue.append((time.time(), succeeded))
+
+    def record_admission_wait(self, wait):
+        current_time = time.time()
+        with self.health_lock:
+            previous_wait = self.unsafe_get_admission_wait(current_time)
+            self.admission_wait = previous_wait + ADMISSION_WAIT_SMOOTHING * (wait - previous_wait)
+            self.admission_wait_time = current_time
+
+    def unsafe_get_admission_wait(self, current_time):
+        result = self.admission_wait * decay_weight(current_time - self.admission_wait_time)
+        return result
+
+    def get_admission_wait(self):
+        with self.health_lock:
+            result = self.unsafe_get_admission_wait(time.time())
+        return result
+
+    def get_in_flight_count(self):
+        with self.health_lock:
+            result = self.in_flight_count
+        return result
+
+    # success rate with each outcome weighted by how recent it is, 1.0 with no history
+    def get_success_rate(self):
+        current_time = time.time()
+        total_weight = 1.0  # one imaginary success keeps a single failure from condemning a client
+        success_weight = 1.0
+        with self.health_lock:
+            for outcome_time, succeeded in self.outcome_queue:
+                weight = decay_weight(current_time - outcome_time)
+                total_weight += weight
+                if succeeded:
+                    success_weight += weight
+        result = success_weight / total_weight
+        return result
+
+
+"""
+  LlmClientGroup is a set of clients that serve the same model, different providers or deployments of one set of
+  weights.  Each call picks the member with the lowest expected time: its admission wait plus its median latency,
+  times one more than the calls it already has running or queued, divided by its success rate.  A prompt is queued
+  for its member as soon as it is submitted, so a burst of prompts submitted together is spread across the group
+  instead of every one scoring the same and going to one member.  Members with no latency history are given the
+  best latency in the group, so they are tried.  Ties go to the member with the lighter load.
+"""
+
+
+class LlmClientGroup:
+    def __init__(self, group_name, client_list):
+        self.group_name = group_name
+        self.client_list = client_list
+
+    def get_group_name(self):
+        return self.group_name
+
+    def get_client_list(self):
+        return self.client_list
+
+    def select_client(self, candidate_list=None):
+        candidate_list = candidate_list if candidate_list is not None else self.client_list
+        if len(candidate_list) == 0:
+            raise KeyError("No active client in group " + self.group_name)
+        latency_list = [client.get_median_latency() for client in candidate_list]
+        known_latency_list = [latency for latency in latency_list if latency is not None]
+        default_latency = min(known_latency_list) if len(known_latency_list) > 0 else 1.0
+        result = None
+        best_key = None
+        for client, latency in zip(candidate_list, latency_list):
+            latency = latency if latency is not None else default_latency
+            health = client.get_health()
+            load = client.get_load()
+            expected_time = ((health.get_admission_wait() + latency) * (load + 1) /
+                             max(health.get_success_rate(), MIN_SUCCESS_RATE))
+            key = (expected_time, load)
+            if best_key is None or key < best_key:
+                best_key = key
+                result = client
+        return result
+
+
+LLM_CLIENT_GROUP_DICT = {}
+
+
+def add_llm_client_group(group: LlmClientGroup):
+    LLM_CLIENT_GROUP_DICT[group.get_group_name()] = group
+    return group
+
+
+def get_llm_client_group(group_name) -> LlmClientGroup:
+    result = LLM_CLIENT_GROUP_DICT.get(group_name, None)
+    return result
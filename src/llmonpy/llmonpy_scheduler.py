@@ -0,0 +1,267 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import concurrent.futures
+import threading
+from collections import deque
+
+DEFAULT_PROMPT_WORKER_COUNT = 200
+DEFAULT_PYPELINE_WORKER_COUNT = 100
+DEFAULT_PROVIDER_CONCURRENCY_LIMIT = 100
+DEFAULT_MODEL_CONCURRENCY_LIMIT = None  # no per model limit unless one is set
+PROVIDER_KEY_PREFIX = "provider:"
+MODEL_KEY_PREFIX = "model:"
+
+
+def provider_key(provider_name):
+    return PROVIDER_KEY_PREFIX + str(provider_name)
+
+
+def model_key(model_name):
+    return MODEL_KEY_PREFIX + str(model_name)
+
+
+class ScheduledTask:
+    def __init__(self, provider_name, model_name, function, args, kwargs):
+        self.provider_key = provider_key(provider_name)
+        self.model_key = model_key(model_name)
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+
+
+class SchedulerStatus:
+    def __init__(self, running_prompt_count, queued_prompt_count, running_pypeline_count, queued_pypeline_count,
+                 running_count_dict, queued_count_dict):
+        self.running_prompt_count = running_prompt_count
+        self.queued_prompt_count = queued_prompt_count
+        self.running_pypeline_count = running_pypeline_count
+        self.queued_pypeline_count = queued_pypeline_count
+        self.running_count_dict = running_count_dict
+        self.queued_count_dict = queued_count_dict
+
+    def to_dict(self):
+        result = dict(vars(self))
+        return result
+
+
+"""
+  LLMonPyScheduler owns every worker thread llmonpy uses to run steps.  Prompts are queued per model and only
+  handed to the bounded prompt worker set when both the provider and the model are under their concurrency limits.
+  Pypeline steps mostly block waiting for their children, so they run in their own lane.  If they shared the prompt
+  workers, a wide tournament could fill every worker with pypelines waiting on prompts that can never start.
+"""
+
+
+class LLMonPyScheduler:
+    _instance = None
+    initialized = False
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(LLMonPyScheduler, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, prompt_worker_count=DEFAULT_PROMPT_WORKER_COUNT,
+                 pypeline_worker_count=DEFAULT_PYPELINE_WORKER_COUNT,
+                 provider_concurrency_limit=DEFAULT_PROVIDER_CONCURRENCY_LIMIT,
+                 model_concurrency_limit=DEFAULT_MODEL_CONCURRENCY_LIMIT):
+        # __new__ hands back the running instance, its workers and queues aren't replaced
+        if self.initialized:
+            return
+        self.initialized = True
+        self.prompt_worker_count = prompt_worker_count
+        self.pypeline_worker_count = pypeline_worker_count
+        self.provider_concurrency_limit = provider_concurrency_limit
+        self.model_concurrency_limit = model_concurrency_limit
+        self.prompt_executor = concurrent.futures.ThreadPoolExecutor(max_workers=prompt_worker_count,
+                                                                     thread_name_prefix="llmonpy_prompt")
+        self.pypeline_executor = concurrent.futures.ThreadPoolExecutor(max_workers=pypeline_worker_count,
+                                                                       thread_name_prefix="llmonpy_pypeline")
+        self.scheduler_lock = threading.Lock()
+        self.concurrency_limit_dict = {}
+        self.running_count_dict = {}
+        self.queue_dict = {}  # model key -> deque of ScheduledTask, only models with queued tasks are present
+        self.running_prompt_count = 0
+        self.queued_prompt_count = 0
+        self.running_pypeline_count = 0
+        self.queued_pypeline_count = 0
+
+    def stop(self):
+        self.prompt_executor.shutdown(wait=False, cancel_futures=True)
+        self.pypeline_executor.shutdown(wait=False, cancel_futures=True)
+
+    def set_provider_concurrency_limit(self, provider_name, limit):
+        with self.scheduler_lock:
+            self.concurrency_limit_dict[provider_key(provider_name)] = limit
+        self.dispatch()
+
+    def set_model_concurrency_limit(self, model_name, limit):
+        with self.scheduler_lock:
+            self.concurrency_limit_dict[model_key(model_name)] = limit
+        self.dispatch()
+
+    def get_prompt_lane(self, provider_name, model_name):
+        return SchedulerLane(self, provider_name, model_name)
+
+    def get_pypeline_lane(self):
+        return SchedulerLane(self)
+
+    def submit_prompt(self, provider_name, model_name, function, *args, **kwargs) -> concurrent.futures.Future:
+        task = ScheduledTask(provider_name, model_name, function, args, kwargs)
+        with self.scheduler_lock:
+            task_queue = self.queue_dict.get(task.model_key, None)
+            if task_queue is None:
+                task_queue = deque()
+                self.queue_dict[task.model_key] = task_queue
+            task_queue.append(task)
+            self.queued_prompt_count += 1
+        self.dispatch()
+        return task.future
+
+    def submit_pypeline(self, function, *args, **kwargs) -> concurrent.futures.Future:
+        with self.scheduler_lock:
+            self.queued_pypeline_count += 1
+        result = self.pypeline_executor.submit(self.run_pypeline, function, args, kwargs)
+        result.add_done_callback(self.pypeline_done)
+        return result
+
+    # a pypeline cancelled before it ran never reaches run_pypeline
+    def pypeline_done(self, future: concurrent.futures.Future):
+        if future.cancelled():
+            with self.scheduler_lock:
+                self.queued_pypeline_count -= 1
+
+    def run_pypeline(self, function, args, kwargs):
+        with self.scheduler_lock:
+            self.queued_pypeline_count -= 1
+            self.running_pypeline_count += 1
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            with self.scheduler_lock:
+                self.running_pypeline_count -= 1
+        return result
+
+    def get_limit(self, key, default_limit):
+        result = self.concurrency_limit_dict.get(key, default_limit)
+        return result
+
+    def unsafe_has_capacity(self, task: ScheduledTask):
+        provider_limit = self.get_limit(task.provider_key, self.provider_concurrency_limit)
+        model_limit = self.get_limit(task.model_key, self.model_concurrency_limit)
+        provider_ok = provider_limit is None or self.running_count_dict.get(task.provider_key, 0) < provider_limit
+        model_ok = model_limit is None or self.running_count_dict.get(task.model_key, 0) < model_limit
+        return provider_ok and model_ok
+
+    def unsafe_take_ready_tasks(self):
+        result = []
+        made_progress = True
+        # round robin across models so one busy model can't starve the others
+        while made_progress and self.running_prompt_count < self.prompt_worker_count:
+            made_progress = False
+            for key in list(self.queue_dict.keys()):
+                if self.running_prompt_count >= self.prompt_worker_count:
+                    break
+                task_queue = self.queue_dict[key]
+                task = task_queue[0]
+                if self.unsafe_has_capacity(task):
+                    task_queue.popleft()
+                    if len(task_queue) == 0:
+                        del self.queue_dict[key]
+                    self.queued_prompt_count -= 1
+                    if task.future.set_running_or_notify_cancel():
+                        self.running_prompt_count += 1
+                        self.running_count_dict[task.provider_key] = self.running_count_dict.get(task.provider_key, 0) + 1
+                        self.running_count_dict[task.model_key] = self.running_count_dict.get(task.model_key, 0) + 1
+                        result.append(task)
+                    made_progress = True
+        return result
+
+    # cancelled tasks would otherwise sit in their queue until they reach the front
+    def discard_cancelled_tasks(self):
+        with self.scheduler_lock:
+            for key in list(self.queue_dict.keys()):
+                task_queue = self.queue_dict[key]
+                kept_queue = deque(task for task in task_queue if task.future.cancelled() is False)
+                self.queued_prompt_count -= len(task_queue) - len(kept_queue)
+                if len(kept_queue) == 0:
+                    del self.queue_dict[key]
+                else:
+                    self.queue_dict[key] = kept_queue
+
+    def dispatch(self):
+        with self.scheduler_lock:
+            ready_list = self.unsafe_take_ready_tasks()
+        for task in ready_list:
+            self.prompt_executor.submit(self.run_prompt, task)
+
+    def run_prompt(self, task: ScheduledTask):
+        try:
+            result = task.function(*task.args, **task.kwargs)
+            task.future.set_result(result)
+        except BaseException as e:
+            task.future.set_exception(e)
+        finally:
+            with self.scheduler_lock:
+                self.running_prompt_count -= 1
+                self.running_count_dict[task.provider_key] -= 1
+                self.running_count_dict[task.model_key] -= 1
+            self.dispatch()
+
+    # (queued, running) prompts of model_name, a prompt counts as soon as it is submitted
+    def get_model_load(self, model_name):
+        key = model_key(model_name)
+        with self.scheduler_lock:
+            task_queue = self.queue_dict.get(key, None)
+            result = len(task_queue) if task_queue is not None else 0, self.running_count_dict.get(key, 0)
+        return result
+
+    def get_queue_depth(self):
+        with self.scheduler_lock:
+            result = self.queued_prompt_count + self.queued_pypeline_count
+        return result
+
+    def get_status(self) -> SchedulerStatus:
+        with self.scheduler_lock:
+            queued_count_dict = {key: len(task_queue) for key, task_queue in self.queue_dict.items()}
+            result = SchedulerStatus(self.running_prompt_count, self.queued_prompt_count,
+                                     self.running_pypeline_count, self.queued_pypeline_count,
+                                     dict(self.running_count_dict), queued_count_dict)
+        return result
+
+    @staticmethod
+    def get_instance():
+        return LLMonPyScheduler._instance
+
+
+# looks like an executor to the steps, so they can keep calling get_thread_pool().submit(...)
+class SchedulerLane:
+    def __init__(self, scheduler: LLMonPyScheduler, provider_name=None, model_name=None):
+        self.scheduler = scheduler
+        self.provider_name = provider_name
+        self.model_name = model_name
+
+    def submit(self, function, *args, **kwargs) -> concurrent.futures.Future:
+        if self.provider_name is None:
+            result = self.scheduler.submit_pypeline(function, *args, **kwargs)
+        else:
+            result = self.scheduler.submit_prompt(self.provider_name, self.model_name, function, *args, **kwargs)
+        return result
+
+
+def llmonpy_scheduler() -> LLMonPyScheduler:
+    result = LLMonPyScheduler.get_instance()
+    return result
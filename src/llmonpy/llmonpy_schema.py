@@ -0,0 +1,358 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import copy
+import hashlib
+import inspect
+import json
+import re
+import threading
+import typing
+
+SCHEMA_NAME_MAX_LENGTH = 64
+# keywords providers with a JSON schema subset reject
+GEMINI_UNSUPPORTED_KEYWORDS = {"additionalProperties", "$schema", "title", "default"}
+JSON_TYPE_CHECKS = {
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: (isinstance(value, int) and not isinstance(value, bool)) or
+                             (isinstance(value, float) and value.is_integer()),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "null": lambda value: value is None
+}
+PYTHON_TYPE_SCHEMAS = {int: "integer", float: "number", str: "string", bool: "boolean", dict: "object",
+                       list: "array"}
+
+
+class LLMonPySchemaValidationException(Exception):
+    def __init__(self, schema_name, error_message):
+        super().__init__("Output doesn't match schema " + schema_name + ": " + error_message)
+        self.schema_name = schema_name
+        self.error_message = error_message
+
+
+def compile_type_check(type_value):
+    type_list = type_value if isinstance(type_value, list) else [type_value]
+    check_list = [JSON_TYPE_CHECKS[type_name] for type_name in type_list if type_name in JSON_TYPE_CHECKS]
+    type_text = "/".join(type_list)
+
+    def check_type(value, path):
+        result = None
+        if not any(check(value) for check in check_list):
+            result = path + " is not " + type_text
+        return result
+    return check_type
+
+
+def compile_enum_check(enum_list):
+    def check_enum(value, path):
+        result = None if value in enum_list else path + " is not one of " + json.dumps(enum_list)
+        return result
+    return check_enum
+
+
+def compile_object_check(schema):
+    property_validator_dict = {key: compile_schema(property_schema)
+                               for key, property_schema in schema.get("properties", {}).items()}
+    required_list = schema.get("required", [])
+    additional_properties = schema.get("additionalProperties", True)
+    additional_validator = compile_schema(additional_properties) if isinstance(additional_properties, dict) else None
+
+    def check_object(value, path):
+        result = None
+        if isinstance(value, dict):
+            for key in required_list:
+                if key not in value:
+                    result = path + "." + key + " is missing"
+                    break
+            if result is None:
+                for key, item in value.items():
+                    property_validator = property_validator_dict.get(key, additional_validator)
+                    if property_validator is not None:
+                        result = property_validator(item, path + "." + key)
+                    elif additional_properties is False:
+                        result = path + "." + key + " is not allowed"
+                    if result is not None:
+                        break
+        return result
+    return check_object
+
+
+def compile_array_check(item_schema):
+    item_validator = compile_schema(item_schema)
+
+    def check_array(value, path):
+        result = None
+        if isinstance(value, list):
+            for index, item in enumerate(value):
+                result = item_validator(item, path + "[" + str(index) + "]")
+                if result is not None:
+                    break
+        return result
+    return check_array
+
+
+def compile_any_of_check(schema_list):
+    validator_list = [compile_schema(schema) for schema in schema_list]
+
+    def check_any_of(value, path):
+        result = None
+        error_list = [validator(value, path) for validator in validator_list]
+        if all(error is not None for error in error_list):
+            result = error_list[0]
+        return result
+    return check_any_of
+
+
+# Turns a JSON schema into a function of (value, path) that returns the first error or None.  The schema is walked
+# once here, so checking a response only runs the checks the schema needs.  Covers the keywords output schemas use:
+# type, enum, properties, required, additionalProperties, items and anyOf.
+def compile_schema(schema):
+    check_list = []
+    if "type" in schema:
+        check_list.append(compile_type_check(schema["type"]))
+    if "enum" in schema:
+        check_list.append(compile_enum_check(schema["enum"]))
+    if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+        check_list.append(compile_object_check(schema))
+    if "items" in schema:
+        check_list.append(compile_array_check(schema["items"]))
+    if "anyOf" in schema:
+        check_list.append(compile_any_of_check(schema["anyOf"]))
+
+    def validate(value, path):
+        result = None
+        for check in check_list:
+            result = check(value, path)
+            if result is not None:
+                break
+        return result
+    return validate
+
+
+# OpenAI's strict mode needs every property required, no other properties and a type on everything
+def is_strict_schema(schema):
+    result = "type" in schema or "anyOf" in schema or "enum" in schema
+    if result and "properties" in schema:
+        result = (schema.get("additionalProperties", True) is False and
+                  set(schema.get("required", [])) == set(schema["properties"].keys()) and
+                  all(is_strict_schema(property_schema) for property_schema in schema["properties"].values()))
+    if result and "items" in schema:
+        result = is_strict_schema(schema["items"])
+    if result and "anyOf" in schema:
+        result = all(is_strict_schema(any_schema) for any_schema in schema["anyOf"])
+    return result
+
+
+def without_keywords(schema, keyword_set):
+    if isinstance(schema, dict):
+        result = {key: without_keywords(value, keyword_set) for key, value in schema.items()
+                  if key not in keyword_set}
+        if isinstance(schema.get("properties", None), dict):
+            result["properties"] = {key: without_keywords(value, keyword_set)
+                                    for key, value in schema["properties"].items()}
+    elif isinstance(schema, list):
+        result = [without_keywords(value, keyword_set) for value in schema]
+    else:
+        result = schema
+    return result
+
+
+# Gemini takes an OpenAPI subset: no type lists, nullable instead, enums only on strings, and every schema needs
+# a type.  None when the
+# schema has a part without a type.
+def to_gemini_schema(schema):
+    result = without_keywords(schema, GEMINI_UNSUPPORTED_KEYWORDS)
+    type_value = result.get("type", None)
+    if isinstance(type_value, list):
+        type_list = [type_name for type_name in type_value if type_name != "null"]
+        result["type"] = type_list[0] if len(type_list) == 1 else None
+        if len(type_list) < len(type_value):
+            result["nullable"] = True
+    if result.get("type", None) is None:
+        result = None
+    elif "enum" in result and result["type"] != "string":
+        del result["enum"]  # Gemini only constrains strings to an enum
+    if result is not None and "properties" in result:
+        property_dict = {key: to_gemini_schema(value) for key, value in result["properties"].items()}
+        result["properties"] = property_dict
+        result = result if all(value is not None for value in property_dict.values()) else None
+    if result is not None and "items" in result:
+        result["items"] = to_gemini_schema(result["items"])
+        result = result if result["items"] is not None else None
+    return result
+
+
+def make_schema_example(schema, tag):
+    type_value = schema.get("type", "string")
+    type_name = type_value[0] if isinstance(type_value, list) else type_value
+    if "enum" in schema:
+        result = schema["enum"][0]
+    elif "anyOf" in schema:
+        result = make_schema_example(schema["anyOf"][0], tag)
+    elif type_name == "object":
+        result = {key: make_schema_example(property_schema, tag)
+                  for key, property_schema in schema.get("properties", {}).items()}
+    elif type_name == "array":
+        result = [make_schema_example(schema.get("items", {}), tag)]
+    elif type_name == "integer" or type_name == "number":
+        result = 1
+    elif type_name == "boolean":
+        result = True
+    elif type_name == "null":
+        result = None
+    else:
+        result = "simulated " + tag
+    return result
+
+
+"""
+  OutputSchema is the JSON schema of a prompt's output.  It is passed to the client as json_output, in place of
+  True, and each client hands it to its provider's structured output feature so the model is constrained to it.
+  Every parsed response is checked once with the compiled validator, and a response that doesn't match is retried
+  as a format error like one that doesn't parse.
+"""
+
+
+class OutputSchema:
+    def __init__(self, name, schema):
+        self.name = re.sub(r"[^A-Za-z0-9_-]", "_", name)[0:SCHEMA_NAME_MAX_LENGTH]
+        self.schema = schema
+        self.strict = is_strict_schema(schema)
+        self.validator = compile_schema(schema)
+        self.schema_key = hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def __bool__(self):
+        return True
+
+    def get_name(self):
+        return self.name
+
+    def get_schema(self):
+        return self.schema
+
+    def is_object_schema(self):
+        result = self.schema.get("type", None) == "object"
+        return result
+
+    def validate(self, value):
+        error_message = self.validator(value, "$")
+        if error_message is not None:
+            raise LLMonPySchemaValidationException(self.name, error_message)
+
+    def is_valid(self, value):
+        result = self.validator(value, "$") is None
+        return result
+
+    def get_gemini_schema(self):
+        result = to_gemini_schema(self.schema)
+        return result
+
+    # for providers without structured output, the schema goes in the prompt
+    def get_instruction_text(self):
+        result = "\n\nRespond with JSON that matches this JSON schema:\n" + json.dumps(self.schema)
+        return result
+
+    def make_example(self, tag):
+        result = make_schema_example(self.schema, tag)
+        return result
+
+    def to_dict(self):
+        result = {"name": self.name, "schema": copy.deepcopy(self.schema)}
+        return result
+
+
+def get_output_schema(json_output) -> OutputSchema:
+    result = json_output if isinstance(json_output, OutputSchema) else None
+    return result
+
+
+# json_output as it goes in a cache key
+def output_format_key(json_output):
+    result = json_output.schema_key if isinstance(json_output, OutputSchema) else json_output
+    return result
+
+
+def schema_for_annotation(annotation):
+    result = {}
+    origin = typing.get_origin(annotation)
+    if isinstance(annotation, list) and len(annotation) == 1:
+        # the [ItemClass] style of annotating lists
+        result = {"type": "array", "items": schema_for_annotation(annotation[0])}
+    elif annotation in PYTHON_TYPE_SCHEMAS:
+        result = {"type": PYTHON_TYPE_SCHEMAS[annotation]}
+    elif origin is list:
+        argument_list = typing.get_args(annotation)
+        result = {"type": "array"}
+        if len(argument_list) == 1:
+            result["items"] = schema_for_annotation(argument_list[0])
+    elif origin is dict:
+        result = {"type": "object"}
+    elif origin is typing.Union or type(annotation).__name__ == "UnionType":
+        argument_list = [argument for argument in typing.get_args(annotation) if argument is not type(None)]
+        if len(argument_list) == 1:
+            result = schema_for_annotation(argument_list[0])
+            if "type" in result:
+                result["type"] = [result["type"], "null"]
+    elif inspect.isclass(annotation) and hasattr(annotation, "to_dict"):
+        result = schema_from_output_class(annotation)
+        result = result if result is not None else {"type": "object"}
+    return result
+
+
+# The schema of the dict output_class is built from.  An explicit output_schema class attribute is used as is,
+# otherwise it comes from the parameters of __init__, since from_dict passes the dict to it as keyword arguments:
+# a parameter's annotation, or the type of its default, gives the property type and parameters without a default
+# are required.  None when there are no parameters to describe.
+def schema_from_output_class(output_class):
+    result = getattr(output_class, "output_schema", None)
+    if result is None:
+        property_dict = {}
+        required_list = []
+        additional_properties = False
+        for parameter in list(inspect.signature(output_class.__init__).parameters.values())[1:]:
+            if parameter.kind == inspect.Parameter.VAR_KEYWORD:
+                additional_properties = True
+            elif parameter.kind != inspect.Parameter.VAR_POSITIONAL:
+                if parameter.annotation is not inspect.Parameter.empty:
+                    property_schema = schema_for_annotation(parameter.annotation)
+                elif parameter.default is not inspect.Parameter.empty and parameter.default is not None:
+                    property_schema = schema_for_annotation(type(parameter.default))
+                else:
+                    property_schema = {}
+                property_dict[parameter.name] = property_schema
+                if parameter.default is inspect.Parameter.empty:
+                    required_list.append(parameter.name)
+        if len(property_dict) > 0:
+            result = {"type": "object", "properties": property_dict, "required": required_list,
+                      "additionalProperties": additional_properties}
+    return result
+
+
+OUTPUT_SCHEMA_DICT = {}
+OUTPUT_SCHEMA_LOCK = threading.Lock()
+
+
+# schemas are built and compiled once per output class
+def output_schema_for_class(output_class) -> OutputSchema:
+    with OUTPUT_SCHEMA_LOCK:
+        if output_class in OUTPUT_SCHEMA_DICT:
+            result = OUTPUT_SCHEMA_DICT[output_class]
+        else:
+            schema = schema_from_output_class(output_class)
+            result = OutputSchema(output_class.__qualname__, schema) if schema is not None else None
+            OUTPUT_SCHEMA_DICT[output_class] = result
+    return result
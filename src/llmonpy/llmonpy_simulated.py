@@ -0,0 +1,451 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import argparse
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ratellmiter.rate_llmiter import BucketRateLimiter
+
+from llmonpy.llm_client import LlmClient, LlmClientResponse, StreamState, LLMONPY_API_PREFIX
+from llmonpy.llmonpy_retry import REQUEST_TIMEOUT_STATUS_CODE
+from llmonpy.llmonpy_schema import get_output_schema, OutputSchema
+from llmonpy.llmonpy_token_limiter import estimate_token_count
+
+SIMULATED_PROVIDER = "SIMULATED"
+SIMULATED_LLM_ENVIRONMENT_KEY = LLMONPY_API_PREFIX + "SIMULATED_LLM"
+LATENCY_FIXED = "fixed"
+LATENCY_UNIFORM = "uniform"
+LATENCY_LOGNORMAL = "lognormal"
+DEFAULT_SIMULATED_REQUESTS_PER_SECOND = 100000
+DEFAULT_SERVER_PORT = 8089
+STREAM_CHUNK_SIZE = 16  # characters per streamed delta
+QUOTED_OPTION_PATTERN = re.compile(r"'([A-Za-z][A-Za-z ]{0,30})'")
+
+
+class SimulatedLlmException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SimulationSettings:
+    def __init__(self, latency_distribution=LATENCY_LOGNORMAL, median_latency=0.5, latency_spread=0.5,
+                 max_latency=30.0, time_per_output_token=0.0, output_tokens=None, rate_limit_rate=0.0,
+                 server_error_rate=0.0, malformed_json_rate=0.0,
+                 requests_per_second=DEFAULT_SIMULATED_REQUESTS_PER_SECOND, seed=None):
+        self.latency_distribution = latency_distribution
+        self.median_latency = median_latency
+        # sigma for lognormal, +/- fraction of the median for uniform
+        self.latency_spread = latency_spread
+        self.max_latency = max_latency
+        self.time_per_output_token = time_per_output_token
+        # None counts the tokens in the generated text
+        self.output_tokens = output_tokens
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.malformed_json_rate = malformed_json_rate
+        self.requests_per_second = requests_per_second
+        self.seed = seed
+
+    def to_dict(self):
+        result = copy.copy(vars(self))
+        return result
+
+    @staticmethod
+    def from_dict(dictionary):
+        result = SimulationSettings(**dictionary)
+        return result
+
+
+# LLMONPY_SIMULATED_LLM can be 1/true for the default settings, a JSON object, or the path of a JSON file
+def simulation_settings_from_environment() -> SimulationSettings:
+    result = None
+    value = os.environ.get(SIMULATED_LLM_ENVIRONMENT_KEY, None)
+    if value is not None and value.strip().lower() not in ["", "0", "false", "no"]:
+        value = value.strip()
+        if value.lower() in ["1", "true", "yes"]:
+            result = SimulationSettings()
+        elif value.startswith("{"):
+            result = SimulationSettings.from_dict(json.loads(value))
+        else:
+            with open(value, "r") as file:
+                result = SimulationSettings.from_dict(json.load(file))
+    return result
+
+
+# every JSON object written out in the prompt, prompts show the model the format they want back
+def find_json_examples(prompt_text):
+    result = []
+    decoder = json.JSONDecoder()
+    i = prompt_text.find("{")
+    while i != -1:
+        try:
+            value, end_index = decoder.raw_decode(prompt_text, i)
+            if isinstance(value, dict) and len(value) > 0:
+                result.append(value)
+            i = prompt_text.find("{", end_index)
+        except ValueError:
+            i = prompt_text.find("{", i + 1)
+    return result
+
+
+# string values get a tag so different simulated responses don't look like duplicates to a tournament
+def tag_example(value, tag):
+    if isinstance(value, str):
+        result = value + " " + tag
+    elif isinstance(value, dict):
+        result = {key: tag_example(item, tag) for key, item in value.items()}
+    elif isinstance(value, list):
+        result = [tag_example(item, tag) for item in value]
+    else:
+        result = value
+    return result
+
+
+class SimulatedCompletion:
+    def __init__(self, response_text, input_tokens, output_tokens, latency):
+        self.response_text = response_text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.latency = latency
+
+
+"""
+  SimulatedLlmClient answers prompts without a network or a key.  JSON prompts are answered with one of the JSON
+  examples in the prompt text, text prompts with one of the quoted options ('Yes' or 'No') or a tagged placeholder.
+  The choice is a hash of the model, temp and prompt so runs repeat, and samples at temp > 0 are numbered so they
+  differ.  Latency, token counts, 429s, 5xxs and malformed JSON come from its SimulationSettings.
+  response_function(prompt_text, json_output) replaces the generated text when a test needs specific answers.
+"""
+
+
+class SimulatedLlmClient(LlmClient):
+    max_samples_per_call = 128
+
+    def __init__(self, model_name, max_input=120000, rate_limiter=None, provider_name=SIMULATED_PROVIDER,
+                 price_per_input_token=0.0, price_per_output_token=0.0, settings: SimulationSettings = None,
+                 response_function=None, register_client=True):
+        settings = settings if settings is not None else SimulationSettings()
+        rate_limiter = rate_limiter if rate_limiter is not None else BucketRateLimiter(settings.requests_per_second,
+                                                                                       SIMULATED_PROVIDER)
+        super().__init__(model_name, max_input, rate_limiter, provider_name, price_per_input_token,
+                         price_per_output_token, register_client=register_client)
+        self.settings = settings
+        self.response_function = response_function
+        self.random_lock = threading.Lock()
+        self.random_source = random.Random(settings.seed)
+        self.sample_count = 0
+
+    def start(self):
+        pass
+
+    # there is nothing to connect to, keys given to set_api_keys only shard the rate limits
+    def make_sdk_clients(self, api_key=None):
+        return None, None, None
+
+    def random_value(self):
+        with self.random_lock:
+            result = self.random_source.random()
+        return result
+
+    def next_sample_number(self):
+        with self.random_lock:
+            self.sample_count += 1
+            result = self.sample_count
+        return result
+
+    def sample_latency(self):
+        settings = self.settings
+        with self.random_lock:
+            if settings.latency_distribution == LATENCY_FIXED:
+                result = settings.median_latency
+            elif settings.latency_distribution == LATENCY_UNIFORM:
+                spread = settings.median_latency * settings.latency_spread
+                result = self.random_source.uniform(settings.median_latency - spread, settings.median_latency + spread)
+            else:
+                result = settings.median_latency * self.random_source.lognormvariate(0.0, settings.latency_spread)
+        result = min(max(result, 0.0), settings.max_latency)
+        return result
+
+    def make_response_text(self, prompt_text, json_output, temp):
+        if self.response_function is not None:
+            return self.response_function(prompt_text, json_output)
+        seed_text = self.model_name + "|" + str(temp) + "|" + prompt_text
+        if temp is not None and temp > 0.0:
+            seed_text += "|" + str(self.next_sample_number())
+        digest = hashlib.sha256(seed_text.encode("utf-8")).hexdigest()
+        choice = int(digest[:8], 16)
+        tag = digest[:6]
+        if json_output:
+            output_schema = get_output_schema(json_output)
+            example_list = find_json_examples(prompt_text)
+            if output_schema is not None:
+                # structured output, only examples that match the schema can come back
+                example_list = [example for example in example_list if output_schema.is_valid(example)]
+            if len(example_list) > 0:
+                result = json.dumps(tag_example(example_list[choice % len(example_list)], tag))
+            elif output_schema is not None:
+                result = json.dumps(output_schema.make_example(tag))
+            else:
+                result = json.dumps({"response": "simulated " + tag})
+        else:
+            option_list = QUOTED_OPTION_PATTERN.findall(prompt_text)
+            if len(option_list) > 0:
+                result = option_list[choice % len(option_list)]
+            else:
+                result = "Simulated response " + tag + " from " + self.model_name
+        return result
+
+    # raises the injected errors, the caller waits out the latency.  A response longer than max_output is cut off,
+    # as a provider would.
+    def simulate_completion(self, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                            max_output=None) -> SimulatedCompletion:
+        settings = self.settings
+        latency = self.sample_latency()
+        error_roll = self.random_value()
+        if error_roll < settings.rate_limit_rate:
+            raise SimulatedLlmException(429, "Simulated rate limit")
+        if error_roll < settings.rate_limit_rate + settings.server_error_rate:
+            raise SimulatedLlmException(500, "Simulated server error")
+        response_text = self.make_response_text(prompt_text, json_output, temp)
+        if json_output and self.random_value() < settings.malformed_json_rate:
+            response_text = "Sure! Here is the JSON you asked for: " + response_text[:int(len(response_text) / 2)]
+        full_prompt = prompt_text if system_prompt is None else system_prompt + prompt_text
+        input_tokens = estimate_token_count(full_prompt)
+        output_tokens = settings.output_tokens if settings.output_tokens is not None else \
+            estimate_token_count(response_text)
+        if max_output is not None and output_tokens > max_output:
+            response_text = response_text[:int(len(response_text) * max_output / output_tokens)]
+            output_tokens = max_output
+        latency += output_tokens * settings.time_per_output_token
+        result = SimulatedCompletion(response_text, input_tokens, output_tokens, latency)
+        return result
+
+    # a real SDK gives up when the call's timeout passes, so the simulated call does too
+    def get_wait_time(self, latency):
+        timeout = self.get_call_timeout()
+        result = min(latency, timeout) if timeout is not None else latency
+        return result
+
+    def do_prompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None) -> LlmClientResponse:
+        completion = self.simulate_completion(prompt_text, system_prompt, json_output, temp, max_output)
+        wait_time = self.get_wait_time(completion.latency)
+        time.sleep(wait_time)
+        if wait_time < completion.latency:
+            raise SimulatedLlmException(REQUEST_TIMEOUT_STATUS_CODE, "Simulated request timeout")
+        result = self.response_from_text(completion.response_text, json_output, completion.input_tokens,
+                                         completion.output_tokens)
+        return result
+
+    # the choices are generated together, so the call takes as long as the slowest one
+    def do_prompt_samples(self, prompt_text, system_prompt, json_output, temp, max_output,
+                          sample_count) -> LlmClientResponse:
+        completion_list = [self.simulate_completion(prompt_text, system_prompt, json_output, temp, max_output)
+                           for _ in range(sample_count)]
+        latency = max(completion.latency for completion in completion_list)
+        wait_time = self.get_wait_time(latency)
+        time.sleep(wait_time)
+        if wait_time < latency:
+            raise SimulatedLlmException(REQUEST_TIMEOUT_STATUS_CODE, "Simulated request timeout")
+        result = self.response_from_samples([completion.response_text for completion in completion_list],
+                                            completion_list[0].input_tokens,
+                                            sum(completion.output_tokens for completion in completion_list))
+        return result
+
+    async def do_aprompt(self, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                         max_output=None) -> LlmClientResponse:
+        completion = self.simulate_completion(prompt_text, system_prompt, json_output, temp, max_output)
+        wait_time = self.get_wait_time(completion.latency)
+        await asyncio.sleep(wait_time)
+        if wait_time < completion.latency:
+            raise SimulatedLlmException(REQUEST_TIMEOUT_STATUS_CODE, "Simulated request timeout")
+        result = self.response_from_text(completion.response_text, json_output, completion.input_tokens,
+                                         completion.output_tokens)
+        return result
+
+    # the time per output token is spread over the deltas, everything else is time to first token
+    def do_stream(self, stream_state: StreamState, prompt_text, system_prompt=None, json_output=False, temp=0.0,
+                  max_output=None):
+        completion = self.simulate_completion(prompt_text, system_prompt, json_output, temp, max_output)
+        text = completion.response_text
+        chunk_count = max(1, int((len(text) + STREAM_CHUNK_SIZE - 1) / STREAM_CHUNK_SIZE))
+        generation_time = completion.output_tokens * self.settings.time_per_output_token
+        first_token_latency = completion.latency - generation_time
+        wait_time = self.get_wait_time(first_token_latency)
+        time.sleep(wait_time)
+        if wait_time < first_token_latency:
+            raise SimulatedLlmException(REQUEST_TIMEOUT_STATUS_CODE, "Simulated request timeout")
+        for i in range(chunk_count):
+            if i > 0:
+                time.sleep(generation_time / chunk_count)
+            yield text[i * STREAM_CHUNK_SIZE:(i + 1) * STREAM_CHUNK_SIZE]
+        stream_state.set_usage(completion.input_tokens, completion.output_tokens)
+
+    # stands in for another client under the same model name, so pypelines written against real models run as is
+    @staticmethod
+    def shadow_of(llm_client: LlmClient, settings: SimulationSettings, rate_limiter=None):
+        result = SimulatedLlmClient(llm_client.model_name, llm_client.max_input, rate_limiter,
+                                    llm_client.provider_name, llm_client.price_per_input_token,
+                                    llm_client.price_per_output_token, settings, register_client=False)
+        result.max_samples_per_call = llm_client.max_samples_per_call
+        return result
+
+
+"""
+  A local stand-in for the OpenAI chat completions endpoint, backed by a SimulatedLlmClient.  Pointing the OpenAI SDK
+  at it (OPENAI_BASE_URL=http://localhost:8089/v1 with any OPENAI_API_KEY) measures the real client stack, HTTP
+  included, without a provider.  Injected errors come back as HTTP status codes and "stream": true is served as
+  server sent events.
+"""
+
+
+class SimulatedOpenAIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    simulated_client: SimulatedLlmClient = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.rstrip("/").endswith("/chat/completions") is False:
+            self.write_json(404, {"error": {"message": "Not found: " + self.path, "type": "invalid_request_error"}})
+            return
+        content_length = int(self.headers.get("Content-Length", 0))
+        request_dict = json.loads(self.rfile.read(content_length))
+        system_prompt = None
+        prompt_list = []
+        for message in request_dict.get("messages", []):
+            if message.get("role") == "system":
+                system_prompt = message.get("content")
+            else:
+                prompt_list.append(str(message.get("content")))
+        prompt_text = "\n".join(prompt_list)
+        response_format = request_dict.get("response_format", None)
+        json_output = response_format is not None and response_format.get("type") == "json_object"
+        if response_format is not None and response_format.get("type") == "json_schema":
+            json_schema = response_format.get("json_schema", {})
+            json_output = OutputSchema(json_schema.get("name", "response"), json_schema.get("schema", {}))
+        temp = request_dict.get("temperature", 0.0)
+        max_output = request_dict.get("max_completion_tokens", None) or request_dict.get("max_tokens", None)
+        model_name = request_dict.get("model", self.simulated_client.model_name)
+        stream = request_dict.get("stream", False)
+        sample_count = 1 if stream else int(request_dict.get("n", None) or 1)
+        try:
+            completion_list = [self.simulated_client.simulate_completion(prompt_text, system_prompt, json_output,
+                                                                         temp, max_output)
+                               for _ in range(sample_count)]
+        except SimulatedLlmException as e:
+            error_type = "rate_limit_exceeded" if e.status_code == 429 else "server_error"
+            self.write_json(e.status_code, {"error": {"message": str(e), "type": error_type}})
+            return
+        completion = completion_list[0]
+        time.sleep(max(sample.latency for sample in completion_list))
+        completion_id = "chatcmpl-" + uuid.uuid4().hex
+        output_tokens = sum(sample.output_tokens for sample in completion_list)
+        usage = {"prompt_tokens": completion.input_tokens, "completion_tokens": output_tokens,
+                 "total_tokens": completion.input_tokens + output_tokens}
+        if stream:
+            self.write_stream(completion_id, model_name, completion.response_text, usage)
+        else:
+            self.write_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model_name,
+                "choices": [{"index": index, "message": {"role": "assistant", "content": sample.response_text},
+                             "finish_reason": "stop"} for index, sample in enumerate(completion_list)],
+                "usage": usage
+            })
+
+    def write_json(self, status_code, response_dict):
+        body = json.dumps(response_dict).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_stream(self, completion_id, model_name, response_text, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        chunk_list = [response_text[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(response_text), STREAM_CHUNK_SIZE)]
+        for chunk_text in chunk_list:
+            self.write_event({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                              "model": model_name,
+                              "choices": [{"index": 0, "delta": {"content": chunk_text}, "finish_reason": None}]})
+        self.write_event({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                          "model": model_name, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                          "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def write_event(self, event_dict):
+        self.wfile.write(b"data: " + json.dumps(event_dict).encode("utf-8") + b"\n\n")
+
+
+class SimulatedOpenAIServer:
+    def __init__(self, port=DEFAULT_SERVER_PORT, settings: SimulationSettings = None, host="127.0.0.1"):
+        handler_class = type("BoundSimulatedOpenAIRequestHandler", (SimulatedOpenAIRequestHandler,), {
+            "simulated_client": SimulatedLlmClient("simulated-openai", settings=settings, register_client=False)
+        })
+        self.http_server = ThreadingHTTPServer((host, port), handler_class)
+        self.http_server.daemon_threads = True
+        self.server_thread = None
+
+    def get_base_url(self):
+        host, port = self.http_server.server_address[:2]
+        result = "http://" + str(host) + ":" + str(port) + "/v1"
+        return result
+
+    def start(self):
+        self.server_thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def serve_forever(self):
+        self.http_server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a simulated OpenAI compatible LLM endpoint.")
+    parser.add_argument("-port", type=int, default=DEFAULT_SERVER_PORT)
+    parser.add_argument("-settings", type=str, default=None, help="JSON object or path to a JSON settings file")
+    args = parser.parse_args()
+    server_settings = None
+    if args.settings is not None:
+        if args.settings.strip().startswith("{"):
+            server_settings = SimulationSettings.from_dict(json.loads(args.settings))
+        else:
+            with open(args.settings, "r") as settings_file:
+                server_settings = SimulationSettings.from_dict(json.load(settings_file))
+    server = SimulatedOpenAIServer(args.port, server_settings)
+    print("Simulated LLM listening on " + server.get_base_url())
+    server.serve_forever()
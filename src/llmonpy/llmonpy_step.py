@@ -12,19 +12,30 @@
 #   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
 #   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
 #   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
-import concurrent
 import copy
 import json
 import uuid
 
 from llmonpy.llm_client import get_llm_client, LlmClient, filter_clients_that_didnt_start
 from llmonpy.config import llmonpy_config
+from llmonpy.llmonpy_scheduler import SchedulerLane
 
 LLMONPY_OUTPUT_FORMAT_JSON = "json"
 LLMONPY_OUTPUT_FORMAT_TEXT = "text"
 EXAMPLE_LIST_KEY = "example_list"
 STEP_NAME_SEPARATOR = ":"
 TEMP_SETTING_KEY = "temp"
+SAMPLE_INDEX_SETTING_KEY = "sample_index"
+STREAM_SETTING_KEY = "stream"
+HEDGE_SETTING_KEY = "hedge"
+INPUT_OVERFLOW_SETTING_KEY = "input_overflow"
+OVERFLOW_MODEL_SETTING_KEY = "overflow_model_name"
+MAX_OUTPUT_SETTING_KEY = "max_output"
+# what a prompt runner does when a rendered prompt is longer than the model's max_input
+INPUT_OVERFLOW_SEND = "send"  # sent as is and left to the provider, max_input is checked against an estimate
+INPUT_OVERFLOW_REJECT = "reject"
+INPUT_OVERFLOW_TRUNCATE_EXAMPLES = "truncate_examples"  # drops examples from the start of the example list
+INPUT_OVERFLOW_ROUTE = "route"  # sends the prompt to the overflow model
 
 STEP_TYPE_PROMPT = "prompt"
 STEP_TYPE_TOURNEY = "tourney"
@@ -77,6 +88,33 @@ class LlmModelInfo:
         result = self.client_settings_dict.get(TEMP_SETTING_KEY, None)
         return result
 
+    # setting a sample index makes a response at temp > 0 cacheable, each index is a distinct sample
+    def get_sample_index(self):
+        result = self.client_settings_dict.get(SAMPLE_INDEX_SETTING_KEY, None)
+        return result
+
+    def get_stream(self):
+        result = self.client_settings_dict.get(STREAM_SETTING_KEY, False)
+        return result
+
+    def get_hedge(self):
+        result = self.client_settings_dict.get(HEDGE_SETTING_KEY, False)
+        return result
+
+    def get_input_overflow(self):
+        result = self.client_settings_dict.get(INPUT_OVERFLOW_SETTING_KEY, INPUT_OVERFLOW_SEND)
+        return result
+
+    # model with a larger context the route strategy sends a prompt that doesn't fit to
+    def get_overflow_model_name(self):
+        result = self.client_settings_dict.get(OVERFLOW_MODEL_SETTING_KEY, None)
+        return result
+
+    # None lets the prompt runner use the max_output learned for the step, see llmonpy_output_sizing
+    def get_max_output(self):
+        result = self.client_settings_dict.get(MAX_OUTPUT_SETTING_KEY, None)
+        return result
+
     def to_dict(self):
         result = copy.deepcopy(vars(self))
         return result
@@ -254,9 +292,33 @@ class TraceLogRecorderInterface:
     def record_exception(self, exception):
         raise NotImplementedError()
 
+    def record_attempt(self, attempt):
+        raise NotImplementedError()
+
+    def record_stream_metrics(self, time_to_first_token, tokens_per_second):
+        raise NotImplementedError()
+
+    def record_input_tokens(self, input_tokens, max_input, input_overflow=None):
+        raise NotImplementedError()
+
+    def record_output_tokens(self, output_tokens, max_output):
+        raise NotImplementedError()
+
     def record_cost(self, cost):
         raise NotImplementedError()
 
+    def set_cost_budget(self, cost_budget):
+        raise NotImplementedError()
+
+    def get_cost_budget(self):
+        raise NotImplementedError()
+
+    def set_deadline(self, deadline):
+        raise NotImplementedError()
+
+    def get_deadline(self):
+        raise NotImplementedError()
+
     def create_tourney_result(self, request_text, number_of_judges, judge_step_name) -> TourneyResultInterface:
         raise NotImplementedError()
 
@@ -309,8 +371,8 @@ class LLMonPyStep:
     def execute_step(self) -> (LLMonPyStepOutput, TraceLogRecorderInterface):
         raise NotImplementedError()
 
-    def get_thread_pool(self) -> concurrent.futures.ThreadPoolExecutor:
-        return llmonpy_config().thread_pool
+    def get_thread_pool(self) -> SchedulerLane:
+        return llmonpy_config().scheduler.get_pypeline_lane()
 
     def get_step_name(self):
         result = get_step_name_from_class_hierarchy(self.__class__)
@@ -0,0 +1,138 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import math
+import threading
+import time
+from collections import deque
+
+from llmonpy.llmonpy_deadline import check_deadline, remaining_time
+
+TOKEN_WINDOW_SECONDS = 60.0
+CHARS_PER_TOKEN = 4
+PUNCTUATION_CHARS_PER_TOKEN = 3
+DEFAULT_OUTPUT_RESERVATION = 1024  # tokens reserved for the response when the caller doesn't set max_output
+
+
+# Local heuristic, no tokenizer download.  English prose runs about 4 characters a token, punctuation tokenizes more
+# finely, so punctuation heavy text like JSON and code runs closer to 3.
+def estimate_token_count(text):
+    result = 0
+    if text:
+        punctuation_count = sum(1 for char in text if not char.isalnum() and not char.isspace())
+        result = int(math.ceil((len(text) - punctuation_count) / CHARS_PER_TOKEN +
+                               punctuation_count / PUNCTUATION_CHARS_PER_TOKEN))
+    return result
+
+
+class TokenReservation:
+    def __init__(self, token_rate_limiter, entry):
+        self.token_rate_limiter = token_rate_limiter
+        self.entry = entry
+        self.settled = False
+
+    def get_reserved_tokens(self):
+        return self.entry[1]
+
+    # replace the estimate with the usage the provider reported
+    def reconcile(self, used_tokens):
+        if self.settled is False:
+            self.settled = True
+            self.token_rate_limiter.adjust(self.entry, used_tokens)
+
+    # the request didn't reach the model, so nothing was used
+    def release(self):
+        self.reconcile(0)
+
+
+"""
+  TokenRateLimiter meters tokens per minute the way BucketRateLimiter meters requests per second.  A request reserves
+  its estimated input tokens plus the output it may generate, and waits until the last minute's tokens plus the
+  reservation fit under the limit.  When the response comes back the reservation is reconciled with the real usage,
+  so a long context prompt holds back the short ones behind it only for as long as it actually counts against the
+  provider's limit.  A request bigger than the whole limit is let through when the window is empty, otherwise it could
+  never run.
+"""
+
+
+class TokenRateLimiter:
+    def __init__(self, tokens_per_minute, name=None, window_seconds=TOKEN_WINDOW_SECONDS):
+        self.tokens_per_minute = tokens_per_minute
+        self.name = name
+        self.window_seconds = window_seconds
+        self.limiter_condition = threading.Condition()
+        self.entry_queue = deque()  # [time, tokens, in_window] in reservation order
+        self.tokens_in_window = 0
+        self.waiting_count = 0
+
+    def set_tokens_per_minute(self, tokens_per_minute):
+        with self.limiter_condition:
+            self.tokens_per_minute = tokens_per_minute
+            self.limiter_condition.notify_all()
+
+    def unsafe_expire_entries(self, current_time):
+        expire_time = current_time - self.window_seconds
+        while len(self.entry_queue) > 0 and self.entry_queue[0][0] <= expire_time:
+            entry = self.entry_queue.popleft()
+            entry[2] = False
+            self.tokens_in_window -= entry[1]
+
+    def unsafe_has_room(self, tokens):
+        result = (self.tokens_in_window + tokens <= self.tokens_per_minute or
+                  (len(self.entry_queue) == 0 and self.tokens_in_window <= 0))
+        return result
+
+    # a request still waiting for room when its deadline passes raises LLMonPyDeadlineExceededException
+    def reserve(self, tokens, deadline=None) -> TokenReservation:
+        with self.limiter_condition:
+            self.waiting_count += 1
+            try:
+                current_time = time.time()
+                self.unsafe_expire_entries(current_time)
+                while self.unsafe_has_room(tokens) is False:
+                    # wake when the oldest entry leaves the window, or sooner if a reservation is reconciled
+                    check_deadline(deadline, "Token reservation")
+                    wait_time = self.entry_queue[0][0] + self.window_seconds - current_time
+                    time_left = remaining_time(deadline)
+                    if time_left is not None:
+                        wait_time = min(wait_time, time_left)
+                    self.limiter_condition.wait(timeout=max(wait_time, 0.01))
+                    current_time = time.time()
+                    self.unsafe_expire_entries(current_time)
+                entry = [current_time, tokens, True]
+                self.entry_queue.append(entry)
+                self.tokens_in_window += tokens
+            finally:
+                self.waiting_count -= 1
+        result = TokenReservation(self, entry)
+        return result
+
+    def adjust(self, entry, tokens):
+        with self.limiter_condition:
+            # an entry that already left the window no longer counts, so only the entry itself is updated
+            if entry[2]:
+                self.tokens_in_window += tokens - entry[1]
+            entry[1] = tokens
+            self.limiter_condition.notify_all()
+
+    def get_tokens_in_window(self):
+        with self.limiter_condition:
+            self.unsafe_expire_entries(time.time())
+            result = self.tokens_in_window
+        return result
+
+    def get_waiting_count(self):
+        with self.limiter_condition:
+            result = self.waiting_count
+        return result
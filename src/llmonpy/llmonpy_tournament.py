@@ -26,6 +26,9 @@ from llmonpy.llmonpy_step import LLMonPyStep, LLMonPyStepOutput, TraceLogRecorde
 
 class TournamentJudgePrompt(JudgePrompt):
     class LLMonPyOutput(LLMonPyPrompt.LLMonPyOutput):
+        output_schema = {"type": "object", "properties": {"winner": {"type": "integer", "enum": [1, 2]}},
+                         "required": ["winner"], "additionalProperties": False}
+
         def __init__(self, winner: int):
             self.winner: int = winner
 
@@ -200,13 +203,13 @@ class RankOutputStep(LLMonPypeline):
     def execute_step(self, recorder: TraceLogRecorderInterface):
         start_index = 0
         contest_list = []
-        number_of_contestants = len(self.contestant_list)
-        number_of_judges = len(self.judgement_model_info_list)
+        number_of_contestants, judgement_model_info_list = self.fit_to_budget(recorder)
+        number_of_judges = len(judgement_model_info_list)
         self.tourney_result = recorder.create_tourney_result(self.request_text, number_of_judges, self.contestant_step_name)
         while start_index < (number_of_contestants - 1):
             for i in range(start_index + 1, number_of_contestants):
                 contest_list.append(CompareOutputStep(self.contestant_list[start_index], self.contestant_list[i],
-                                                      self.judgement_prompt, self.judgement_model_info_list).create_step(recorder))
+                                                      self.judgement_prompt, judgement_model_info_list).create_step(recorder))
             start_index += 1
         print("number of contests " + str(len(contest_list)))
         self.run_parallel_steps(contest_list, handle_result_function=self.record_victory)
@@ -215,6 +218,25 @@ class RankOutputStep(LLMonPypeline):
         result = OrderedStepOutputList(ordered_contestant_list)
         return result
 
+    # The round robin needs contests * judges prompts.  When the cost budget can't cover that the jury shrinks first,
+    # down to one judge, and then the contestants at the end of the list are left out of the ranking.
+    def fit_to_budget(self, recorder: TraceLogRecorderInterface):
+        number_of_contestants = len(self.contestant_list)
+        judgement_model_info_list = self.judgement_model_info_list
+        number_of_contests = (number_of_contestants * (number_of_contestants - 1)) // 2
+        prompt_count = number_of_contests * len(judgement_model_info_list)
+        affordable_count = self.get_affordable_prompt_count(recorder, prompt_count)
+        if affordable_count < prompt_count:
+            number_of_judges = max(affordable_count // number_of_contests, 1)
+            judgement_model_info_list = judgement_model_info_list[0:number_of_judges]
+            while number_of_contestants > 1 and number_of_contests * number_of_judges > affordable_count:
+                number_of_contestants -= 1
+                number_of_contests = (number_of_contestants * (number_of_contestants - 1)) // 2
+            recorder.log_message("cost budget covers " + str(affordable_count) + " of " + str(prompt_count) +
+                                 " prompts, ranking " + str(number_of_contestants) + " contestants with " +
+                                 str(number_of_judges) + " judges")
+        return number_of_contestants, judgement_model_info_list
+
     def record_victory(self, step):
         contest_result = step.get_step_output()
         self. tourney_result.add_contest_result(step.get_step_id(),contest_result.output_1_id, contest_result.output_2_id,
@@ -296,6 +318,9 @@ class AdaptiveICLCycle(LLMonPypeline):
         first_round_result_list = tournament.get_step_output().ordered_response_list
         self.update_example_list(first_round_result_list, recorder)
         for i in range(1, self.max_cycles):
+            if self.get_affordable_prompt_count(recorder, len(self.generation_model_info_list)) == 0:
+                recorder.log_message("cycle " + str(i) + " skipped, cost budget exhausted")
+                break
             tournament = LLMonPyTournament(self.generation_prompt, self.generation_model_info_list,
                                            self.judgement_prompt, self.judgement_model_info_list).create_step(recorder)
             recorder.set_step_examples(self.generation_prompt_name, self.get_example_output_list())
@@ -196,6 +196,21 @@ class JSONTable:
                 result.append(value)
         return result
 
+    # one field of the stored JSON for the newest rows where match_field is match_value.  Fields that aren't columns
+    # are read with json_extract, so rows written before the field existed are searched as well.
+    def select_json_values(self, value_field, match_field, match_value, limit):
+        statement = io.StringIO()
+        value_path = "json_extract(" + JSON_STRING_COLUMN_NAME + ", '$." + value_field + "')"
+        match_path = "json_extract(" + JSON_STRING_COLUMN_NAME + ", '$." + match_field + "')"
+        statement.write("SELECT " + value_path + " FROM " + self.table_name)
+        statement.write(" WHERE " + match_path + " = ? AND " + value_path + " IS NOT NULL")
+        statement.write(" ORDER BY rowid DESC LIMIT ?")
+        statement_text = statement.getvalue()
+        with self.connection_pool.acquire() as connection:
+            query_result = connection.execute(statement_text, (match_value, limit))
+            result = [row[0] for row in query_result.fetchall()]
+        return result
+
     def get_all(self, object_factory):
         statement = io.StringIO()
         statement.write("SELECT " + JSON_STRING_COLUMN_NAME + " FROM " + self.table_name)
@@ -284,6 +299,10 @@ class SqliteLLMonPyTraceStore:
         step_list = self.step_record_table.select_rows([trace_id_condition], self.step_record_factory)
         return step_list
 
+    def get_output_tokens_for_step_name(self, step_name, limit):
+        result = self.step_record_table.select_json_values("output_tokens", STEP_NAME_COLUMN_NAME, step_name, limit)
+        return result
+
     def get_events_for_trace(self, trace_id):
         trace_id_condition = QueryCondition(TRACE_ID_COLUMN_NAME, "=", trace_id)
         event_list = self.event_table.select_rows([trace_id_condition], self.event_factory)
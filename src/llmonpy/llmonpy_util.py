@@ -15,103 +15,177 @@
 import io
 import json
 import os
+import re
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 POST_DOUBLE_QUOTE_CHARS = { ":": ":", ",": ",","}": "}" }
 
 
-def next_nonwhitespace_char(input_string, i):
-    result = None
-    while i < len(input_string):
-        current_char = input_string[i]
-        if not current_char.isspace():
-            result = current_char
-            break
-        i += 1
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# a valid escape, a stray backslash, a quote or a raw control character, everything else in a value is copied as is
+VALUE_STRING_TOKEN = re.compile(r'\\(?:u[0-9a-fA-F]{4}|["\\/bfnrt])|\\|"|[\x00-\x1f]')
+# the rest of a key or array string, up to and including its closing quote
+OTHER_STRING_BODY = re.compile(r'(?:[^"\\]|\\.)*"?', re.DOTALL)
+CONTROL_CHAR_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+
+
+def loads_json(json_str):
+    if orjson is not None:
+        result = orjson.loads(json_str)
+    else:
+        result = json.loads(json_str)
     return result
 
 
-def last_nonwhitespace_char(input_string, i):
-    result = None
-    while i >= 0:
-        current_char = input_string[i]
-        if not current_char.isspace():
-            result = current_char
-            break
-        i -= 1
+# Most responses are valid JSON, so they are parsed as is and only repaired when that fails.  Returns the text that
+# was parsed, which is the repaired text when a repair was needed, and the parsed value.
+def parse_json_response(json_str):
+    try:
+        result = json_str, loads_json(json_str)
+    except ValueError:
+        fixed_json = fix_common_json_encoding_errors(json_str)
+        result = fixed_json, json.loads(fixed_json)
     return result
 
 
-# assumes " are balanced if not escaped
-def extract_value_string_exclude_last_quote(json_str, start_index):
+def write_value_string(json_str, start_index, string_builder):
     in_substring = False
-    result = None
-    last_char = "\""
-    for i in range(start_index, len(json_str)):
-        current_char = json_str[i]
-        if current_char == "\"" and last_char != "\\":
-            if not in_substring and next_nonwhitespace_char(json_str, i+1) in POST_DOUBLE_QUOTE_CHARS:
-                result = json_str[start_index:i]
+    current_index = start_index
+    max_index = len(json_str)
+    while True:
+        match = VALUE_STRING_TOKEN.search(json_str, current_index)
+        if match is None:
+            string_builder.write(json_str[current_index:])
+            current_index = max_index
+            break
+        string_builder.write(json_str[current_index:match.start()])
+        token = match.group()
+        current_index = match.end()
+        if token == "\"":
+            next_index = JSON_WHITESPACE.match(json_str, current_index).end()
+            next_char = json_str[next_index] if next_index < max_index else None
+            # a quote only closes the value when JSON structure follows it, and an inner quote that opened a quoted
+            # phrase is always taken to be closed by the next one
+            if in_substring is False and (next_char is None or next_char in POST_DOUBLE_QUOTE_CHARS):
+                string_builder.write(token)
                 break
-            else:
-                in_substring = not in_substring
-        last_char = current_char
-    return result, i
-
-
-def handle_json_special_characters_for_values(json_str, start_index, string_builder):
-    last_char = None
-    value_string, end_of_value_string_index = extract_value_string_exclude_last_quote(json_str, start_index)
-    for i in range(len(value_string)):
-        current_char = value_string[i]
-        if current_char == "\"" and last_char != "\\":
-            string_builder.write("\\\"") # escape double quote
+            in_substring = not in_substring
+            string_builder.write("\\\"")
+        elif token == "\\":
+            string_builder.write("\\\\")
+        elif len(token) == 1:
+            string_builder.write(CONTROL_CHAR_ESCAPES.get(token, "\\u%04x" % ord(token)))
         else:
-            if current_char == "\n":
-                string_builder.write("\\n")
-            elif current_char == "\r":
-                string_builder.write("\\r")
-            elif current_char == "\t":
-                string_builder.write("\\t")
-            elif current_char == "\b":
-                string_builder.write("\\b")
-            elif current_char == "\f":
-                string_builder.write("\\f")
-            elif current_char == "\\":
-                if len(value_string) > i+1 and value_string[i+1] != "\\" and value_string[i+1] != "\"" and \
-                        value_string[i+1] != "n" and value_string[i+1] != "r" and value_string[i+1] != "t" and \
-                        value_string[i+1] != "b" and value_string[i+1] != "f":
-                    string_builder.write("\\\\")
-                else:
-                    string_builder.write(current_char)
-            else:
-                string_builder.write(current_char)
-        last_char = current_char
-    string_builder.write("\"")
-    return end_of_value_string_index
+            string_builder.write(token)
+    return current_index
+
+
+"""
+  fix_common_json_encoding_errors repairs the mistakes models make writing string values: unescaped double quotes,
+  raw newlines and other control characters and stray backslashes.  It makes one pass over the text.  Outside of
+  strings it jumps from quote to quote with str.find, and inside a value it jumps between the characters that need
+  attention with a regular expression, so the Python loop runs once per quote or special character, not once per
+  character.  Key and array strings are copied unchanged.
+"""
 
 
 def fix_common_json_encoding_errors(json_str):
     if json_str is None:
         return None
-    result = json_str
     with io.StringIO() as string_builder:
-        current_char = None
-        last_char = None
+        last_structure_char = None
+        current_index = 0
         max_index = len(json_str)
-        current_char_index = 0
-        while current_char_index < max_index:
-            current_char = json_str[current_char_index]
-            string_builder.write(current_char)
-            if current_char == "\"" and last_char != "\\":
-                # only handle special characters between quotes for values, not keys.
-                if last_nonwhitespace_char(json_str, current_char_index-1) == ":":
-                    current_char_index = handle_json_special_characters_for_values(json_str, current_char_index + 1, string_builder)
-            last_char = json_str[current_char_index]
-            current_char_index += 1
+        while current_index < max_index:
+            quote_index = json_str.find("\"", current_index)
+            if quote_index < 0:
+                string_builder.write(json_str[current_index:])
+                break
+            segment = json_str[current_index:quote_index + 1]
+            string_builder.write(segment)
+            stripped_segment = segment[:-1].rstrip()
+            if len(stripped_segment) > 0:
+                last_structure_char = stripped_segment[-1]
+            # only handle special characters between quotes for values, not keys.
+            if last_structure_char == ":":
+                current_index = write_value_string(json_str, quote_index + 1, string_builder)
+            else:
+                match = OTHER_STRING_BODY.match(json_str, quote_index + 1)
+                string_builder.write(match.group())
+                current_index = match.end()
+            last_structure_char = "\""
         result = string_builder.getvalue()
     return result
 
 
+BENCHMARK_SYNTHETIC_SIZES = [10 * 1024, 100 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+BENCHMARK_MIN_SECONDS = 0.5
+
+
+# A list of objects whose values hold what models get wrong: quoted phrases, raw newlines, backslashes in paths and
+# embedded JSON.  Returns the broken text, which needs a repair, and the valid text of the same data.
+def make_synthetic_json(target_size):
+    item_list = []
+    size = 0
+    index = 0
+    while size < target_size:
+        item_list.append({"id": index,
+                          "criteria": 'The name is "memorable" and catchy,\nideally one to three words.',
+                          "passing_response": '{"name": "Response Relay ' + str(index) + '"}',
+                          "path": "C:\\data\\step_" + str(index) + "\\output.json",
+                          "notes": "Plain text with no special characters at all. " * 4})
+        size += 320
+        index += 1
+    valid_json = json.dumps({"checklist": item_list}, indent=2)
+    broken_list = []
+    for item in item_list:
+        broken_list.append('{\n"id": ' + str(item["id"]) + ',\n"criteria": "' + item["criteria"] +
+                           '",\n"passing_response": "' + item["passing_response"] + '",\n"path": "' + item["path"] +
+                           '",\n"notes": "' + item["notes"] + '"\n}')
+    broken_json = '{\n"checklist": [\n' + ",\n".join(broken_list) + "\n]\n}"
+    return broken_json, valid_json
+
+
+def measure_mb_per_second(function, text):
+    text_mb = len(text.encode("utf-8")) / (1024 * 1024)
+    run_count = 0
+    start_time = time.perf_counter()
+    elapsed_time = 0.0
+    while elapsed_time < BENCHMARK_MIN_SECONDS:
+        function(text)
+        run_count += 1
+        elapsed_time = time.perf_counter() - start_time
+    result = (text_mb * run_count) / elapsed_time
+    return result
+
+
+# Throughput of the response parse, both the fast path for valid JSON and the repair path, over the files in
+# test_data_directory and synthetic payloads of each size in synthetic_size_list.
+def benchmark_json_parsing(test_data_directory, synthetic_size_list=None):
+    synthetic_size_list = synthetic_size_list if synthetic_size_list is not None else BENCHMARK_SYNTHETIC_SIZES
+    payload_list = []
+    for file_name in sorted(os.listdir(test_data_directory)):
+        if file_name.endswith(".json"):
+            with open(os.path.join(test_data_directory, file_name), "r") as file:
+                payload_list.append((file_name, file.read(), None))
+    for size in synthetic_size_list:
+        broken_json, valid_json = make_synthetic_json(size)
+        payload_list.append(("synthetic_" + str(size // 1024) + "KB", broken_json, valid_json))
+    print("json parser: " + ("orjson" if orjson is not None else "json"))
+    print(f"{'payload':<32}{'KB':>10}{'repair MB/s':>14}{'parse MB/s':>14}{'valid parse MB/s':>18}")
+    for name, json_str, valid_json in payload_list:
+        repair_rate = measure_mb_per_second(fix_common_json_encoding_errors, json_str)
+        parse_rate = measure_mb_per_second(parse_json_response, json_str)
+        valid_rate = measure_mb_per_second(parse_json_response, valid_json) if valid_json is not None else None
+        valid_column = f"{valid_rate:>18.1f}" if valid_rate is not None else f"{'':>18}"
+        print(f"{name:<32}{len(json_str) / 1024:>10.1f}{repair_rate:>14.1f}{parse_rate:>14.1f}" + valid_column)
+
+
 if __name__ == "__main__":
     test_data_directory = "artifacts/json_test_data/"
     working_directory = os.getcwd()
@@ -121,9 +195,9 @@ if __name__ == "__main__":
             file_path = os.path.join(test_data_directory, file_name)
             with open(file_path, "r") as file:
                 json_str = file.read()
-                fixed_json = fix_common_json_encoding_errors(json_str)
                 try:
-                    json.loads(fixed_json)
+                    parse_json_response(json_str)
                     print(f"JSON is valid. {file_path}")
                 except Exception as e:
                     print(f"Error in file {file_path} {str(e)}")
+    benchmark_json_parsing(test_data_directory)
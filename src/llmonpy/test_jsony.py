@@ -0,0 +1,107 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import json
+import os
+
+import pytest
+
+from llmonpy.jsony import JsonyStreamParser, jsony_to_json
+
+JSONY_TEST_DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "..", "artifacts", "jsony_test_data")
+
+VALID_JSON_LIST = [
+    '[1, 2, 3]',
+    '["x", "y"]',
+    '[]',
+    '[[1, 2], [3, [4, 5]]]',
+    '[{"a": 1}, {"b": [1, 2]}, "c", null]',
+    '{"a": [1, 2], "b": {"c": {"d": [true, false]}}, "e": "f"}',
+    '{"winner": 1, "reason": "the first \\"answer\\" is better"}',
+    '{"path": "C:\\\\temp\\\\file.txt", "unicode": "caf\\u00e9", "slash": "a\\/b"}',
+]
+
+
+def parse_in_chunks(text, chunk_size):
+    parser = JsonyStreamParser()
+    for start in range(0, len(text), chunk_size):
+        assert parser.feed(text[start:start + chunk_size]), parser.error_message
+    result = json.loads(parser.finish())
+    return result
+
+
+@pytest.mark.parametrize("json_text", VALID_JSON_LIST)
+def test_valid_json_is_unchanged(json_text):
+    assert json.loads(jsony_to_json(json_text)) == json.loads(json_text)
+
+
+@pytest.mark.parametrize("json_text", VALID_JSON_LIST)
+def test_every_chunk_boundary(json_text):
+    expected = json.loads(json_text)
+    for split_index in range(1, len(json_text)):
+        parser = JsonyStreamParser()
+        assert parser.feed(json_text[:split_index]), parser.error_message
+        assert parser.feed(json_text[split_index:]), parser.error_message
+        assert json.loads(parser.finish()) == expected
+    assert parse_in_chunks(json_text, 1) == expected
+
+
+def test_top_level_array_has_no_fields():
+    field_list = []
+    parser = JsonyStreamParser(lambda key, value: field_list.append(key))
+    assert parser.feed('[{"a": 1}, {"b": 2}, 3]')
+    assert json.loads(parser.finish()) == [{"a": 1}, {"b": 2}, 3]
+    assert field_list == []
+    assert parser.get_field_dict() == {}
+
+
+def test_fields_of_a_top_level_object_are_emitted_as_they_close():
+    field_list = []
+    parser = JsonyStreamParser(lambda key, value: field_list.append((key, value)))
+    parser.feed('{"winner": 1, "nested": {"a": [1, ')
+    assert field_list == [("winner", 1)]
+    parser.feed('2]}, "reason": "because')
+    assert field_list == [("winner", 1), ("nested", {"a": [1, 2]})]
+    parser.feed('"}')
+    parser.finish()
+    assert parser.get_field_dict() == {"winner": 1, "nested": {"a": [1, 2]}, "reason": "because"}
+
+
+def test_quotes_and_escapes_split_across_chunks():
+    # the quote that might close the string and the character that decides it arrive in different chunks
+    assert parse_in_chunks('{"a": "say "hi" now", "b": 1}', 1) == {"a": 'say "hi" now', "b": 1}
+    # a backslash at the end of a chunk is resolved by the next chunk
+    assert parse_in_chunks('{"a": "line\\nnext\\q"}', 1) == {"a": "line\nnext\\q"}
+    assert parse_in_chunks("{'a': 'it\\'s', 'b': [True, None]}", 1) == {"a": "it's", "b": [True, None]}
+    assert parse_in_chunks('["raw\nnewline", "tab\there"]', 1) == ["raw\nnewline", "tab\there"]
+
+
+def test_code_fence_and_trailing_text_are_dropped():
+    assert parse_in_chunks('```json\n[1, 2]\n```', 3) == [1, 2]
+
+
+def test_invalid_text_fails_early():
+    parser = JsonyStreamParser()
+    assert parser.feed("Sure! Here is the JSON") is False
+    parser = JsonyStreamParser()
+    assert parser.feed("[1, 2}") is False
+    parser = JsonyStreamParser()
+    assert parser.feed('{"a": undefined, ') is False
+
+
+def test_jsony_test_data():
+    with open(os.path.join(JSONY_TEST_DATA_DIRECTORY, "jsony_input.txt"), "r") as file:
+        jsony_text = file.read()
+    expected = json.loads(jsony_to_json(jsony_text))
+    assert parse_in_chunks(jsony_text, 7) == expected
@@ -0,0 +1,53 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import pytest
+
+pytest.importorskip("ratellmiter")
+
+from llmonpy.llmonpy_simulated import SimulatedLlmClient
+
+TEST_KEY_NAME = "LLMONPY_TEST_KEY_LIST"
+
+
+class MultiKeyClient(SimulatedLlmClient):
+    api_key_name = TEST_KEY_NAME
+
+
+class SingleKeyClient(SimulatedLlmClient):
+    api_key_name = TEST_KEY_NAME
+    multiple_api_keys_supported = False
+
+
+def test_several_keys_make_a_pool(monkeypatch):
+    monkeypatch.setenv(TEST_KEY_NAME, "key-one, key-two:org-two")
+    client = MultiKeyClient("test-multi-key", register_client=False)
+    client.load_api_keys()
+    shard_list = client.get_api_key_pool().get_shard_list()
+    assert [shard.api_key.key for shard in shard_list] == ["key-one", "key-two"]
+    assert shard_list[1].api_key.organization == "org-two"
+
+
+def test_one_key_makes_no_pool(monkeypatch):
+    monkeypatch.setenv(TEST_KEY_NAME, "key-one")
+    client = MultiKeyClient("test-one-key", register_client=False)
+    client.load_api_keys()
+    assert client.get_api_key_pool() is None
+
+
+def test_single_key_client_rejects_several_keys(monkeypatch):
+    monkeypatch.setenv(TEST_KEY_NAME, "key-one,key-two")
+    client = SingleKeyClient("test-single-key", register_client=False)
+    with pytest.raises(ValueError):
+        client.load_api_keys()
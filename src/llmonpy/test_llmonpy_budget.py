@@ -0,0 +1,65 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import threading
+import time
+
+import pytest
+
+from llmonpy.llmonpy_budget import CostBudget, LLMonPyBudgetExceededException
+from llmonpy.llmonpy_deadline import LLMonPyDeadlineExceededException
+
+
+def test_reserve_within_budget():
+    cost_budget = CostBudget(1.0)
+    reservation = cost_budget.reserve(0.4)
+    reservation.settle(0.3)
+    assert cost_budget.get_spent() == pytest.approx(0.3)
+    assert cost_budget.get_remaining() == pytest.approx(0.7)
+
+
+def test_reserve_rejects_when_spent():
+    cost_budget = CostBudget(1.0)
+    cost_budget.reserve(0.5).settle(0.9)
+    with pytest.raises(LLMonPyBudgetExceededException):
+        cost_budget.reserve(0.5)
+    assert cost_budget.is_exhausted()
+
+
+def test_waiting_reserve_gives_up_at_deadline():
+    cost_budget = CostBudget(1.0)
+    cost_budget.reserve(0.8)
+    start_time = time.time()
+    with pytest.raises(LLMonPyDeadlineExceededException):
+        cost_budget.reserve(0.5, deadline=start_time + 0.2)
+    assert 0.15 < time.time() - start_time < 2.0
+    assert cost_budget.is_exhausted() is False
+
+
+def test_waiting_reserve_goes_ahead_when_room_is_settled():
+    cost_budget = CostBudget(1.0)
+    reservation = cost_budget.reserve(0.8)
+    timer = threading.Timer(0.1, reservation.settle, [0.2])
+    timer.start()
+    second_reservation = cost_budget.reserve(0.5, deadline=time.time() + 5.0)
+    timer.join()
+    assert second_reservation.estimated_cost == 0.5
+    assert cost_budget.get_remaining() == pytest.approx(0.3)
+
+
+def test_charge_counts_unreserved_spend():
+    cost_budget = CostBudget(1.0)
+    cost_budget.charge(0.25)
+    assert cost_budget.get_spent() == pytest.approx(0.25)
+    assert cost_budget.get_remaining() == pytest.approx(0.75)
@@ -0,0 +1,63 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import threading
+import time
+
+from llmonpy.llmonpy_hedge import run_hedged
+from llmonpy.llmonpy_scheduler import LLMonPyScheduler
+
+HEDGE_MODEL_NAME = "test-hedge"
+
+
+def get_hedge_lane():
+    result = LLMonPyScheduler().get_prompt_lane("test-hedge-provider", HEDGE_MODEL_NAME)
+    return result
+
+
+def test_no_hedge_delay_runs_on_the_callers_thread():
+    result, hedge_won = run_hedged(lambda: threading.current_thread(), lambda: None, None, get_hedge_lane())
+    assert result is threading.current_thread()
+    assert hedge_won is False
+
+
+def test_slow_primary_is_hedged_and_loser_is_reported():
+    loser_list = []
+    loser_event = threading.Event()
+
+    def record_loser(result):
+        loser_list.append(result)
+        loser_event.set()
+
+    result, hedge_won = run_hedged(lambda: (time.sleep(0.5), "primary")[1], lambda: "hedge", 0.05,
+                                   get_hedge_lane(), record_loser)
+    assert result == "hedge"
+    assert hedge_won
+    assert loser_event.wait(2.0)
+    assert loser_list == ["primary"]
+
+
+def test_queued_hedge_is_cancelled_when_primary_wins():
+    scheduler = LLMonPyScheduler()
+    scheduler.set_model_concurrency_limit(HEDGE_MODEL_NAME, 0)
+    hedge_call_list = []
+    try:
+        result, hedge_won = run_hedged(lambda: (time.sleep(0.2), "primary")[1],
+                                       lambda: hedge_call_list.append("hedge"), 0.05, get_hedge_lane())
+    finally:
+        scheduler.set_model_concurrency_limit(HEDGE_MODEL_NAME, None)
+    assert result == "primary"
+    assert hedge_won is False
+    assert scheduler.get_model_load(HEDGE_MODEL_NAME) == (0, 0)
+    assert hedge_call_list == []
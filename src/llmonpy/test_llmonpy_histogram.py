@@ -0,0 +1,35 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+from llmonpy.llmonpy_histogram import LatencyHistogram
+from llmonpy.llmonpy_metrics import LATENCY_BUCKET_BOUND_LIST
+
+
+def test_cumulative_count_includes_values_at_or_below_the_bound():
+    histogram = LatencyHistogram()
+    value_list = [0.0005, 0.04, 0.05, 0.09, 0.1, 0.7, 1.0, 2.4, 9.9, 10.0, 59.0, 299.0, 300.0, 1000.0]
+    for value in value_list:
+        histogram.record(value)
+    for bound in LATENCY_BUCKET_BOUND_LIST:
+        at_or_below_count = len([value for value in value_list if value <= bound])
+        assert histogram.get_cumulative_count(bound) >= at_or_below_count
+
+
+def test_cumulative_count_stays_within_a_bucket_of_the_bound():
+    histogram = LatencyHistogram()
+    histogram.record(1.0)
+    histogram.record(1.5)
+    assert histogram.get_cumulative_count(1.0) == 1
+    assert histogram.get_cumulative_count(1.5) == 2
+    assert histogram.get_cumulative_count(10000.0) == 2
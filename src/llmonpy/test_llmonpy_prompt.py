@@ -0,0 +1,219 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("ratellmiter")
+pytest.importorskip("jinja2")
+
+from llmonpy import llm_client
+from llmonpy.llm_client import LlmClientJSONFormatException, OutputLimit, SingleFlightTable
+from llmonpy.llmonpy_deadline import LLMonPyDeadlineExceededException
+from llmonpy.llmonpy_output_sizing import output_sizer
+from llmonpy.llmonpy_prompt import LLMonPyPromptRunner, LLMonPySimplePrompt, LLMonPyInputTooLongException
+from llmonpy.llmonpy_retry import RetryAttempt, ERROR_CLASS_JSON_FORMAT, ERROR_CLASS_RATE_LIMIT
+from llmonpy.llmonpy_simulated import SimulatedLlmClient
+from llmonpy.llmonpy_step import LlmModelInfo, TEMP_SETTING_KEY, INPUT_OVERFLOW_SETTING_KEY, \
+    OVERFLOW_MODEL_SETTING_KEY, INPUT_OVERFLOW_SEND, INPUT_OVERFLOW_REJECT, INPUT_OVERFLOW_TRUNCATE_EXAMPLES, \
+    INPUT_OVERFLOW_ROUTE, EXAMPLE_LIST_KEY
+
+SMALL_MODEL_NAME = "test-overflow-small"
+LARGE_MODEL_NAME = "test-overflow-large"
+EXAMPLE_PROMPT_TEXT = "Name the product.{% for example in example_list %}\nExample: {{ example }}{% endfor %}"
+EXAMPLE_LIST = ["example number " + str(index) + " is a few words long" for index in range(30)]
+
+
+class InputTokenRecorder:
+    def __init__(self):
+        self.input_token_list = []
+
+    def create_child_recorder(self, step):
+        return self
+
+    def record_input_tokens(self, input_tokens, max_input, input_overflow=None):
+        self.input_token_list.append((input_tokens, max_input, input_overflow))
+
+    def record_attempt(self, attempt):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def overflow_clients():
+    small_client = SimulatedLlmClient(SMALL_MODEL_NAME, max_input=100, register_client=False)
+    large_client = SimulatedLlmClient(LARGE_MODEL_NAME, max_input=10000, register_client=False)
+    llm_client.ACTIVE_LLM_CLIENT_DICT[SMALL_MODEL_NAME] = small_client
+    llm_client.ACTIVE_LLM_CLIENT_DICT[LARGE_MODEL_NAME] = large_client
+    yield
+    del llm_client.ACTIVE_LLM_CLIENT_DICT[SMALL_MODEL_NAME]
+    del llm_client.ACTIVE_LLM_CLIENT_DICT[LARGE_MODEL_NAME]
+
+
+def make_runner(settings_dict, prompt_text=EXAMPLE_PROMPT_TEXT):
+    client_settings_dict = {TEMP_SETTING_KEY: 0.0}
+    client_settings_dict.update(settings_dict)
+    prompt = LLMonPySimplePrompt("test_overflow", prompt_text)
+    result = LLMonPyPromptRunner(InputTokenRecorder(), prompt, LlmModelInfo(SMALL_MODEL_NAME, client_settings_dict))
+    return result
+
+
+def test_default_sends_the_prompt_as_is():
+    runner = make_runner({})
+    prompt_text = runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST})
+    assert prompt_text.count("Example:") == len(EXAMPLE_LIST)
+    input_tokens, max_input, input_overflow = runner.get_recorder().input_token_list[0]
+    assert input_tokens > max_input
+    assert input_overflow == INPUT_OVERFLOW_SEND
+
+
+def test_send_setting_matches_the_default():
+    runner = make_runner({INPUT_OVERFLOW_SETTING_KEY: INPUT_OVERFLOW_SEND})
+    prompt_text = runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST})
+    assert prompt_text.count("Example:") == len(EXAMPLE_LIST)
+
+
+def test_prompt_that_fits_is_unchanged():
+    runner = make_runner({INPUT_OVERFLOW_SETTING_KEY: INPUT_OVERFLOW_REJECT})
+    prompt_text = runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST[:2]})
+    assert prompt_text.count("Example:") == 2
+    assert runner.get_recorder().input_token_list[0][2] is None
+
+
+def test_reject_raises():
+    runner = make_runner({INPUT_OVERFLOW_SETTING_KEY: INPUT_OVERFLOW_REJECT})
+    with pytest.raises(LLMonPyInputTooLongException):
+        runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST})
+    assert runner.get_recorder().input_token_list[0][2] == INPUT_OVERFLOW_REJECT
+
+
+def test_truncate_keeps_the_longest_tail_that_fits():
+    runner = make_runner({INPUT_OVERFLOW_SETTING_KEY: INPUT_OVERFLOW_TRUNCATE_EXAMPLES})
+    prompt_text = runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST})
+    kept_count = prompt_text.count("Example:")
+    assert 0 < kept_count < len(EXAMPLE_LIST)
+    # the last examples are kept, they are the best ones
+    assert prompt_text.endswith(EXAMPLE_LIST[-1])
+    input_tokens, max_input, input_overflow = runner.get_recorder().input_token_list[0]
+    assert input_tokens <= max_input
+    assert input_overflow == "dropped " + str(len(EXAMPLE_LIST) - kept_count) + " examples"
+    # one more example wouldn't have fit
+    longer_text = runner.render_prompt_text({EXAMPLE_LIST_KEY: EXAMPLE_LIST[-(kept_count + 1):]})
+    assert runner.get_llm_client().count_input_tokens(longer_text) > max_input
+
+
+def test_truncate_rejects_when_nothing_fits():
+    runner = make_runner({INPUT_OVERFLOW_SETTING_KEY: INPUT_OVERFLOW_TRUNCATE_EXAMPLES},
+                         "word " * 500 + EXAMPLE_PROMPT_TEXT)
+    with pytest.raises(LLMonPyInputTooLongException):
+        runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST})
+    assert runner.get_recorder().input_token_list[0][2] == INPUT_OVERFLOW_REJECT
+
+
+def test_route_sends_to_the_overflow_model():
+    runner = make_runner({INPUT_OVERFLOW_SETTING_KEY: INPUT_OVERFLOW_ROUTE,
+                          OVERFLOW_MODEL_SETTING_KEY: LARGE_MODEL_NAME})
+    prompt_text = runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST})
+    assert prompt_text.count("Example:") == len(EXAMPLE_LIST)
+    assert runner.get_llm_client().model_name == LARGE_MODEL_NAME
+    assert runner.get_recorder().input_token_list[0][2] == "routed to " + LARGE_MODEL_NAME
+
+
+def test_route_rejects_without_an_overflow_model():
+    runner = make_runner({INPUT_OVERFLOW_SETTING_KEY: INPUT_OVERFLOW_ROUTE})
+    with pytest.raises(LLMonPyInputTooLongException):
+        runner.fit_to_max_input({EXAMPLE_LIST_KEY: EXAMPLE_LIST})
+    assert runner.get_llm_client().model_name == SMALL_MODEL_NAME
+
+
+def test_cut_off_json_is_retried_with_a_larger_max_output():
+    output_limit = OutputLimit(32)
+    max_output_list = []
+
+    def attempt_function(max_output):
+        max_output_list.append(max_output)
+        if max_output < 100:
+            raise LlmClientJSONFormatException('{"response": "cut', max_output)
+        return max_output
+    for _ in range(2):
+        with pytest.raises(LlmClientJSONFormatException):
+            output_limit.run(attempt_function)
+    assert output_limit.run(attempt_function) == 128
+    assert max_output_list == [32, 64, 128]
+
+
+def test_badly_formed_json_keeps_its_max_output():
+    output_limit = OutputLimit(32)
+
+    def attempt_function(max_output):
+        raise LlmClientJSONFormatException("Sure! {", 10)
+    with pytest.raises(LlmClientJSONFormatException):
+        output_limit.run(attempt_function)
+    assert output_limit.max_output == 32
+
+
+def test_cut_off_attempt_is_recorded_for_output_sizing():
+    prompt = LLMonPySimplePrompt("test_cut_off_sizing", "Answer in JSON")
+    runner = LLMonPyPromptRunner(InputTokenRecorder(), prompt, LlmModelInfo(SMALL_MODEL_NAME))
+    tracker = output_sizer().get_tracker(prompt.get_step_name())
+    sample_count = tracker.get_sample_count()
+    runner.record_attempt(RetryAttempt(1, 0.0, 0.1, ERROR_CLASS_JSON_FORMAT, "JSON parsing error", output_tokens=64))
+    runner.record_attempt(RetryAttempt(2, 0.0, 0.1, ERROR_CLASS_RATE_LIMIT, "Simulated rate limit"))
+    assert tracker.get_sample_count() == sample_count + 1
+    assert tracker.get_percentile(1.0) == 64
+
+
+class CoalescedResponse:
+    def __init__(self, response_text):
+        self.response_text = response_text
+
+    def make_coalesced_copy(self):
+        return CoalescedResponse(self.response_text)
+
+
+def follow_leader_failure(leader_exception):
+    table = SingleFlightTable()
+    future, is_leader = table.join_or_lead("request")
+    outcome_list = []
+
+    def follower():
+        try:
+            outcome_list.append(table.run("request", lambda: CoalescedResponse("follower"), time.time() + 10))
+        except Exception as e:
+            outcome_list.append(e)
+    follower_thread = threading.Thread(target=follower)
+    follower_thread.start()
+    while table.coalesced_count == 0:
+        time.sleep(0.001)
+    table.finish("request", future, exception=leader_exception)
+    follower_thread.join(5)
+    result = outcome_list[0]
+    return result
+
+
+def test_follower_runs_its_own_request_after_the_leader_misses_its_deadline():
+    outcome = follow_leader_failure(LLMonPyDeadlineExceededException(time.time(), "Leader prompt"))
+    assert outcome.response_text == "follower"
+
+
+def test_follower_runs_its_own_request_after_the_leader_fails_validation():
+    outcome = follow_leader_failure(LlmClientJSONFormatException("not what the leader wanted"))
+    assert outcome.response_text == "follower"
+
+
+def test_follower_shares_the_leader_provider_error():
+    leader_exception = RuntimeError("provider is down")
+    outcome = follow_leader_failure(leader_exception)
+    assert outcome is leader_exception
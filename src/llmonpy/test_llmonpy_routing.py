@@ -0,0 +1,58 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import threading
+
+import pytest
+
+pytest.importorskip("ratellmiter")
+
+from llmonpy import llm_client
+from llmonpy.llm_client import get_llm_client
+from llmonpy.llmonpy_routing import LlmClientGroup, add_llm_client_group, LLM_CLIENT_GROUP_DICT
+from llmonpy.llmonpy_scheduler import LLMonPyScheduler
+from llmonpy.llmonpy_simulated import SimulatedLlmClient
+
+GROUP_NAME = "test-routing-group"
+MEMBER_NAME_LIST = ["test-routing-a", "test-routing-b"]
+
+
+@pytest.fixture
+def group():
+    member_list = [SimulatedLlmClient(model_name, register_client=False) for model_name in MEMBER_NAME_LIST]
+    for member in member_list:
+        llm_client.ACTIVE_LLM_CLIENT_DICT[member.model_name] = member
+    result = add_llm_client_group(LlmClientGroup(GROUP_NAME, member_list))
+    yield result
+    del LLM_CLIENT_GROUP_DICT[GROUP_NAME]
+    for model_name in MEMBER_NAME_LIST:
+        del llm_client.ACTIVE_LLM_CLIENT_DICT[model_name]
+
+
+def test_burst_is_spread_across_the_group(group):
+    scheduler = LLMonPyScheduler()
+    scheduler.set_model_concurrency_limit(MEMBER_NAME_LIST[0], 1)
+    scheduler.set_model_concurrency_limit(MEMBER_NAME_LIST[1], 1)
+    release_event = threading.Event()
+    selected_name_list = []
+    future_list = []
+    for _ in range(10):
+        member = get_llm_client(GROUP_NAME)
+        selected_name_list.append(member.model_name)
+        future_list.append(member.get_thread_pool().submit(release_event.wait, 5.0))
+    release_event.set()
+    for future in future_list:
+        future.result()
+    assert selected_name_list.count(MEMBER_NAME_LIST[0]) == 5
+    assert selected_name_list.count(MEMBER_NAME_LIST[1]) == 5
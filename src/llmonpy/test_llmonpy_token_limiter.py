@@ -0,0 +1,49 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import time
+
+import pytest
+
+from llmonpy.llmonpy_deadline import LLMonPyDeadlineExceededException
+from llmonpy.llmonpy_token_limiter import TokenRateLimiter, estimate_token_count
+
+
+def test_estimate_token_count():
+    assert estimate_token_count(None) == 0
+    assert estimate_token_count("") == 0
+    # prose at 4 characters a token
+    assert estimate_token_count("abcd" * 25) == 25
+    # punctuation at 3 characters a token, counted once
+    assert estimate_token_count("{}," * 10) == 10
+    assert estimate_token_count("abcd" * 10 + "{}," * 10) == 20
+
+
+def test_reserve_gives_up_at_deadline():
+    token_rate_limiter = TokenRateLimiter(100)
+    token_rate_limiter.reserve(80)
+    start_time = time.time()
+    with pytest.raises(LLMonPyDeadlineExceededException):
+        token_rate_limiter.reserve(50, deadline=start_time + 0.2)
+    assert 0.15 < time.time() - start_time < 2.0
+    assert token_rate_limiter.get_waiting_count() == 0
+    assert token_rate_limiter.get_tokens_in_window() == 80
+
+
+def test_reserve_goes_ahead_when_reconciled_before_deadline():
+    token_rate_limiter = TokenRateLimiter(100)
+    reservation = token_rate_limiter.reserve(80)
+    reservation.reconcile(20)
+    token_rate_limiter.reserve(50, deadline=time.time() + 0.2)
+    assert token_rate_limiter.get_tokens_in_window() == 70
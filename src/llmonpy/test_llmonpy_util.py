@@ -0,0 +1,155 @@
+#   Copyright © 2024 Thomas Edward Burns
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+#   documentation files (the “Software”), to deal in the Software without restriction, including without limitation the
+#   rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+#   permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+#   Software.
+#
+#   THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+#   WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#   COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#   OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import io
+import json
+import os
+
+import pytest
+
+from llmonpy.llmonpy_util import fix_common_json_encoding_errors, parse_json_response, make_synthetic_json
+
+JSON_TEST_DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "..", "artifacts", "json_test_data")
+JSON_TEST_FILE_LIST = sorted(os.listdir(JSON_TEST_DATA_DIRECTORY))
+BASELINE_CONTROL_CHAR_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+
+
+"""
+  The character at a time repair fix_common_json_encoding_errors replaced, kept as the reference its output is
+  checked against.
+"""
+
+
+def baseline_next_nonwhitespace_char(input_string, i):
+    result = None
+    while i < len(input_string):
+        current_char = input_string[i]
+        if not current_char.isspace():
+            result = current_char
+            break
+        i += 1
+    return result
+
+
+def baseline_last_nonwhitespace_char(input_string, i):
+    result = None
+    while i >= 0:
+        current_char = input_string[i]
+        if not current_char.isspace():
+            result = current_char
+            break
+        i -= 1
+    return result
+
+
+def baseline_extract_value_string(json_str, start_index):
+    in_substring = False
+    result = None
+    last_char = "\""
+    for i in range(start_index, len(json_str)):
+        current_char = json_str[i]
+        if current_char == "\"" and last_char != "\\":
+            if not in_substring and baseline_next_nonwhitespace_char(json_str, i + 1) in {":", ",", "}"}:
+                result = json_str[start_index:i]
+                break
+            else:
+                in_substring = not in_substring
+        last_char = current_char
+    return result, i
+
+
+def baseline_write_value_string(json_str, start_index, string_builder):
+    last_char = None
+    value_string, end_of_value_string_index = baseline_extract_value_string(json_str, start_index)
+    for i in range(len(value_string)):
+        current_char = value_string[i]
+        if current_char == "\"" and last_char != "\\":
+            string_builder.write("\\\"")
+        elif current_char in BASELINE_CONTROL_CHAR_ESCAPES:
+            string_builder.write(BASELINE_CONTROL_CHAR_ESCAPES[current_char])
+        elif current_char == "\\":
+            if len(value_string) > i + 1 and value_string[i + 1] not in "\\\"nrtbf":
+                string_builder.write("\\\\")
+            else:
+                string_builder.write(current_char)
+        else:
+            string_builder.write(current_char)
+        last_char = current_char
+    string_builder.write("\"")
+    return end_of_value_string_index
+
+
+def baseline_fix_common_json_encoding_errors(json_str):
+    with io.StringIO() as string_builder:
+        last_char = None
+        max_index = len(json_str)
+        current_char_index = 0
+        while current_char_index < max_index:
+            current_char = json_str[current_char_index]
+            string_builder.write(current_char)
+            if current_char == "\"" and last_char != "\\":
+                if baseline_last_nonwhitespace_char(json_str, current_char_index - 1) == ":":
+                    current_char_index = baseline_write_value_string(json_str, current_char_index + 1,
+                                                                     string_builder)
+            last_char = json_str[current_char_index]
+            current_char_index += 1
+        result = string_builder.getvalue()
+    return result
+
+
+def read_test_file(file_name):
+    with open(os.path.join(JSON_TEST_DATA_DIRECTORY, file_name), "r") as file:
+        result = file.read()
+    return result
+
+
+@pytest.mark.parametrize("file_name", JSON_TEST_FILE_LIST)
+def test_repair_matches_baseline(file_name):
+    json_text = read_test_file(file_name)
+    fixed_text = fix_common_json_encoding_errors(json_text)
+    assert fixed_text == baseline_fix_common_json_encoding_errors(json_text)
+    assert json.loads(fixed_text) == json.loads(baseline_fix_common_json_encoding_errors(json_text))
+
+
+@pytest.mark.parametrize("file_name", JSON_TEST_FILE_LIST)
+def test_parse_json_response_matches_baseline(file_name):
+    json_text = read_test_file(file_name)
+    parsed_text, value = parse_json_response(json_text)
+    assert value == json.loads(baseline_fix_common_json_encoding_errors(json_text))
+    assert json.loads(parsed_text) == value
+
+
+def test_valid_json_takes_the_fast_path():
+    json_text = json.dumps({"a": "x \"quoted\" y\n", "b": [1, 2.5, None], "c": {"d": "\u00e9"}})
+    parsed_text, value = parse_json_response(json_text)
+    assert parsed_text is json_text
+    assert value == json.loads(json_text)
+
+
+def test_synthetic_repair():
+    broken_text, valid_text = make_synthetic_json(20 * 1024)
+    assert json.loads(fix_common_json_encoding_errors(broken_text)) == json.loads(valid_text)
+    assert parse_json_response(broken_text)[1] == json.loads(valid_text)
+
+
+def test_repairs_of_value_strings():
+    assert json.loads(fix_common_json_encoding_errors('{"a": "say "hi" now", "b": 1}')) == \
+        {"a": 'say "hi" now', "b": 1}
+    assert json.loads(fix_common_json_encoding_errors('{"a": "line\nnext\ttab"}')) == {"a": "line\nnext\ttab"}
+    assert json.loads(fix_common_json_encoding_errors('{"a": "C:\\qdir\\x"}')) == {"a": "C:\\qdir\\x"}
+    # valid escapes are kept, the baseline doubled the backslash of \u and \/
+    assert json.loads(fix_common_json_encoding_errors('{"a": "caf\\u00e9 a\\/b"}')) == {"a": "caf\u00e9 a/b"}
+    # a ':' inside a key doesn't start a value
+    assert json.loads(fix_common_json_encoding_errors('{"a:b": "c"}')) == {"a:b": "c"}
+    assert fix_common_json_encoding_errors(None) is None
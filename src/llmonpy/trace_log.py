@@ -23,6 +23,7 @@ import uuid
 from llmonpy.config import llmonpy_config
 from llmonpy.llmonpy_step import LLMonPyStepOutput, LLMONPY_OUTPUT_FORMAT_JSON, STEP_STATUS_NO_STATUS, STEP_STATUS_SUCCESS, \
     TraceLogRecorderInterface, TourneyResultInterface, JudgedOutput, LlmModelInfo
+from llmonpy.llmonpy_deadline import earliest_deadline
 from llmonpy.llmonpy_trace_store import SqliteLLMonPyTraceStore
 from llmonpy.system_services import add_service_to_stop
 from llmonpy.system_startup import llmonpy_start, llmonpy_stop
@@ -287,7 +288,9 @@ class StepTraceData:
     def __init__(self, trace_id, trace_group_id, variation_of_trace_id, step_id, step_index,
                  step_name, step_type, root_step_id, root_step_name, parent_step_id, parent_step_name, llm_model_info, input_dict,
                  start_time=None, end_time=None, output_dict=None, output_format=LLMONPY_OUTPUT_FORMAT_JSON,
-                 status_code=STEP_STATUS_NO_STATUS, error_list=None, cost=0.0, prompt_text=None):
+                 status_code=STEP_STATUS_NO_STATUS, error_list=None, cost=0.0, prompt_text=None, attempt_list=None,
+                 time_to_first_token=None, tokens_per_second=None, input_tokens=None, max_input=None,
+                 input_overflow=None, output_tokens=None, max_output=None):
         self.trace_id = trace_id
         self.trace_group_id = trace_group_id
         self.variation_of_trace_id = variation_of_trace_id
@@ -309,6 +312,16 @@ class StepTraceData:
         self.error_list = error_list
         self.cost = cost
         self.prompt_text = prompt_text
+        self.attempt_list = attempt_list
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        # estimated before the prompt was sent, input_overflow says what was done when it didn't fit
+        self.input_tokens = input_tokens
+        self.max_input = max_input
+        self.input_overflow = input_overflow
+        # as reported by the provider, max_output is the limit the prompt was sent with
+        self.output_tokens = output_tokens
+        self.max_output = max_output
 
     def set_prompt_text(self, prompt_text):
         self.prompt_text = prompt_text
@@ -338,6 +351,11 @@ class StepTraceData:
             self.error_list = []
         self.error_list.append(str(exception))
 
+    def add_attempt(self, attempt_dict):
+        if self.attempt_list is None:
+            self.attempt_list = []
+        self.attempt_list.append(attempt_dict)
+
     @staticmethod
     def from_dict(dict):
         result = StepTraceData(**dict)
@@ -385,6 +403,8 @@ class TraceLogRecorder (TraceLogRecorderInterface):
         self.recorder_lock = threading.Lock()
         self.next_step_index = step_index
         self.step_examples = {}
+        self.cost_budget = None
+        self.deadline = None
 
     def get_step_id(self):
         return self.trace_data.step_id
@@ -462,12 +482,51 @@ class TraceLogRecorder (TraceLogRecorderInterface):
             self.trace_data.add_exception(exception)
             self.log_exception(exception)
 
+    def record_attempt(self, attempt):
+        with self.recorder_lock:
+            self.trace_data.add_attempt(attempt.to_dict())
+            if attempt.error_message is not None:
+                self.trace_data.add_exception(attempt.error_message)
+
+    def record_stream_metrics(self, time_to_first_token, tokens_per_second):
+        self.trace_data.time_to_first_token = time_to_first_token
+        self.trace_data.tokens_per_second = tokens_per_second
+
+    def record_input_tokens(self, input_tokens, max_input, input_overflow=None):
+        self.trace_data.input_tokens = input_tokens
+        self.trace_data.max_input = max_input
+        self.trace_data.input_overflow = input_overflow
+
+    def record_output_tokens(self, output_tokens, max_output):
+        self.trace_data.output_tokens = output_tokens
+        self.trace_data.max_output = max_output
+
     def record_cost(self, cost):
         if cost is not None:
             self.add_to_cost(cost)
             if self.parent_recorder is not None:
                 self.parent_recorder.record_cost(cost)
 
+    def set_cost_budget(self, cost_budget):
+        self.cost_budget = cost_budget
+
+    # a budget set on a step covers every step below it
+    def get_cost_budget(self):
+        result = self.cost_budget
+        if result is None and self.parent_recorder is not None:
+            result = self.parent_recorder.get_cost_budget()
+        return result
+
+    def set_deadline(self, deadline):
+        self.deadline = deadline
+
+    # a deadline set on a step covers every step below it, the earliest one applies
+    def get_deadline(self):
+        result = self.deadline
+        if self.parent_recorder is not None:
+            result = earliest_deadline(result, self.parent_recorder.get_deadline())
+        return result
+
     def create_tourney_result(self, request_text, number_of_judges, judged_step_name) -> TourneyResult:
         tourney_result_id = str(uuid.uuid4())
         result = TourneyResult(tourney_result_id, self.trace_data.step_id, self.trace_data.trace_id,
@@ -600,6 +659,13 @@ class TraceLogService:
             self.trace_info_list = []
         return result
 
+    # records waiting for the next write_data, by kind
+    def get_write_backlog(self):
+        with self.write_lock:
+            result = {"steps": len(self.recorded_step_list), "events": len(self.event_list),
+                      "tourney_results": len(self.tourney_result_list), "trace_info": len(self.trace_info_list)}
+        return result
+
     def write_data(self):
         steps_ready_to_write = self.get_and_clear_recorded_steps()
         if len(steps_ready_to_write) > 0:
@@ -640,6 +706,11 @@ class TraceLogService:
         result.sort(key=lambda x: x.step_index)
         return result
 
+    # newest first, from steps that have been written
+    def get_output_tokens_for_step_name(self, step_name, limit):
+        result = self.llmonpy_trace_store.get_output_tokens_for_step_name(step_name, limit)
+        return result
+
     def get_events_for_step(self, step_id):
         result = self.llmonpy_trace_store.get_events_for_step(step_id)
         result.sort(key=lambda x: x.event_time)